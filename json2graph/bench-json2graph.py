@@ -0,0 +1,275 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import json2graph as j2g
+
+# The step lists run through a PreprocessingPlan (with the NumPy kernels if
+# available), through a plan on the vertex and edge lists and one step after
+# another.
+PLANS = [["REMOVE_H_ALL"], ["GET_CONSENSUS", "REMOVE_H_ALL"], ["REMOVE_H"],
+         ["COMPRESS_CH3"], ["REMOVE_H", "COMPRESS_CH3"],
+         ["GET_CONSENSUS", "REMOVE_H_ALL", "COMPRESS_CH3", "REMOVE_H"]]
+
+
+def generate_molecule(atoms: int, seed=0):
+    """
+    Generate a synthetic molecule with roughly the given number of atoms.
+    Heavy atoms (mostly carbon) form a tree with some ring closures, free
+    valences are filled with hydrogen atoms. Some bonds are double bonds.
+
+    :param atoms: The number of atoms.
+    :param seed: The random seed.
+    :return: A tuple of (elements, bonds) with bonds as (aid1, aid2, order).
+    """
+    rnd = random.Random(seed)
+    valences = {6: 4, 7: 3, 8: 2}
+    heavy = max(1, atoms // 3)
+    elements = [rnd.choice([6, 6, 6, 6, 7, 8]) for _ in range(heavy)]
+    free = [valences[e] for e in elements]
+    bonds = []
+    for aid in range(1, heavy):
+        candidates = [rnd.randrange(max(0, aid - 4), aid) for _ in range(3)]
+        parent = max(candidates, key=lambda x: free[x])
+        if free[parent] == 0 or free[aid] == 0:
+            continue
+        order = 2 if free[parent] > 1 and free[aid] > 1 \
+            and rnd.random() < 0.1 else 1
+        bonds += [(parent + 1, aid + 1, order)]
+        free[parent] -= order
+        free[aid] -= order
+    for aid in range(heavy):
+        if rnd.random() < 0.05 and aid > 6:
+            other = aid - rnd.randrange(4, 7)
+            if free[aid] > 0 and free[other] > 0:
+                bonds += [(other + 1, aid + 1, 1)]
+                free[aid] -= 1
+                free[other] -= 1
+    for aid in range(heavy):
+        for _ in range(free[aid]):
+            if len(elements) >= atoms:
+                break
+            elements += [1]
+            bonds += [(aid + 1, len(elements), 1)]
+    return elements, bonds
+
+
+def write_pubchem_json(path: str, elements: list, bonds: list):
+    """
+    Write a molecule in PubChem JSON format.
+
+    :param path: The output path.
+    :param elements: The element numbers of the atoms.
+    :param bonds: The bonds as tuples of (aid1, aid2, order).
+    :return: Nothing.
+    """
+    compound = {"id": {"id": {"cid": 1}},
+                "atoms": {"aid": list(range(1, len(elements) + 1)),
+                          "element": elements},
+                "bonds": {"aid1": [b[0] for b in bonds],
+                          "aid2": [b[1] for b in bonds],
+                          "order": [b[2] for b in bonds]}}
+    with open(path, "w") as file:
+        json.dump({"PC_Compounds": [compound]}, file)
+
+
+def generate_aligned_graph(atoms: int, molecules=8, seed=0):
+    """
+    Generate a synthetic aligned graph as written by multiVitamin. Every
+    vertex label lists the labels of the aligned vertices of all molecules,
+    separated by spaces.
+
+    :param atoms: The number of vertices.
+    :param molecules: The number of aligned molecules.
+    :param seed: The random seed.
+    :return: The graph.
+    """
+    rnd = random.Random(seed)
+    elements, bonds = generate_molecule(atoms, seed)
+    vertices = []
+    for aid, element in enumerate(elements, 1):
+        labels = [str(element) if rnd.random() < 0.7
+                  else rnd.choice(["1", "6", "7", "8", ""])
+                  for _ in range(molecules)]
+        vertices += [(str(aid), " ".join(labels))]
+    edges = [(str(b[0]), str(b[1]), str(b[2])) for b in bonds]
+    return j2g.Graph(vertices, edges)
+
+
+def measure(function, repeat: int):
+    """
+    Measure the best wall time of a function.
+
+    :param function: The function, called without arguments.
+    :param repeat: The number of runs.
+    :return: The best time in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_steps(graph, steps: list):
+    """
+    Run preprocessing steps one after another, without a plan.
+
+    :param graph: The graph.
+    :param steps: The steps (by name).
+    :return: The graph after preprocessing.
+    """
+    for step in steps:
+        graph = graph.preprocess(j2g.Preprocessing.get(step))
+    return graph
+
+
+def run_lists(graph, steps: list):
+    """
+    Run a PreprocessingPlan on the vertex and edge lists, without NumPy.
+
+    :param graph: The graph.
+    :param steps: The steps (by name).
+    :return: The graph after preprocessing.
+    """
+    numpy = j2g.numpy
+    j2g.numpy = None
+    try:
+        return j2g.PreprocessingPlan(steps).run(graph)
+    finally:
+        j2g.numpy = numpy
+
+
+def run_benchmarks(sizes: list, repeat: int, tmp: str):
+    """
+    Run all benchmarks.
+
+    :param sizes: The numbers of atoms.
+    :param repeat: The number of runs per benchmark.
+    :param tmp: A directory for the generated inputs.
+    :return: A list of result dicts.
+    """
+    results = []
+
+    def record(name, atoms, function):
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds = measure(function, repeat)
+        results.append({"benchmark": name, "atoms": atoms,
+                        "seconds": seconds})
+        sys.stderr.write("%-28s %8d atoms %10.6f s\n"
+                         % (name, atoms, seconds))
+
+    for size in sizes:
+        json_path = os.path.join(tmp, "molecule-%d.json" % size)
+        graph_path = os.path.join(tmp, "aligned-%d.graph" % size)
+        out_path = os.path.join(tmp, "out.graph")
+        write_pubchem_json(json_path, *generate_molecule(size))
+        aligned = generate_aligned_graph(size)
+        with contextlib.redirect_stdout(io.StringIO()):
+            aligned.write(graph_path, "bench")
+        molecule = j2g.Graph.read_graph_json(json_path)
+        record("read_graph_json", size,
+               lambda: j2g.Graph.read_graph_json(json_path))
+        record("read_graph_graph", size,
+               lambda: j2g.Graph.read_graph_graph(graph_path))
+        for step in j2g.Preprocessing:
+            source = aligned if step == j2g.Preprocessing.GET_CONSENSUS \
+                else molecule
+            record("preprocess." + step.value, size,
+                   lambda: source.copy().preprocessing([step.value]))
+        record("get_consesus", size, lambda: aligned.get_consesus())
+        for steps in PLANS:
+            source = aligned if "GET_CONSENSUS" in steps else molecule
+            name = "+".join(steps)
+            record("plan." + name, size,
+                   lambda: j2g.PreprocessingPlan(steps).run(source.copy()))
+            record("lists." + name, size,
+                   lambda: run_lists(source.copy(), steps))
+            record("steps." + name, size,
+                   lambda: run_steps(source.copy(), steps))
+        record("write", size, lambda: molecule.write(out_path, "bench"))
+    return results
+
+
+def get_commit():
+    """
+    Get the current git commit, if available.
+
+    :return: The commit hash or None.
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, current: dict, threshold: float):
+    """
+    Compare two benchmark runs.
+
+    :param baseline: The baseline run.
+    :param current: The current run.
+    :param threshold: The slowdown factor that counts as a regression.
+    :return: A list of (benchmark, atoms, factor) tuples of regressions.
+    """
+    old = {(r["benchmark"], r["atoms"]): r["seconds"]
+           for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        key = (result["benchmark"], result["atoms"])
+        if key not in old or old[key] <= 0:
+            continue
+        factor = result["seconds"] / old[key]
+        sys.stderr.write("%-28s %8d atoms %6.2fx\n" % (key[0], key[1],
+                                                       factor))
+        if factor > threshold:
+            regressions += [(key[0], key[1], factor)]
+    return regressions
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(
+        description="Benchmark json2graph on synthetic inputs.")
+    ap.add_argument("-s", "--sizes", nargs="+", type=int, metavar="ATOMS",
+                    default=[10, 100, 1000, 10000, 100000],
+                    help="Numbers of atoms (default: 10 to 10^5, use up to "
+                         "10^6 for full runs)")
+    ap.add_argument("-r", "--repeat", type=int, default=3,
+                    help="Runs per benchmark, the best run is reported.")
+    ap.add_argument("-o", "--output", help="Write the results to a JSON file.")
+    ap.add_argument("-c", "--compare", metavar="BASELINE",
+                    help="Compare with the results of an earlier run.")
+    ap.add_argument("-t", "--threshold", type=float, default=1.25,
+                    help="Slowdown factor reported as regression "
+                         "(default: 1.25).")
+    args = ap.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        run = {"commit": get_commit(),
+               "python": platform.python_version(),
+               "numpy": j2g.numpy is not None,
+               "timestamp": time.time(),
+               "results": run_benchmarks(args.sizes, args.repeat, tmp_dir)}
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(run, outfile, indent=1)
+    if args.compare:
+        with open(args.compare) as infile:
+            regressions = compare(json.load(infile), run, args.threshold)
+        for name, atoms, factor in regressions:
+            sys.stderr.write("Regression: %s with %d atoms is %.2fx slower\n"
+                             % (name, atoms, factor))
+        if regressions:
+            exit(1)
@@ -0,0 +1,79 @@
+import json
+import os
+import socket
+import sys
+import tempfile
+
+
+def get_socket_path():
+    """
+    Get the socket path of the server, like get_default_socket in
+    json2graph.py.
+
+    :return: The path.
+    """
+    return os.environ.get("JSON2GRAPH_SOCKET") or os.path.join(
+        tempfile.gettempdir(), "json2graph-" + str(os.getuid()) + ".sock")
+
+
+def connect(path: str):
+    """
+    Connect to a server started with json2graph.py --serve.
+
+    :param path: The path of the socket.
+    :return: The connected socket.
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except OSError:
+        connection.close()
+        raise
+    return connection
+
+
+def send(request: dict, connection):
+    """
+    Send a request to the server and wait for the reply. The connection is
+    closed afterwards.
+
+    :param request: The request.
+    :param connection: The socket connected to the server (see connect).
+    :return: The reply.
+    """
+    with connection, connection.makefile("rwb") as stream:
+        stream.write(json.dumps(request).encode("utf-8") + b"\n")
+        stream.flush()
+        line = stream.readline()
+    if not line:
+        raise ValueError("The server closed the connection")
+    reply = json.loads(line.decode("utf-8"))
+    if not isinstance(reply, dict) or "exit_code" not in reply:
+        raise ValueError("Malformed reply: " + repr(reply))
+    return reply
+
+
+if __name__ == '__main__':
+    # The same arguments as json2graph.py, --stop-server stops the server.
+    argv = sys.argv[1:]
+    if argv == ["--stop-server"]:
+        send({"stop": True}, connect(get_socket_path()))
+        exit(0)
+    try:
+        connection = connect(get_socket_path())
+    except (FileNotFoundError, ConnectionRefusedError):
+        # No server, run json2graph in this process.
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "json2graph.py")
+        os.execv(sys.executable, [sys.executable, script] + argv)
+    try:
+        reply = send({"argv": argv, "cwd": os.getcwd()}, connection)
+    except (OSError, ValueError) as e:
+        # The server may have written some outputs already, running the
+        # conversion again could mix them with outputs of this process.
+        sys.stderr.write("Error: No valid reply from the server: " + str(e)
+                         + "\n")
+        exit(1)
+    sys.stdout.write(reply.get("stdout", ""))
+    sys.stderr.write(reply.get("stderr", ""))
+    exit(reply["exit_code"])
@@ -1,10 +1,65 @@
 import argparse
+import asyncio
+import bz2
+import contextlib
+import ctypes
+import ctypes.util
+import gc
+import gzip
+import hashlib
+import io
+import itertools
 import json
+import lzma
+import mmap
+import operator
 import os
+import select
+import shutil
+import socket
+import sqlite3
+import struct
 import sys
+import tempfile
+import time
+import tracemalloc
 
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum, unique
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The binary graph format: a header, a label table (offsets and UTF-8 data)
+# and int32 columns of vertex ids, vertex labels, edge sources, edge targets
+# and edge labels. All numbers are little-endian.
+BINARY_MAGIC = b"J2GRAPH\x01"
+BINARY_HEADER = struct.Struct("<8s4IQi4x")
+
+# The file name suffixes of the output formats.
+OUT_FORMAT_SUFFIXES = {"graph": ".graph", "binary": ".bgraph"}
+
+# The compression formats of the output files (by their suffix).
+COMPRESSION_FORMATS = ["gz", "bz2", "xz"]
+
+# The compression modules by file name suffix (used when writing) and by
+# magic bytes (used when reading).
+COMPRESSION_SUFFIXES = {".gz": gzip, ".bz2": bz2, ".xz": lzma, ".lzma": lzma}
+COMPRESSION_MAGIC = [(b"\x1f\x8b", gzip), (b"BZh", bz2),
+                     (b"\xfd7zXZ\x00", lzma)]
+
+# At most this many vertices and edges are preallocated from the header
+# counts of a .graph file (the counts may be wrong).
+PREALLOCATE_MAX = 1 << 20
+
+# Graphs with at least this many vertices are preprocessed with the NumPy
+# kernels (if NumPy is available).
+VECTORIZE_MIN_VERTICES = 256
+
 
 @unique
 class Preprocessing(Enum):
@@ -54,9 +109,114 @@ class Graph:
             vertices = []
         if edges is None:
             edges = []
+        self._adjacency = None
+        self._vertex_index = None
+        self._arrays = None
         self.vertices = vertices
         self.edges = edges
 
+    @property
+    def vertices(self):
+        """
+        The list of vertices as tuples of (id, label).
+        Assigning a new list will invalidate the vertex index.
+        """
+        return self._vertices
+
+    @vertices.setter
+    def vertices(self, vertices):
+        self._vertices = vertices
+        self._vertex_index = None
+        self._arrays = None
+
+    @property
+    def edges(self):
+        """
+        The list of edges as tuples of (source_id, target_id, label).
+        Assigning a new list will invalidate the adjacency index.
+        """
+        return self._edges
+
+    @edges.setter
+    def edges(self, edges):
+        self._edges = edges
+        self._adjacency = None
+        self._arrays = None
+
+    def get_adjacency(self):
+        """
+        Get the adjacency index of this graph. This maps each vertex id to a
+        list of (neighbor_id, edge_label), in the order of the edge list.
+        The index is built on first use and kept up to date by the methods of
+        this class. Lists modified in place require a new assignment of
+        vertices or edges.
+
+        :return: The adjacency index.
+        """
+        if self._adjacency is None:
+            adjacency = dict()
+            for e in self.edges:
+                adjacency.setdefault(e[0], []).append((e[1], e[2]))
+                if e[0] != e[1]:
+                    adjacency.setdefault(e[1], []).append((e[0], e[2]))
+            self._adjacency = adjacency
+        return self._adjacency
+
+    def get_vertex_index(self):
+        """
+        Get the vertex index of this graph. This maps each vertex id to a
+        tuple of (position, vertex).
+
+        :return: The vertex index.
+        """
+        if self._vertex_index is None:
+            self._vertex_index = {v[0]: (i, v)
+                                  for i, v in enumerate(self.vertices)}
+        return self._vertex_index
+
+    def get_arrays(self):
+        """
+        Get the NumPy arrays of this graph used by the vectorized steps. Like
+        the other indices, they are built on first use. The vectorized steps
+        pass them on to their result, so a chain of steps converts the tuple
+        lists only once. Requires NumPy.
+
+        :return: A dict of "positions" (the position of the last vertex with
+        the id of every vertex, like in the vertex index), "unique" (whether
+        the vertex ids are unique), "labels" (the vertex labels), "sources"
+        and "targets" (the positions of the vertices of every edge, -1 for
+        unknown vertices) and "multibond" (the edges with a label other than
+        "1").
+        """
+        if self._arrays is None:
+            vertices = self.vertices
+            edges = self.edges
+            id_position = dict(zip(map(operator.itemgetter(0), vertices),
+                                   itertools.count()))
+            get = id_position.get
+            unique = len(id_position) == len(vertices)
+            if unique:
+                positions = numpy.arange(len(vertices))
+            else:
+                positions = numpy.fromiter(
+                    map(id_position.__getitem__,
+                        map(operator.itemgetter(0), vertices)),
+                    dtype=numpy.intp, count=len(vertices))
+            arrays = {"positions": positions, "unique": unique,
+                      "labels": numpy.array(
+                          list(map(operator.itemgetter(1), vertices)),
+                          dtype=object)}
+            for key, column in ("sources", 0), ("targets", 1):
+                arrays[key] = numpy.fromiter(
+                    map(get, map(operator.itemgetter(column), edges),
+                        itertools.repeat(-1)),
+                    dtype=numpy.intp, count=len(edges))
+            arrays["multibond"] = numpy.fromiter(
+                map("1".__ne__, map(operator.itemgetter(2), edges)),
+                dtype=bool, count=len(edges))
+            self._arrays = arrays
+        return self._arrays
+
     def have_neighbors_multibonds(self, vertex):
         """
         Calculate whether any neighbor of a vertex has multibonds 
@@ -81,18 +241,13 @@ class Graph:
         :param vertex: The vertex to get neighbors of.
         :return: The neighbors of the vertex and the corresponding edge label.
         """
-        vid = vertex[0]
-        edges_min = list(map(lambda x: (x[0], x[1]), self.edges))
-        neighbors = filter(lambda x: ((x[0], vid) in edges_min or
-                                      (vid, x[0] in edges_min)), self.vertices)
-        res = []
-        for neighbor in neighbors:
-            n_id = neighbor[0]
-            for connecting in [e for e in self.edges if
-                               (e[0] == vid and e[1] == n_id) or
-                               (e[0] == n_id and e[1] == vid)]:
-                res += [(neighbor, connecting[2])]
-        return res
+        vertex_index = self.get_vertex_index()
+        neighbors = [(vertex_index[n_id], label) for n_id, label in
+                     self.get_adjacency().get(vertex[0], ())
+                     if n_id in vertex_index]
+        # Neighbors are ordered like the vertex list, then like the edge list.
+        neighbors.sort(key=lambda x: x[0][0])
+        return [(neighbor[1], label) for neighbor, label in neighbors]
 
     def compress_ch3(self):
         """
@@ -100,7 +255,7 @@ class Graph:
 
         :return: The graph with compressed CH_3 subgraphs.
         """
-        to_remove = []
+        to_remove = set()
         new_vertices = []
         for vertex in self.vertices:
             if vertex[1] != "6":
@@ -110,12 +265,14 @@ class Graph:
                                     map(lambda x: x[0],
                                         self.get_neighbors_of(vertex))))
             if len(neighbors) == 3:
-                to_remove += neighbors
+                to_remove.update(neighbors)
                 new_vertices += [(vertex[0], "CH3")]
             else:
                 new_vertices += [vertex]
-        return Graph(new_vertices, self.edges)\
-            .filter_vertices(lambda x: x not in to_remove)
+        result = Graph(new_vertices, self.edges)
+        # The edges are unchanged, the adjacency index can be shared.
+        result._adjacency = self.get_adjacency()
+        return result.filter_vertices(lambda x: x not in to_remove)
 
     def copy(self):
         """
@@ -125,6 +282,29 @@ class Graph:
         """
         return Graph(self.vertices.copy(), self.edges.copy())
 
+    def shallow_copy(self):
+        """
+        Return a copy of this graph sharing the vertex and edge lists and the
+        indices. The methods of this class never modify these lists in place,
+        they assign new ones, so the copy can be preprocessed without changing
+        this graph (copy-on-write).
+
+        :return: A shallow copy of this graph.
+        """
+        result = Graph(self.vertices, self.edges)
+        result._adjacency = self._adjacency
+        result._vertex_index = self._vertex_index
+        result._arrays = self._arrays
+        return result
+
+    def view(self):
+        """
+        Return a lazy view of this graph, see GraphView.
+
+        :return: A view showing the whole graph.
+        """
+        return GraphView(self)
+
     def degree(self, vertex):
         """
         Get the degree of a vertex.
@@ -132,8 +312,12 @@ class Graph:
         :param vertex: The vertex.
         :return: The degree of that vertex.
         """
-        return len(set([e for e in self.edges if e[0] == vertex[0] or
-                       e[1] == vertex[0]]))
+        neighbors = self.get_adjacency().get(vertex[0], ())
+        if len(set(neighbors)) == len(neighbors):
+            return len(neighbors)
+        # Repeated neighbors are parallel or reversed edges, only identical
+        # edges count once.
+        return len({e for e in self.edges if vertex[0] in e[:2]})
 
     def filter_vertices(self, vertex_filter):
         """
@@ -153,24 +337,37 @@ class Graph:
 
         :return: The consensus graph.
         """
+        if numpy is not None and \
+                len(self.vertices) >= VECTORIZE_MIN_VERTICES:
+            return ConsensusEngine().get_consensus([self])[0]
         new_vertices = []
         for v in self.vertices:
-            labels = v[1].split(" ")
-            label_counts = dict()
-            for l in labels:
-                if l in label_counts:
-                    label_counts[l] += 1
-                else:
-                    label_counts[l] = 1
-            new_label = ""
-            new_count = 0
-            for label in label_counts:
-                if new_count < label_counts[label]:
-                    new_label = label
-                    new_count = label_counts[label]
-            new_vertices += [(v[0], new_label if new_label != "" else "0")]
+            new_vertices += [(v[0], Graph.consensus_label(v[1]))]
         return Graph(new_vertices, self.edges)
 
+    @staticmethod
+    def consensus_label(label: str):
+        """
+        Get the most common label of an aligned vertex label. If multiple
+        labels are the most common, the first one is used.
+
+        :param label: The space-separated labels of an aligned vertex.
+        :return: The consensus label or "0" if there is none.
+        """
+        labels = label.split(" ")
+        label_counts = dict()
+        for l in labels:
+            if l in label_counts:
+                label_counts[l] += 1
+            else:
+                label_counts[l] = 1
+        new_label = ""
+        new_count = 0
+        for label in label_counts:
+            if new_count < label_counts[label]:
+                new_label = label
+                new_count = label_counts[label]
+        return new_label if new_label != "" else "0"
 
     def induced_subgraph(self):
         """
@@ -179,13 +376,170 @@ class Graph:
 
         :return: The induced subgraph.
         """
-        vertex_ids = sorted(map(lambda x: x[0], self.vertices))
+        vertex_ids = set(map(lambda x: x[0], self.vertices))
         result_edges = list(filter(
             lambda x: (x[0] in vertex_ids and x[1] in vertex_ids), self.edges))
+        adjacency = None
+        if self._adjacency is not None:
+            # Update the existing index instead of rebuilding it.
+            adjacency = dict()
+            for vid, neighbors in self._adjacency.items():
+                if vid in vertex_ids:
+                    adjacency[vid] = [n for n in neighbors
+                                      if n[0] in vertex_ids]
         self.edges = result_edges
+        self._adjacency = adjacency
         return self
 
-    def write(self, outpath, author=None):
+    def get_wl_colors(self, iterations=3):
+        """
+        Get the Weisfeiler-Lehman colors of the vertices. The color of a vertex
+        starts as its label and is refined with the labels of its edges and
+        the colors of its neighbors. The colors do not depend on the vertex
+        ids or the order of vertices and edges, so they can be compared
+        between graphs. Edges to unknown vertices are ignored.
+
+        :param iterations: The number of refinements.
+        :return: A dict of vertex id to color.
+        """
+        vertex_index = self.get_vertex_index()
+        adjacency = self.get_adjacency()
+        colors = {v[0]: v[1] for v in self.vertices}
+        for _ in range(iterations):
+            new_colors = dict()
+            for vid, color in colors.items():
+                signature = sorted(n[1] + ":" + colors[n[0]]
+                                   for n in adjacency.get(vid, [])
+                                   if n[0] in vertex_index)
+                new_colors[vid] = hashlib.sha1(
+                    (color + "(" + ",".join(signature) + ")")
+                    .encode("utf-8")).hexdigest()[:16]
+            colors = new_colors
+        return colors
+
+    def canonical_hash(self, iterations=3):
+        """
+        Get a canonical hash of the structure of this graph, i.e. of the vertex
+        and edge labels (not of the vertex ids). Isomorphic graphs have the
+        same hash, graphs with the same hash are not necessarily isomorphic
+        (see is_isomorphic).
+
+        :param iterations: The number of Weisfeiler-Lehman refinements.
+        :return: The hash as hex string.
+        """
+        colors = self.get_wl_colors(iterations)
+        edges = sorted(min(colors[e[0]], colors[e[1]]) + ":"
+                       + max(colors[e[0]], colors[e[1]]) + ":" + e[2]
+                       for e in self.edges
+                       if e[0] in colors and e[1] in colors)
+        digest = hashlib.sha256()
+        digest.update((str(len(colors)) + ";" + str(len(edges)) + "\n")
+                      .encode("utf-8"))
+        digest.update(("\n".join(sorted(colors.values())) + "\n")
+                      .encode("utf-8"))
+        digest.update("\n".join(edges).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _get_edge_labels(self):
+        """
+        Get the sorted labels of the (undirected) edges between each pair of
+        vertices. Edges to unknown vertices are ignored.
+
+        :return: A dict of (vertex id, vertex id) (in both orders) to a tuple
+        of edge labels.
+        """
+        vertex_index = self.get_vertex_index()
+        edge_labels = dict()
+        for e in self.edges:
+            if e[0] in vertex_index and e[1] in vertex_index:
+                edge_labels.setdefault((e[0], e[1]), []).append(e[2])
+                if e[0] != e[1]:
+                    edge_labels.setdefault((e[1], e[0]), []).append(e[2])
+        return {pair: tuple(sorted(labels))
+                for pair, labels in edge_labels.items()}
+
+    def is_isomorphic(self, other):
+        """
+        Check whether this graph is isomorphic to another graph, respecting
+        the vertex and edge labels. The vertices are matched by backtracking,
+        restricted to vertices of the same Weisfeiler-Lehman color.
+
+        :param other: The other graph.
+        :return: True if the graphs are isomorphic, False otherwise.
+        """
+        colors = self.get_wl_colors()
+        other_colors = other.get_wl_colors()
+        if len(colors) != len(self.vertices) or \
+                len(other_colors) != len(other.vertices):
+            # Duplicate vertex ids, fall back to a plain comparison.
+            return self.vertices == other.vertices and \
+                self.edges == other.edges
+        if sorted(colors.values()) != sorted(other_colors.values()):
+            return False
+        edge_labels = self._get_edge_labels()
+        other_edge_labels = other._get_edge_labels()
+        if sorted(edge_labels.values()) != \
+                sorted(other_edge_labels.values()):
+            return False
+        candidates = dict()
+        for vid, color in other_colors.items():
+            candidates.setdefault(color, []).append(vid)
+        neighbors = dict()
+        for u, w in edge_labels:
+            neighbors.setdefault(u, set()).add(w)
+        other_neighbors = dict()
+        for u, w in other_edge_labels:
+            other_neighbors.setdefault(u, set()).add(w)
+        # Match the vertices in BFS order starting at the rarest colors, so
+        # most vertices have a matched neighbor.
+        order = []
+        seen = set()
+        for start in sorted(colors, key=lambda x: len(candidates[colors[x]])):
+            if start in seen:
+                continue
+            seen.add(start)
+            queue = [start]
+            for u in queue:
+                order += [u]
+                for w in sorted(neighbors.get(u, ()),
+                                key=lambda x: len(candidates[colors[x]])):
+                    if w not in seen:
+                        seen.add(w)
+                        queue += [w]
+        mapping = dict()
+        used = set()
+
+        def consistent(u, v):
+            mapped = [w for w in neighbors.get(u, ()) if w in mapping]
+            if len(mapped) != len(used.intersection(
+                    other_neighbors.get(v, ()))):
+                return False
+            if edge_labels.get((u, u)) != other_edge_labels.get((v, v)):
+                return False
+            return all(edge_labels[(u, w)] ==
+                       other_edge_labels.get((v, mapping[w]))
+                       for w in mapped if w != u)
+
+        # Iterative backtracking, a stack of candidate iterators.
+        stack = [iter(candidates[colors[order[0]]])] if order else []
+        while stack:
+            u = order[len(stack) - 1]
+            if u in mapping:
+                used.discard(mapping.pop(u))
+            for v in stack[-1]:
+                if v not in used and consistent(u, v):
+                    mapping[u] = v
+                    used.add(v)
+                    break
+            else:
+                stack.pop()
+                continue
+            if len(stack) == len(order):
+                return True
+            stack += [iter(candidates[colors[order[len(stack)]]])]
+        return not order
+
+    def write(self, outpath, author=None, out_format="graph"):
         """
         Writes the graph in the format used by read_graph (as lists of tuples)
         as the custom .graph format used by the other tools in the Praktikum.
@@ -193,26 +547,13 @@ class Graph:
         :param outpath: The path of the output .graph file.
         :param author: The value of the author field in the output file
         (optional).
+        :param out_format: The output format (graph or binary).
         """
-        vertex_count = str(len(self.vertices))
-        edges_count = str(len(self.edges))
-        print("Writing ", outpath, " with ", vertex_count, " vertices and ",
-              edges_count, " edges.")
-        outfile = open(outpath, "w")
-        if author:
-            outfile.write("AUTHOR: " + author + "\n")
-        outfile.write("#nodes;" + vertex_count + "\n")
-        outfile.write("#edges;" + edges_count + "\n")
-        outfile.write("Nodes labelled;True\n")
-        outfile.write("Edges labelled;True\n")
-        outfile.write("Directed graph;False\n")
-        outfile.write("\n")
-        for vertex in self.vertices:
-            outfile.write(";".join(vertex) + "\n")
-        outfile.write("\n")
-        for edge in self.edges:
-            outfile.write(";".join(edge) + "\n")
-        outfile.close()
+        if out_format == "binary":
+            CompactGraph.from_graph(self).write(outpath, author, out_format)
+            return
+        write_graph_text(outpath, self.vertices, self.edges,
+                         len(self.vertices), len(self.edges), author)
 
     def preprocess(self, step: Preprocessing):
         """
@@ -222,6 +563,14 @@ class Graph:
         :return: The processed graph.
         """
         remove_atoms = ["1"]
+        # REMOVE_H_ALL does not look at neighbors, converting the graph to
+        # arrays costs more than the kernel saves. It only uses the kernel if
+        # the arrays are built already.
+        if numpy is not None and step in VECTORIZED_STEPS and \
+                len(self.vertices) >= VECTORIZE_MIN_VERTICES and \
+                (step != Preprocessing.REMOVE_H_ALL or
+                 self._arrays is not None):
+            return self.preprocess_vectorized(step)
         if step == Preprocessing.REMOVE_H:
             return self.filter_vertices(
                 lambda x: x[1] not in remove_atoms or
@@ -236,128 +585,499 @@ class Graph:
         else:
             raise Exception("Unknown step: " + str(step))
 
-    def preprocessing(self, step_names: list):
+    def preprocess_vectorized(self, step: Preprocessing):
+        """
+        Run a structural preprocessing step (REMOVE_H, REMOVE_H_ALL or
+        COMPRESS_CH3) using the NumPy kernels. The result is the same as the
+        result of preprocess.
+
+        :param step: The step.
+        :return: The processed graph.
+        """
+        if step not in VECTORIZED_STEPS:
+            raise Exception("Step not vectorized: " + str(step))
+        arrays = self.get_arrays()
+        positions = arrays["positions"]
+        labels = arrays["labels"]
+        sources = arrays["sources"]
+        targets = arrays["targets"]
+        valid = (sources >= 0) & (targets >= 0)
+        is_h = labels == "1"
+        new_vertices = self.vertices
+        if step == Preprocessing.REMOVE_H:
+            neighbor_multibond = remove_h_kernel(
+                len(labels), sources[valid], targets[valid],
+                arrays["multibond"][valid])
+            keep = ~is_h | neighbor_multibond[positions]
+        elif step == Preprocessing.REMOVE_H_ALL:
+            keep = ~is_h
+        else:
+            is_c = labels == "6"
+            is_c_id = numpy.zeros(len(labels), dtype=bool)
+            is_c_id[positions[is_c]] = True
+            compressed, removed = compress_ch3_kernel(
+                is_h, is_c_id, sources[valid], targets[valid])
+            keep = ~(is_h & removed[positions])
+            compressed = is_c & compressed[positions]
+            new_vertices = [(v[0], "CH3") if c else v for v, c in
+                            zip(self.vertices, compressed.tolist())]
+            if compressed.any():
+                labels = labels.copy()
+                labels[compressed] = "CH3"
+        kept_ids = numpy.zeros(len(labels), dtype=bool)
+        kept_ids[positions[keep]] = True
+        keep_edges = valid.copy()
+        keep_edges[valid] = kept_ids[sources[valid]] & \
+            kept_ids[targets[valid]]
+        result = self if step != Preprocessing.COMPRESS_CH3 else Graph()
+        result.vertices = list(itertools.compress(new_vertices,
+                                                  keep.tolist()))
+        result.edges = list(itertools.compress(self.edges,
+                                               keep_edges.tolist()))
+        if arrays["unique"]:
+            # Only edges between kept vertices remain, renumber them.
+            new_position = numpy.cumsum(keep) - 1
+            result._arrays = {
+                "positions": numpy.arange(len(result.vertices)),
+                "unique": True, "labels": labels[keep],
+                "sources": new_position[sources[keep_edges]],
+                "targets": new_position[targets[keep_edges]],
+                "multibond": arrays["multibond"][keep_edges]}
+        return result
+
+    def preprocessing(self, step_names: list, profiler=None):
         """
-        Run preprocessing steps.
+        Run preprocessing steps through a PreprocessingPlan.
 
         :param step_names: The steps (by name)
+        :param profiler: A Profiler recording every step (optional).
         :return: The graph after preprocessing.
         """
         if not step_names:
             return self
-        g = self
-        for step in step_names:
-            g = g.preprocess(Preprocessing.get(step))
-        return g
+        return PreprocessingPlan(step_names).run(self, profiler)
+
+    def preprocessing_variants(self, pipelines: dict, profiler=None):
+        """
+        Run several preprocessing pipelines. Steps of a common prefix of
+        multiple pipelines are only run once. This graph is not changed.
+
+        :param pipelines: A dict of variant names to lists of steps (by name).
+        :param profiler: A Profiler recording every step (optional, see
+        preprocessing). Steps of a common prefix are recorded once.
+        :return: A dict of variant names to the graphs after preprocessing.
+        """
+        results = dict()
+
+        def run(graph, done, names):
+            for name in names:
+                if len(pipelines[name]) == done:
+                    results[name] = graph
+            groups = OrderedDict()
+            for name in names:
+                if len(pipelines[name]) > done:
+                    groups.setdefault(pipelines[name][done], []).append(name)
+            for step, group in groups.items():
+                # Extend the common steps until the group branches.
+                segment = [step]
+                while True:
+                    position = done + len(segment)
+                    following = set(pipelines[name][position]
+                                    if len(pipelines[name]) > position
+                                    else None for name in group)
+                    if len(following) != 1 or None in following:
+                        break
+                    segment += following
+                run(graph.shallow_copy().preprocessing(segment, profiler),
+                    done + len(segment), group)
+
+        run(self, 0, list(pipelines))
+        return results
 
     @classmethod
-    def read_graph(cls, in_path: str, in_format="auto"):
+    def read_graph(cls, in_path: str, in_format="auto", compact=False):
         """
-        Read a graph in either json or .graph format.
+        Read a graph in either json or .graph format. Compressed files
+        (gzip, bz2 or xz) are decompressed transparently.
 
         :param in_path: The input path.
         :param in_format: The input format (or auto).
+        :param compact: Read the graph as a CompactGraph.
         :return: A new graph read from the file
         """
+        in_format = Graph.detect_format(in_path, in_format)
+        if in_format == "json":
+            return Graph.read_graph_json(in_path, compact)
+        elif in_format == "binary":
+            return Graph.read_graph_binary(in_path, compact)
+        else:
+            return Graph.read_graph_graph(in_path, compact)
+
+    @classmethod
+    def parse_graph(cls, data: bytes, in_path: str, in_format="auto",
+                    compact=False):
+        """
+        Parse a graph from the content of a file that was already read into
+        memory.
+
+        :param data: The file content (optionally compressed).
+        :param in_path: The input path (used to detect the format).
+        :param in_format: The input format (or auto).
+        :param compact: Parse the graph as a CompactGraph.
+        :return: The parsed graph.
+        """
+        in_format = Graph.detect_format(in_path, in_format)
+        data = decompress(data)
+        if in_format == "json":
+            return Graph.from_compound_json(
+                json.loads(data)["PC_Compounds"][0], compact)
+        elif in_format == "binary":
+            result = CompactGraph.from_buffer(data, in_path)
+            if compact:
+                return result
+            return result.to_graph()
+        else:
+            return Graph._read_graph_file(io.TextIOWrapper(io.BytesIO(data)),
+                                          compact)
+
+    @staticmethod
+    def detect_format(in_path: str, in_format="auto"):
+        """
+        Get the format of an input file.
+
+        :param in_path: The input path.
+        :param in_format: The input format (or auto).
+        :return: The detected format (json, graph or binary).
+        """
+        in_path = strip_compression_suffix(in_path)
         if (in_format == "auto" and in_path.endswith("json"))\
                 or in_format == "json":
-            return Graph.read_graph_json(in_path)
+            return "json"
+        elif (in_format == "auto" and in_path.endswith(".bgraph")) \
+                or in_format == "binary":
+            return "binary"
         elif (in_format == "auto" and in_path.endswith("graph")) \
                 or in_format == "graph":
-            return Graph.read_graph_graph(in_path)
+            return "graph"
         else:
             raise Exception("Unknown format " + in_format + " or format not "
                                                             "detected.")
 
     @classmethod
-    def read_graph_graph(cls, in_path):
+    def read_graph_binary(cls, in_path, compact=False):
         """
-        Read a graph from a .graph file.
+        Read a graph from a file in the binary graph format. The file is
+        memory-mapped, a CompactGraph uses the mapped columns without
+        copying them.
 
         :param in_path: The input path.
+        :param compact: Read the graph as a CompactGraph.
         :return: The parsed graph.
         """
-        infile = open(in_path, "r")
-        vertices = []
-        edges = []
+        result = CompactGraph.read_binary(in_path)
+        if compact:
+            return result
+        return result.to_graph()
+
+    @classmethod
+    def read_graph_header(cls, in_path):
+        """
+        Read only the header of a .graph file (or a binary graph file), without
+        parsing the vertices and edges.
+
+        :param in_path: The input path.
+        :return: A dict of the author, vertex_count and edge_count.
+        """
+        if Graph.detect_format(in_path) == "binary":
+            with open_file(in_path, "rb") as infile:
+                data = infile.read(BINARY_HEADER.size)
+                if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+                    raise Exception("Not a binary graph: " + in_path)
+                _, vertex_count, _, edge_count, label_count, _, \
+                    author_index = BINARY_HEADER.unpack(data)
+                author = None
+                if author_index >= 0:
+                    # The author is the label at author_index, read only its
+                    # offsets and its data.
+                    infile.seek(BINARY_HEADER.size + 8 * author_index)
+                    start, end = struct.unpack("<2q", infile.read(16))
+                    infile.seek(BINARY_HEADER.size + 8 * (label_count + 1) +
+                                start)
+                    author = str(infile.read(end - start), "utf-8")
+            return {"author": author, "vertex_count": vertex_count,
+                    "edge_count": edge_count}
+        with open_file(in_path, "r") as infile:
+            header = Graph._read_graph_header(infile)
+        if header is None:
+            raise Exception("Incomplete header: " + in_path)
+        return {"author": header["author"],
+                "vertex_count": int(header["vertex_count"]),
+                "edge_count": int(header["edge_count"])}
+
+    @staticmethod
+    def _read_graph_header(infile):
+        """
+        Read the header of a .graph file up to (and including) the empty line
+        that ends it.
+
+        :param infile: The input file.
+        :return: A dict of the author, vertex_count, edge_count (as strings)
+        and edges_labeled or None if the file ends within the header.
+        """
         author = None
         vertex_count = None
         edge_count = None
         edges_labeled = None
-        line: str = infile.readline()
-        state = 1
-        while line:
+        for line in infile:
             line = line.rstrip()
-            if state == 1:
-                # Header
-                if line.startswith("//"):
-                    pass
-                elif line.startswith("AUTHOR:"):
-                    author = line[7:]
-                elif line.startswith("#nodes;"):
-                    vertex_count = line.split(";")[1]
-                elif line.startswith("#edges;"):
-                    edge_count = line.split(";")[1]
-                elif line.startswith("Nodes labelled;"):
-                    if not bool(line.split(";")[1]):
-                        raise Exception("Unlabelled nodes are not supported")
-                elif line.startswith("Edges labelled;"):
-                    edges_labeled = not (line.split(";")[1] == "False")
-                elif line.startswith("Directed graph"):
-                    pass
-                elif line == "":
-                    state = 2
-                else:
-                    raise Exception("Unrecognized line: " + line)
-            if state == 2:
+            if line.startswith("//"):
+                pass
+            elif line.startswith("AUTHOR:"):
+                author = line[7:].lstrip()
+            elif line.startswith("#nodes;"):
+                vertex_count = line.split(";")[1]
+            elif line.startswith("#edges;"):
+                edge_count = line.split(";")[1]
+            elif line.startswith("Nodes labelled;"):
+                if not bool(line.split(";")[1]):
+                    raise Exception("Unlabelled nodes are not supported")
+            elif line.startswith("Edges labelled;"):
+                edges_labeled = not (line.split(";")[1] == "False")
+            elif line.startswith("Directed graph"):
+                pass
+            elif line == "":
                 # Validify header
                 assert vertex_count, "Vertex count not set"
                 assert edge_count, "Edge count not set"
-                state = 3
-            elif state == 3:
-                # Vertices
-                if line == "":
-                    state = 4
-                else:
-                    data = line.split(";")
-                    if len(data) != 2:
+                return {"author": author, "vertex_count": vertex_count,
+                        "edge_count": edge_count,
+                        "edges_labeled": edges_labeled}
+            else:
+                raise Exception("Unrecognized line: " + line)
+        return None
+
+    @classmethod
+    def read_graph_graph(cls, in_path, compact=False, block_size=None):
+        """
+        Read a graph from a .graph file. The vertex and edge sections are read
+        in blocks and split in bulk, the vertex and edge counts of the header
+        are used to preallocate the lists (up to PREALLOCATE_MAX).
+        A CompactGraph is filled block by block, without lists of all
+        vertices and edges.
+
+        :param in_path: The input path.
+        :param compact: Read the graph as a CompactGraph.
+        :param block_size: The number of characters read at once (default:
+        4M, or 64K for a CompactGraph).
+        :return: The parsed graph.
+        """
+        with open_file(in_path, "r") as infile:
+            return Graph._read_graph_file(infile, compact, block_size)
+
+    @staticmethod
+    def _read_graph_file(infile, compact=False, block_size=None):
+        """
+        Read a graph from an open .graph file.
+
+        :param infile: The (text mode) input file.
+        :param compact: Read the graph as a CompactGraph.
+        :param block_size: The number of characters read at once (see
+        read_graph_graph).
+        :return: The parsed graph.
+        """
+        header = Graph._read_graph_header(infile)
+        if header is None:
+            if compact:
+                return CompactGraph()
+            return Graph()
+        if block_size is None:
+            # The parsed tuples of a block are the largest temporary data of
+            # a compact read, so its blocks are small.
+            block_size = 1 << 16 if compact else 1 << 22
+        vertex_count = int(header["vertex_count"]) \
+            if header["vertex_count"].isdigit() else 0
+        edge_count = int(header["edge_count"]) \
+            if header["edge_count"].isdigit() else 0
+        # The parsed tuples cannot form reference cycles. Pausing the garbage
+        # collector avoids repeated collections while they are allocated.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            if compact:
+                result = CompactGraph()
+                result.author = header["author"]
+                for is_vertices, parsed in Graph._iter_graph_sections(
+                        infile, header["edges_labeled"], block_size):
+                    if is_vertices:
+                        for vertex in parsed:
+                            result.add_vertex(vertex[0], vertex[1])
+                    else:
+                        for edge in parsed:
+                            result.add_edge(edge[0], edge[1], edge[2])
+                return result
+            vertices, edges = Graph._read_graph_sections(
+                infile, vertex_count, edge_count, header["edges_labeled"],
+                block_size)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return Graph(vertices, edges)
+
+    @staticmethod
+    def _read_graph_sections(infile, vertex_count: int, edge_count: int,
+                             edges_labeled, block_size: int):
+        """
+        Read the vertex and edge sections of a .graph file in blocks.
+
+        :param infile: The input file, positioned after the header.
+        :param vertex_count: The expected number of vertices.
+        :param edge_count: The expected number of edges.
+        :param edges_labeled: Whether the edges are labeled.
+        :param block_size: The number of characters read at once.
+        :return: A tuple of the vertex and edge lists.
+        """
+        # The lists grow beyond the preallocated entries if necessary.
+        vertices = [None] * min(vertex_count, PREALLOCATE_MAX)
+        edges = [None] * min(edge_count, PREALLOCATE_MAX)
+        vertex_position = 0
+        edge_position = 0
+        for is_vertices, parsed in Graph._iter_graph_sections(
+                infile, edges_labeled, block_size):
+            if is_vertices:
+                vertices[vertex_position:vertex_position + len(parsed)] = \
+                    parsed
+                vertex_position += len(parsed)
+            else:
+                edges[edge_position:edge_position + len(parsed)] = parsed
+                edge_position += len(parsed)
+        # The header counts may be wrong, drop unused preallocated entries.
+        del vertices[vertex_position:]
+        del edges[edge_position:]
+        return vertices, edges
+
+    @staticmethod
+    def _iter_graph_sections(infile, edges_labeled, block_size: int,
+                             vertices_only=False, skip_vertices=False):
+        """
+        Parse the vertex and edge sections of a .graph file in blocks.
+
+        :param infile: The input file, positioned after the header.
+        :param edges_labeled: Whether the edges are labeled.
+        :param block_size: The number of characters read at once.
+        :param vertices_only: Stop at the end of the vertex section.
+        :param skip_vertices: Do not parse the vertex section.
+        :return: An iterator of (True, vertex list) for the vertex section and
+        (False, edge list) for the edge section, one per block.
+        """
+        edge_fields = 3 if edges_labeled else 2
+        in_vertices = True
+        rest = ""
+        while True:
+            block = infile.read(block_size)
+            lines = (rest + block).split("\n")
+            # The last line may be incomplete, unless the file ends here.
+            rest = lines.pop() if block else ""
+            if not block and lines == [""]:
+                lines = []
+            lines = [line.rstrip() for line in lines]
+            start = 0
+            if in_vertices:
+                try:
+                    end = lines.index("")
+                except ValueError:
+                    end = len(lines)
+                if not skip_vertices:
+                    parsed = [tuple(line.split(";")) for line in lines[:end]]
+                    if any(len(vertex) != 2 for vertex in parsed):
+                        line = next(line for line, vertex in
+                                    zip(lines, parsed) if len(vertex) != 2)
                         raise Exception("Failed to parse vertex: " + line)
-                    vertices += [(data[0], data[1])]
-            elif state == 4:
-                # Edges
-                data = line.split(";")
-                if (edges_labeled and len(data) != 3) or\
-                        (not edges_labeled and len(data) != 2):
+                    yield True, parsed
+                if end < len(lines):
+                    in_vertices = False
+                    start = end + 1
+                    if vertices_only:
+                        return
+            if not in_vertices:
+                parsed = [tuple(line.split(";")) for line in lines[start:]]
+                if any(len(edge) != edge_fields for edge in parsed):
+                    line = next(line for line, edge in
+                                zip(lines[start:], parsed)
+                                if len(edge) != edge_fields)
                     raise Exception("Failed to parse edge: " + line)
-                else:
-                    edges += [(data[0], data[1],
-                               data[2] if edges_labeled else "")]
-            line = infile.readline()
-        infile.close()
-        return Graph(vertices, edges)
+                if not edges_labeled:
+                    parsed = [edge + ("",) for edge in parsed]
+                yield False, parsed
+            if not block:
+                break
 
     @classmethod
-    def read_graph_json(cls, inpath):
+    def read_graph_json(cls, inpath, compact=False):
         """
         Read a graph from a file in JSON format. This lists of vertices and edges
         as tuples. Vertices are encoded as tuples of (id, label) and edges as
         tuples of (source_id, target_id, label).
 
         :param inpath: The JSON file input path.
+        :param compact: Read the graph as a CompactGraph.
         :return: A graph as tuple of vertex- and edge-list.
         """
-        file = open(inpath, "r")
+        file = open_file(inpath, "r")
         parsed = json.load(file)
         file.close()
-        compound = parsed["PC_Compounds"][0]["atoms"]
-        bonds = parsed["PC_Compounds"][0]["bonds"]
-        nr_of_atoms = len(compound["aid"])
+        return Graph.from_compound_json(parsed["PC_Compounds"][0], compact)
+
+    @classmethod
+    def read_graphs_json(cls, inpath, chunk_size=1 << 20, compact=False):
+        """
+        Read all compounds from a file in JSON format, one at a time.
+        Only the compound currently being parsed is kept in memory, so this
+        can be used for bulk exports with many compounds per file.
+
+        :param inpath: The JSON file input path.
+        :param chunk_size: The number of characters read at once.
+        :param compact: Read the graphs as CompactGraphs.
+        :return: A generator of (compound_id, graph) tuples.
+        """
+        with open_file(inpath, "r") as file:
+            index = 0
+            for compound in iter_json_array(file, "PC_Compounds", chunk_size):
+                try:
+                    compound_id = str(compound["id"]["id"]["cid"])
+                except (KeyError, TypeError):
+                    compound_id = str(index)
+                index += 1
+                yield compound_id, Graph.from_compound_json(compound,
+                                                            compact)
+
+    @classmethod
+    def from_compound_json(cls, compound: dict, compact=False):
+        """
+        Create a graph from a single parsed compound of a PubChem JSON file.
+
+        :param compound: The compound (an element of PC_Compounds).
+        :param compact: Create a CompactGraph.
+        :return: The graph.
+        """
+        atoms = compound["atoms"]
+        bonds = compound.get("bonds", {"aid1": [], "aid2": [], "order": []})
+        nr_of_atoms = len(atoms["aid"])
         nr_of_bonds = len(bonds["aid1"])
+        if compact:
+            result = CompactGraph()
+            for atom in range(nr_of_atoms):
+                result.add_vertex(str(atoms["aid"][atom]),
+                                  str(atoms["element"][atom]))
+            for bond in range(nr_of_bonds):
+                result.add_edge(str(bonds["aid1"][bond]),
+                                str(bonds["aid2"][bond]),
+                                str(bonds["order"][bond]))
+            return result
         vertices = []
         edges = []
         for atom in range(nr_of_atoms):
-            atom_type = str(compound["element"][atom])
-            atom_id = str(compound["aid"][atom])
+            atom_type = str(atoms["element"][atom])
+            atom_id = str(atoms["aid"][atom])
             vertices += [(atom_id, atom_type)]
         for bond in range(nr_of_bonds):
             source_id = str(bonds["aid1"][bond])
@@ -366,82 +1086,3646 @@ class Graph:
         return Graph(vertices, edges)
 
 
-def json2graph(inpath: str, outpath: str, informat: str, author=None,
-               preprocess = None):
-    print("Converting ", inpath, "to", outpath)
-    graph = Graph.read_graph(inpath, informat)
-    graph.preprocessing(preprocess).write(outpath, author)
+class PreprocessingPlan:
+    """
+    A plan running a list of preprocessing steps in one pass over the
+    vertices per step and one pass over the edges. Removed vertices are only
+    marked, so the vertex and edge lists are filtered once at the end instead
+    of after every step.
+    Steps that only look at a vertex itself (REMOVE_H_ALL, GET_CONSENSUS)
+    are merged into a single pass over the labels. Steps that look at the
+    neighbors of a vertex (REMOVE_H, COMPRESS_CH3) see the state before the
+    step and get a pass of their own. With NumPy and at least
+    VECTORIZE_MIN_VERTICES vertices these passes run the kernels on the
+    arrays of the graph (see Graph.get_arrays), which are built once for the
+    whole plan. Otherwise the neighbors are indexed by vertex position at the
+    first such pass, skipping the edges of vertices removed before.
+    """
 
+    LOCAL_STEPS = (Preprocessing.REMOVE_H_ALL, Preprocessing.GET_CONSENSUS)
 
-def print_banner():
-    """
-    Print the json2graph banner.
+    def __init__(self, step_names: list):
+        """
+        Create a new plan from a list of step names.
 
-    :return: Nothing.
+        :param step_names: The steps (by name).
+        """
+        self.steps = [Preprocessing.get(name) for name in step_names]
+        self.passes = []
+        for step in self.steps:
+            if self.passes and step in PreprocessingPlan.LOCAL_STEPS and \
+                    self.passes[-1][0] in PreprocessingPlan.LOCAL_STEPS:
+                self.passes[-1] += [step]
+            else:
+                self.passes += [[step]]
+        self.uses_neighbors = any(
+            steps[0] not in PreprocessingPlan.LOCAL_STEPS
+            for steps in self.passes)
+
+    def run(self, graph: Graph, profiler=None):
+        """
+        Run the plan on a graph. The result is the same as running the steps
+        one after another. The graph is not changed.
+
+        :param graph: The graph.
+        :param profiler: A Profiler recording every step (optional). The
+        counts are those of the vertices and edges not removed yet.
+        :return: The graph after preprocessing.
+        """
+        vertices = graph.vertices
+        # Without neighbor steps, the arrays are only used if already built.
+        vectorized = numpy is not None and \
+            len(vertices) >= VECTORIZE_MIN_VERTICES and \
+            (self.uses_neighbors or graph._arrays is not None)
+        if self.uses_neighbors:
+            if vectorized:
+                unique = graph.get_arrays()["unique"]
+            else:
+                unique = len(set(map(operator.itemgetter(0), vertices))) \
+                    == len(vertices)
+            if not unique:
+                # Ambiguous vertex ids, run the steps one after another.
+                stage = Profiler.get_stage(profiler)
+                g = graph.shallow_copy()
+                for step in self.steps:
+                    with stage("preprocess." + step.value, g) as record:
+                        g = g.preprocess(step)
+                        Profiler.set_counts(record, "after", g)
+                return g
+        if vectorized:
+            return self._run_arrays(graph, profiler)
+        return self._run_lists(graph, profiler)
+
+    def _run_lists(self, graph: Graph, profiler=None):
+        """
+        Run the plan on the vertex and edge lists of a graph.
+
+        :param graph: The graph.
+        :param profiler: A Profiler recording every step (optional).
+        :return: The graph after preprocessing.
+        """
+        vertices = graph.vertices
+        labels = [v[1] for v in vertices]
+        alive = [True] * len(vertices)
+        adjacency = None
+        filtered = False
+
+        def get_adjacency():
+            id_position = {v[0]: i for i, v in enumerate(vertices)}
+            result = [[] for _ in vertices]
+            for source, target, label in graph.edges:
+                s = id_position.get(source)
+                t = id_position.get(target)
+                if s is None or t is None or not alive[s] or not alive[t]:
+                    continue
+                result[s].append((t, label))
+                if s != t:
+                    result[t].append((s, label))
+            return result
+
+        def neighbors(position):
+            for n, label in adjacency[position]:
+                if alive[n]:
+                    yield n, label
+
+        def set_counts(record, when):
+            record["vertices_" + when] = alive.count(True)
+            if filtered:
+                vertex_ids = set(v[0] for v, a in zip(vertices, alive) if a)
+                record["edges_" + when] = sum(
+                    1 for e in graph.edges
+                    if e[0] in vertex_ids and e[1] in vertex_ids)
+            else:
+                record["edges_" + when] = len(graph.edges)
+
+        stage = Profiler.get_stage(profiler)
+        for steps in self.passes:
+            for step in steps:
+                with stage("preprocess." + step.value) as record:
+                    if profiler is not None:
+                        set_counts(record, "before")
+                    if step == Preprocessing.REMOVE_H_ALL:
+                        alive = [a and label != "1"
+                                 for a, label in zip(alive, labels)]
+                        filtered = True
+                    elif step == Preprocessing.GET_CONSENSUS:
+                        if len(vertices) >= VECTORIZE_MIN_VERTICES:
+                            consensus = iter(
+                                ConsensusEngine().consensus_labels(
+                                    list(itertools.compress(labels, alive))))
+                            labels = [next(consensus) if a else label
+                                      for a, label in zip(alive, labels)]
+                        else:
+                            labels = [Graph.consensus_label(label) if a
+                                      else label
+                                      for a, label in zip(alive, labels)]
+                    else:
+                        filtered = True
+                        if adjacency is None:
+                            adjacency = get_adjacency()
+                        self._run_neighbor_step(step, labels, alive,
+                                                neighbors)
+                    if profiler is not None:
+                        set_counts(record, "after")
+        new_vertices = [v if labels[i] is v[1] else (v[0], labels[i])
+                        for i, v in enumerate(vertices) if alive[i]]
+        if not filtered:
+            return Graph(new_vertices, graph.edges)
+        vertex_ids = set(map(operator.itemgetter(0), new_vertices))
+        return Graph(new_vertices,
+                     [e for e in graph.edges
+                      if e[0] in vertex_ids and e[1] in vertex_ids])
+
+    @staticmethod
+    def _run_neighbor_step(step: Preprocessing, labels: list, alive: list,
+                           neighbors):
+        """
+        Run REMOVE_H or COMPRESS_CH3 on the labels and the mask of the
+        vertices not removed yet, both are changed in place.
+
+        :param step: The step.
+        :param labels: The labels by vertex position.
+        :param alive: The mask of the vertices not removed yet.
+        :param neighbors: A function yielding the (position, edge_label) of
+        the neighbors of a position that are not removed yet.
+        :return: Nothing.
+        """
+        to_remove = set()
+        if step == Preprocessing.REMOVE_H:
+            has_multibond = dict()
+            for i in range(len(labels)):
+                if not alive[i] or labels[i] != "1":
+                    continue
+                keep = False
+                for n, _ in neighbors(i):
+                    if n not in has_multibond:
+                        has_multibond[n] = any(
+                            label != "1" for _, label in neighbors(n))
+                    if has_multibond[n]:
+                        keep = True
+                        break
+                if not keep:
+                    to_remove.add(i)
+        elif step == Preprocessing.COMPRESS_CH3:
+            for i in range(len(labels)):
+                if not alive[i] or labels[i] != "6":
+                    continue
+                hydrogens = [n for n, _ in neighbors(i) if labels[n] == "1"]
+                if len(hydrogens) == 3:
+                    to_remove.update(hydrogens)
+                    labels[i] = "CH3"
+        else:
+            raise Exception("Unknown step: " + str(step))
+        for i in to_remove:
+            alive[i] = False
+
+    def _run_arrays(self, graph: Graph, profiler=None):
+        """
+        Run the plan on the arrays of a graph with the NumPy kernels.
+
+        :param graph: The graph.
+        :param profiler: A Profiler recording every step (optional).
+        :return: The graph after preprocessing.
+        """
+        arrays = graph.get_arrays()
+        positions = arrays["positions"]
+        labels = arrays["labels"]
+        all_sources = arrays["sources"]
+        all_targets = arrays["targets"]
+        valid = (all_sources >= 0) & (all_targets >= 0)
+        sources = all_sources[valid]
+        targets = all_targets[valid]
+        multibond = arrays["multibond"][valid]
+        alive = numpy.ones(len(labels), dtype=bool)
+        is_h = None
+        filtered = False
+
+        def get_alive_ids():
+            if arrays["unique"]:
+                return alive
+            # Edges refer to the last vertex with an id, which is kept if
+            # any vertex with that id is kept.
+            alive_ids = numpy.zeros(len(labels), dtype=bool)
+            alive_ids[positions[alive]] = True
+            return alive_ids
+
+        def set_counts(record, when):
+            record["vertices_" + when] = int(alive.sum())
+            if filtered:
+                alive_ids = get_alive_ids()
+                record["edges_" + when] = int(
+                    (alive_ids[sources] & alive_ids[targets]).sum())
+            else:
+                record["edges_" + when] = len(all_sources)
+
+        stage = Profiler.get_stage(profiler)
+        for step in self.steps:
+            with stage("preprocess." + step.value) as record:
+                if profiler is not None:
+                    set_counts(record, "before")
+                if is_h is None:
+                    is_h = labels == "1"
+                if step == Preprocessing.REMOVE_H_ALL:
+                    alive &= ~is_h
+                    filtered = True
+                elif step == Preprocessing.GET_CONSENSUS:
+                    consensus = numpy.empty(int(alive.sum()), dtype=object)
+                    consensus[:] = ConsensusEngine().consensus_labels(
+                        labels[alive].tolist())
+                    labels = labels.copy()
+                    labels[alive] = consensus
+                    is_h = None
+                else:
+                    filtered = True
+                    alive_edges = alive[sources] & alive[targets]
+                    step_sources = sources[alive_edges]
+                    step_targets = targets[alive_edges]
+                    if step == Preprocessing.REMOVE_H:
+                        alive &= ~is_h | remove_h_kernel(
+                            len(labels), step_sources, step_targets,
+                            multibond[alive_edges])
+                    else:
+                        compressed, removed = compress_ch3_kernel(
+                            is_h, alive & (labels == "6"), step_sources,
+                            step_targets)
+                        if compressed.any():
+                            if labels is arrays["labels"]:
+                                labels = labels.copy()
+                            labels[compressed] = "CH3"
+                        alive &= ~removed
+                if profiler is not None:
+                    set_counts(record, "after")
+        keep = alive.tolist()
+        if labels is arrays["labels"]:
+            new_vertices = list(itertools.compress(graph.vertices, keep))
+        else:
+            new_vertices = [v if label is v[1] else (v[0], label)
+                            for v, label in itertools.compress(
+                                zip(graph.vertices, labels.tolist()), keep)]
+        result = Graph(new_vertices, graph.edges)
+        if not filtered:
+            result._arrays = dict(arrays, labels=labels)
+            return result
+        alive_ids = get_alive_ids()
+        keep_edges = numpy.zeros(len(all_sources), dtype=bool)
+        keep_edges[valid] = alive_ids[sources] & alive_ids[targets]
+        result.edges = list(itertools.compress(graph.edges,
+                                               keep_edges.tolist()))
+        if arrays["unique"]:
+            # Only edges between kept vertices remain, renumber them.
+            new_position = numpy.cumsum(alive) - 1
+            result._arrays = {
+                "positions": numpy.arange(len(new_vertices)),
+                "unique": True, "labels": labels[alive],
+                "sources": new_position[all_sources[keep_edges]],
+                "targets": new_position[all_targets[keep_edges]],
+                "multibond": arrays["multibond"][keep_edges]}
+        return result
+
+
+class GraphView:
+    """
+    A lazy view of a subgraph of a base graph. The view stores a vertex mask,
+    an edge mask and a map of changed vertex labels (by vertex position)
+    instead of lists of vertices and edges. Preprocessing a view returns a
+    new view of the same base graph, so a chain of steps does not copy the
+    graph at every step. Only write and materialize build the vertices and
+    edges. The base graph is never changed.
     """
-    if "TERM" in os.environ and "color" in os.environ["TERM"]:
-        print(r"""[38;5;93m    [38;5;99m   _[38;5;63m     [38;5;69m    [38;5;33m    [38;5;39m    _[38;5;38m__  [38;5;44m    [38;5;43m     [38;5;49m    [38;5;48m    [38;5;84m     [38;5;83m  __[38;5;119m
-[38;5;93m   [38;5;99m   (_[38;5;63m)___[38;5;69m____[38;5;33m_  __[38;5;39m__ |[38;5;38m__ \[38;5;44m ____[38;5;43m ___[38;5;49m_____[38;5;48m__ _[38;5;84m____[38;5;83m  / /[38;5;119m
-[38;5;93m   [38;5;99m  / [38;5;63m/ ___[38;5;69m/ __[38;5;33m \/ [38;5;39m__ \_[38;5;38m_/ /[38;5;44m/ __[38;5;43m `/ _[38;5;49m__/ [38;5;48m__ `[38;5;84m/ __ [38;5;83m\/ _[38;5;119m_ \
-[38;5;93m   [38;5;99m / ([38;5;63m__  [38;5;69m) /_/[38;5;33m / /[38;5;39m / /[38;5;38m __//[38;5;44m /_/[38;5;43m / /[38;5;49m  / /[38;5;48m_/ /[38;5;84m /_/[38;5;83m / / [38;5;119m/ /
-[38;5;93m _[38;5;99m_/ /[38;5;63m____/[38;5;69m\___[38;5;33m_/_/[38;5;39m /_/_[38;5;38m___/[38;5;44m\__, [38;5;43m/_/ [38;5;49m  \_[38;5;48m_,_/ [38;5;84m.___[38;5;83m/_/ [38;5;119m/_/
-[38;5;93m/_[38;5;99m__/ [38;5;63m    [38;5;69m     [38;5;33m    [38;5;39m    [38;5;38m    /[38;5;44m____[38;5;43m/   [38;5;49m     [38;5;48m  /_[38;5;84m/   [38;5;83m     [38;5;119m
 
-[0m""")
-    else:
-        print(r"""       _                 ___                          __
-      (_)________  ____ |__ \ ____ __________ _____  / /_
-     / / ___/ __ \/ __ \__/ // __ `/ ___/ __ `/ __ \/ __ \
-    / (__  ) /_/ / / / / __// /_/ / /  / /_/ / /_/ / / / /
- __/ /____/\____/_/ /_/____/\__, /_/   \__,_/ .___/_/ /_/
-/___/                      /____/          /_/""")
+    def __init__(self, base: Graph, vertex_mask=None, edge_mask=None,
+                 label_overrides=None):
+        """
+        Create a new view of a graph.
 
+        :param base: The base graph.
+        :param vertex_mask: A bytearray with a byte of 1 for every visible
+        vertex and 0 for every hidden vertex of the base graph (optional,
+        default: all vertices).
+        :param edge_mask: A bytearray like vertex_mask for the edges of the
+        base graph (optional, default: all edges).
+        :param label_overrides: A dict of vertex positions to new labels
+        (optional).
+        """
+        self.base = base
+        self.vertex_mask = vertex_mask if vertex_mask is not None \
+            else bytearray(b"\x01") * len(base.vertices)
+        self.edge_mask = edge_mask if edge_mask is not None \
+            else bytearray(b"\x01") * len(base.edges)
+        self.label_overrides = label_overrides \
+            if label_overrides is not None else dict()
+        self._index = None
 
-if __name__ == '__main__':
-    ap = argparse.ArgumentParser()
-    ap.add_argument("-f", "--force", help="Overwrite existing files.",
-                    action="store_true")
-    ap_out_selection = ap.add_mutually_exclusive_group(required=True)
-    ap_out_selection.add_argument("-o", "--output", help="Output file")
-    ap_out_selection.add_argument("-O", "--outpath", help="Output path")
-    ap.add_argument("-l", "--format", help="Input format (json, graph, auto)",
-                    default="auto")
-    ap.add_argument("-a", "--author", help="Author", default="Egal.",
-                    required=False)
-    ap.add_argument("-A", "--no-author", help="Do not write the author.",
-                    action="store_true")
-    ap.add_argument("-P", "--preprocess", nargs="+", metavar="STEP",
-                    help="Run a preprocessing step ("
-                         + Preprocessing.names() + ")")
-    ap.add_argument("input", metavar="INFILE", nargs="+", help="Input file(s)")
-    print_banner()
-    args = ap.parse_args()
-    new_author = args.author
-    if args.no_author:
-        new_author = None
-    infiles = args.input
-    if len(infiles) > 1 or args.outpath:
-        if args.output:
-            sys.stderr.write("Please use -O when converting multiple input "
-                             "files\n")
-            exit(1)
-        assert args.outpath, "Output path not set. [-O]"
-        outpath = args.outpath
-        if not os.path.exists(outpath):
-            sys.stderr.write("Warning: Output path does not exist\n")
-            os.mkdir(outpath)
-        for infile in infiles:
-            next_outfile = os.path.join(outpath,
-                                        os.path.basename(infile) + ".graph")
-            if os.path.exists(next_outfile) and not args.force:
-                sys.stderr.write("Error: File already exists: " + next_outfile
-                                 + "\n")
-                continue
-            json2graph(infile, next_outfile, args.format,
-                       new_author, args.preprocess)
-    elif len(infiles) == 0:
-        sys.stderr.write("Error: No input files.\n")
-    elif len(infiles) == 1:
-        assert args.output, "No output file given. [-o]"
-        json2graph(infiles[0], args.output, args.format, new_author,
-                   args.preprocess)
+    @property
+    def vertex_count(self):
+        """
+        The number of visible vertices.
+        """
+        return len(self.vertex_mask) - self.vertex_mask.count(0)
+
+    @property
+    def edge_count(self):
+        """
+        The number of visible edges.
+        """
+        return len(self.edge_mask) - self.edge_mask.count(0)
+
+    def _derive(self, vertex_mask, edge_mask, label_overrides):
+        """
+        Create a new view of the same base graph sharing the index.
+
+        :param vertex_mask: The vertex mask.
+        :param edge_mask: The edge mask.
+        :param label_overrides: The changed labels.
+        :return: The view.
+        """
+        result = GraphView(self.base, vertex_mask, edge_mask, label_overrides)
+        result._index = self._index
+        return result
+
+    def get_index(self):
+        """
+        Get the index of the base graph. It is built on first use and shared
+        by all views derived from this view. "sources" and "targets" are the
+        positions of the vertices of every edge (-1 for unknown vertices).
+        Large graphs are processed with NumPy if available ("vectorized"),
+        then "valid" marks the edges between known vertices, "multibond" the
+        edges with a label other than "1" and "labels" holds the vertex
+        labels. Otherwise "offsets" and "incident" list the incident edges of
+        every vertex and "dangling" the edges to unknown vertices.
+
+        :return: The index as dict or None if the vertex ids of the base graph
+        are not unique.
+        """
+        if self._index is None:
+            vertices = self.base.vertices
+            edges = self.base.edges
+            if numpy is not None and len(vertices) >= VECTORIZE_MIN_VERTICES:
+                # The arrays of the base graph, shared with its vectorized
+                # steps.
+                arrays = self.base.get_arrays()
+                if not arrays["unique"]:
+                    self._index = dict()
+                    return None
+                index = {key: arrays[key] for key in
+                         ("sources", "targets", "multibond", "labels")}
+                index["vectorized"] = True
+                index["valid"] = (index["sources"] >= 0) & \
+                    (index["targets"] >= 0)
+                self._index = index
+                return index
+            position = {v[0]: i for i, v in enumerate(vertices)}
+            if len(position) != len(vertices):
+                self._index = dict()
+                return None
+            get = position.get
+            index = {"vectorized": False}
+            sources = array("i", [get(e[0], -1) for e in edges])
+            targets = array("i", [get(e[1], -1) for e in edges])
+            del position
+            counts = [0] * (len(vertices) + 1)
+            dangling = []
+            for e, (s, t) in enumerate(zip(sources, targets)):
+                if s < 0 or t < 0:
+                    dangling += [e]
+                    continue
+                counts[s + 1] += 1
+                if s != t:
+                    counts[t + 1] += 1
+            offsets = array("q", itertools.accumulate(counts))
+            incident = array("i", [0]) * offsets[-1]
+            fill = offsets[:-1]
+            for e, (s, t) in enumerate(zip(sources, targets)):
+                if s < 0 or t < 0:
+                    continue
+                incident[fill[s]] = e
+                fill[s] += 1
+                if s != t:
+                    incident[fill[t]] = e
+                    fill[t] += 1
+            index.update(sources=sources, targets=targets, offsets=offsets,
+                         incident=incident, dangling=dangling)
+            self._index = index
+        return self._index or None
+
+    def get_label(self, position: int):
+        """
+        Get the label of a vertex.
+
+        :param position: The position of the vertex in the base graph.
+        :return: The label.
+        """
+        label = self.label_overrides.get(position)
+        return label if label is not None \
+            else self.base.vertices[position][1]
+
+    def get_positions(self):
+        """
+        Get the positions of the visible vertices in the base graph.
+
+        :return: A list of positions.
+        """
+        return list(itertools.compress(range(len(self.vertex_mask)),
+                                       self.vertex_mask))
+
+    def get_labels(self):
+        """
+        Get the labels of all vertices of the base graph, including the hidden
+        vertices.
+
+        :return: A list of labels by vertex position.
+        """
+        labels = [v[1] for v in self.base.vertices]
+        for i, label in self.label_overrides.items():
+            labels[i] = label
+        return labels
+
+    def get_neighbors_of(self, position: int):
+        """
+        Get the visible neighbors of a vertex. Requires unique vertex ids and
+        an index that is not vectorized.
+
+        :param position: The position of the vertex in the base graph.
+        :return: A list of (neighbor position, edge label).
+        """
+        return self._get_neighbor_function()(position)
+
+    def _get_neighbor_function(self):
+        """
+        Get a function returning the visible neighbors of a vertex, like
+        get_neighbors_of, with the index looked up only once.
+
+        :return: The function.
+        """
+        index = self.get_index()
+        sources = index["sources"]
+        targets = index["targets"]
+        offsets = index["offsets"]
+        incident = index["incident"]
+        edges = self.base.edges
+        vertex_mask = self.vertex_mask
+        edge_mask = self.edge_mask
+
+        def neighbors(position):
+            result = []
+            for e in incident[offsets[position]:offsets[position + 1]]:
+                if edge_mask[e]:
+                    n = targets[e] if sources[e] == position else sources[e]
+                    if vertex_mask[n]:
+                        result += [(n, edges[e][2])]
+            return result
+
+        return neighbors
+
+    def _get_arrays(self):
+        """
+        Get NumPy arrays of the current state. Requires unique vertex ids and
+        a vectorized index.
+
+        :return: A tuple of (visible vertices, labels, sources, targets,
+        multibond) with the last three for the visible edges between visible
+        vertices only.
+        """
+        index = self.get_index()
+        visible = get_mask_array(self.vertex_mask)
+        labels = index["labels"]
+        if self.label_overrides:
+            labels = labels.copy()
+            labels[numpy.fromiter(self.label_overrides, dtype=numpy.intp,
+                                  count=len(self.label_overrides))] = \
+                list(self.label_overrides.values())
+        edges = get_mask_array(self.edge_mask) & index["valid"]
+        edges[edges] = visible[index["sources"][edges]] & \
+            visible[index["targets"][edges]]
+        return visible, labels, index["sources"][edges], \
+            index["targets"][edges], index["multibond"][edges]
+
+    def iter_vertices(self):
+        """
+        Iterate over the visible vertices.
+
+        :return: An iterator of (id, label) tuples.
+        """
+        overrides = self.label_overrides
+        for i, v in zip(self.get_positions(),
+                        itertools.compress(self.base.vertices,
+                                           self.vertex_mask)):
+            label = overrides.get(i)
+            yield v if label is None else (v[0], label)
+
+    def iter_edges(self):
+        """
+        Iterate over the visible edges.
+
+        :return: An iterator of (source_id, target_id, label) tuples.
+        """
+        return itertools.compress(self.base.edges, self.edge_mask)
+
+    def materialize(self):
+        """
+        Build the graph shown by this view.
+
+        :return: The graph.
+        """
+        return Graph(list(self.iter_vertices()), list(self.iter_edges()))
+
+    def remove_vertices(self, positions):
+        """
+        Hide vertices and their edges. Like Graph.induced_subgraph, edges to
+        unknown vertices are hidden as well. Requires unique vertex ids.
+
+        :param positions: The positions of the vertices in the base graph.
+        :return: The view of the subgraph.
+        """
+        index = self.get_index()
+        vertex_mask = bytearray(self.vertex_mask)
+        edge_mask = bytearray(self.edge_mask)
+        if index["vectorized"]:
+            if not isinstance(positions, numpy.ndarray):
+                positions = numpy.fromiter(positions, dtype=numpy.intp)
+            visible = get_mask_array(vertex_mask)
+            visible[positions] = False
+            valid = index["valid"]
+            keep = valid.copy()
+            keep[valid] = visible[index["sources"][valid]] & \
+                visible[index["targets"][valid]]
+            get_mask_array(edge_mask)[~keep] = False
+            return self._derive(vertex_mask, edge_mask, self.label_overrides)
+        offsets = index["offsets"]
+        incident = index["incident"]
+        for e in index["dangling"]:
+            edge_mask[e] = 0
+        for i in positions:
+            vertex_mask[i] = 0
+            for k in range(offsets[i], offsets[i + 1]):
+                edge_mask[incident[k]] = 0
+        return self._derive(vertex_mask, edge_mask, self.label_overrides)
+
+    def filter_vertices(self, vertex_filter):
+        """
+        Apply a filter to the visible vertices, see Graph.filter_vertices.
+        Requires unique vertex ids.
+
+        :param vertex_filter: The vertex filter, called with (id, label).
+        :return: The view of the subgraph.
+        """
+        return self.remove_vertices(
+            [i for i, v in zip(self.get_positions(), self.iter_vertices())
+             if not vertex_filter(v)])
+
+    def remove_h(self, keep_multibonds=True):
+        """
+        Remove hydrogen atoms, see Preprocessing.REMOVE_H and REMOVE_H_ALL.
+        Requires unique vertex ids.
+
+        :param keep_multibonds: Keep hydrogen atoms with a neighbor with
+        multibonds (REMOVE_H).
+        :return: The view without these hydrogen atoms.
+        """
+        if self.get_index()["vectorized"]:
+            visible, labels, sources, targets, multibond = self._get_arrays()
+            remove = visible & (labels == "1")
+            if keep_multibonds:
+                remove &= ~remove_h_kernel(len(labels), sources, targets,
+                                           multibond)
+            return self.remove_vertices(numpy.flatnonzero(remove))
+        labels = self.get_labels()
+        hydrogens = [i for i in self.get_positions() if labels[i] == "1"]
+        if not keep_multibonds:
+            return self.remove_vertices(hydrogens)
+        neighbors = self._get_neighbor_function()
+        has_multibond = dict()
+        to_remove = []
+        for i in hydrogens:
+            for n, _ in neighbors(i):
+                if n not in has_multibond:
+                    has_multibond[n] = any(label != "1" for _, label in
+                                           neighbors(n))
+                if has_multibond[n]:
+                    break
+            else:
+                to_remove += [i]
+        return self.remove_vertices(to_remove)
+
+    def compress_ch3(self):
+        """
+        Find CH_3 subgraphs and replace them with a single vertex, see
+        Graph.compress_ch3. Requires unique vertex ids.
+
+        :return: The view with compressed CH_3 subgraphs.
+        """
+        overrides = dict(self.label_overrides)
+        if self.get_index()["vectorized"]:
+            visible, labels, sources, targets, _ = self._get_arrays()
+            compressed, removed = compress_ch3_kernel(
+                visible & (labels == "1"), visible & (labels == "6"),
+                sources, targets)
+            overrides.update(dict.fromkeys(
+                numpy.flatnonzero(compressed).tolist(), "CH3"))
+            to_remove = numpy.flatnonzero(removed)
+        else:
+            labels = self.get_labels()
+            neighbors = self._get_neighbor_function()
+            to_remove = set()
+            for i in self.get_positions():
+                if labels[i] != "6":
+                    continue
+                hydrogens = [n for n, _ in neighbors(i) if labels[n] == "1"]
+                if len(hydrogens) == 3:
+                    to_remove.update(hydrogens)
+                    overrides[i] = "CH3"
+        return self._derive(self.vertex_mask, self.edge_mask, overrides)\
+            .remove_vertices(to_remove)
+
+    def get_consesus(self):
+        """
+        Get the consensus of an aligned graph, see Graph.get_consesus.
+
+        :return: The view of the consensus graph.
+        """
+        positions = self.get_positions()
+        labels = self.get_labels()
+        labels = [labels[i] for i in positions]
+        if numpy is not None and len(labels) >= VECTORIZE_MIN_VERTICES:
+            labels = ConsensusEngine().consensus_labels(labels)
+        else:
+            labels = [Graph.consensus_label(label) for label in labels]
+        overrides = dict(self.label_overrides)
+        overrides.update(zip(positions, labels))
+        return self._derive(self.vertex_mask, self.edge_mask, overrides)
+
+    def preprocess(self, step: Preprocessing):
+        """
+        Run a preprocessing step, see Graph.preprocess. If the vertex ids of
+        the base graph are not unique, the step runs on the materialized
+        graph.
+
+        :param step: The step.
+        :return: The view of the processed graph.
+        """
+        if step == Preprocessing.GET_CONSENSUS:
+            return self.get_consesus()
+        if self.get_index() is None:
+            # Ambiguous vertex ids, the vertices cannot be told apart.
+            return GraphView(self.materialize().preprocess(step))
+        if step == Preprocessing.REMOVE_H:
+            return self.remove_h()
+        elif step == Preprocessing.REMOVE_H_ALL:
+            return self.remove_h(keep_multibonds=False)
+        elif step == Preprocessing.COMPRESS_CH3:
+            return self.compress_ch3()
+        else:
+            raise Exception("Unknown step: " + str(step))
+
+    def preprocessing(self, step_names: list, profiler=None):
+        """
+        Run preprocessing steps, see Graph.preprocessing.
+
+        :param step_names: The steps (by name)
+        :param profiler: A Profiler recording every step (optional).
+        :return: The view after preprocessing.
+        """
+        g = self
+        for step in step_names or []:
+            if profiler is None:
+                g = g.preprocess(Preprocessing.get(step))
+                continue
+            with profiler.stage("preprocess." + step, g) as record:
+                g = g.preprocess(Preprocessing.get(step))
+                Profiler.set_counts(record, "after", g)
+        return g
+
+    def write(self, outpath, author=None, out_format="graph"):
+        """
+        Writes the visible subgraph, see Graph.write.
+
+        :param outpath: The path of the output .graph file.
+        :param author: The value of the author field in the output file
+        (optional).
+        :param out_format: The output format (graph or binary).
+        """
+        if out_format == "binary":
+            compact = CompactGraph()
+            for vertex in self.iter_vertices():
+                compact.add_vertex(vertex[0], vertex[1])
+            for edge in self.iter_edges():
+                compact.add_edge(edge[0], edge[1], edge[2])
+            compact.write(outpath, author, out_format)
+            return
+        write_graph_text(outpath, self.iter_vertices(), self.iter_edges(),
+                         self.vertex_count, self.edge_count, author)
+
+
+def get_mask_array(mask: bytearray):
+    """
+    Get a NumPy view of a mask of GraphView. Writing to the view changes the
+    mask.
+
+    :param mask: The mask (a bytearray of 0 and 1).
+    :return: A boolean array.
+    """
+    if not mask:
+        return numpy.zeros(0, dtype=bool)
+    return numpy.frombuffer(mask, dtype=bool)
+
+
+class OutOfCoreGraph:
+    """
+    A .graph file processed without loading its edges. Only the vertices are
+    kept in memory, with a mask of the remaining vertices and their current
+    labels. The edge section is parsed once, in blocks, into a temporary
+    file of (source position, target position, label number) records. The
+    passes over the edges stream this file in blocks: two passes for
+    REMOVE_H and COMPRESS_CH3 (which look at the neighbors), none for
+    REMOVE_H_ALL and GET_CONSENSUS, one for counting and one for writing the
+    remaining edges. The memory use is bounded by the vertices plus a block.
+    The result is the same as the result of the steps on the parsed graph.
+    """
+
+    # A record of the temporary edge file: source, target, label (int32).
+    EDGE_RECORD = 3
+
+    def __init__(self, in_path: str, block_size=1 << 16):
+        """
+        Read the header and the vertices of a .graph file.
+
+        :param in_path: The input path.
+        :param block_size: The number of characters (of the input) or edges
+        (of the temporary file) read at once.
+        """
+        self.in_path = in_path
+        self.block_size = block_size
+        self.ids = []
+        self.labels = []
+        # Labels repeat, keep a single string per label.
+        interned = dict()
+        with open_file(in_path, "r") as infile:
+            header = Graph._read_graph_header(infile)
+            if header is None:
+                raise Exception("Incomplete header: " + in_path)
+            for _, parsed in Graph._iter_graph_sections(
+                    infile, header["edges_labeled"], block_size, True):
+                self.ids += [v[0] for v in parsed]
+                self.labels += [interned.setdefault(v[1], v[1])
+                                for v in parsed]
+        self.author = header["author"]
+        self.edges_labeled = header["edges_labeled"]
+        self._position = {vid: i for i, vid in enumerate(self.ids)}
+        if len(self._position) != len(self.ids):
+            raise Exception("Out-of-core processing requires unique vertex "
+                            "ids: " + in_path)
+        self.alive = bytearray(b"\x01") * len(self.ids)
+        # Whether vertices were filtered, the edges are the induced subgraph
+        # (without edges to unknown vertices) from then on.
+        self.filtered = False
+        self.edge_labels = []
+        self._edge_file = None
+        self._edge_total = 0
+        self._edge_count = None
+
+    @property
+    def vertex_count(self):
+        """
+        The number of remaining vertices.
+        """
+        return len(self.alive) - self.alive.count(0)
+
+    @property
+    def edge_count(self):
+        """
+        The number of remaining edges (counted in a pass over the edges).
+        """
+        if self._edge_count is None:
+            self._get_edge_file()
+            if not self.filtered:
+                self._edge_count = self._edge_total
+            else:
+                self._edge_count = sum(len(block[0]) for block in
+                                       self._iter_alive_edges())
+        return self._edge_count
+
+    def _iter_text_edges(self):
+        """
+        Stream the edges of the input file.
+
+        :return: An iterator of edge lists, one per block.
+        """
+        with open_file(self.in_path, "r") as infile:
+            Graph._read_graph_header(infile)
+            for _, parsed in Graph._iter_graph_sections(
+                    infile, self.edges_labeled, self.block_size,
+                    skip_vertices=True):
+                yield parsed
+
+    def _get_edge_file(self):
+        """
+        Get the temporary edge file, parsing the edges of the input file on
+        first use. Unknown vertices are stored as -1.
+
+        :return: The temporary file.
+        """
+        if self._edge_file is None:
+            get = self._position.get
+            label_index = dict()
+            edge_file = tempfile.TemporaryFile()
+            for edges in self._iter_text_edges():
+                for label in set(map(operator.itemgetter(2), edges))\
+                        .difference(label_index):
+                    label_index[label] = len(self.edge_labels)
+                    self.edge_labels += [label]
+                records = array("i", itertools.chain.from_iterable(zip(
+                    map(get, map(operator.itemgetter(0), edges),
+                        itertools.repeat(-1)),
+                    map(get, map(operator.itemgetter(1), edges),
+                        itertools.repeat(-1)),
+                    map(label_index.__getitem__,
+                        map(operator.itemgetter(2), edges)))))
+                records.tofile(edge_file)
+                self._edge_total += len(edges)
+            self._edge_file = edge_file
+        return self._edge_file
+
+    def _iter_alive_edges(self):
+        """
+        Stream the edges between remaining vertices from the temporary file
+        in blocks.
+
+        :return: An iterator of (sources, targets, labels), one per block,
+        with the positions of the vertices and the numbers of the labels of
+        the edges (as NumPy arrays if available, else as lists).
+        """
+        edge_file = self._get_edge_file()
+        edge_file.seek(0)
+        alive = self.alive
+        if numpy is not None:
+            alive = get_mask_array(alive)
+        remaining = self._edge_total
+        while remaining > 0:
+            count = min(self.block_size, remaining)
+            remaining -= count
+            if numpy is not None:
+                records = numpy.fromfile(
+                    edge_file, dtype=numpy.int32,
+                    count=count * OutOfCoreGraph.EDGE_RECORD)\
+                    .reshape(count, OutOfCoreGraph.EDGE_RECORD)
+                sources = records[:, 0].astype(numpy.intp)
+                targets = records[:, 1].astype(numpy.intp)
+                keep = (sources >= 0) & (targets >= 0)
+                keep[keep] = alive[sources[keep]] & alive[targets[keep]]
+                yield sources[keep], targets[keep], records[keep, 2]
+                continue
+            records = array("i")
+            records.fromfile(edge_file, count * OutOfCoreGraph.EDGE_RECORD)
+            sources = records[0::3]
+            targets = records[1::3]
+            keep = [s >= 0 and t >= 0 and alive[s] and alive[t]
+                    for s, t in zip(sources, targets)]
+            yield list(itertools.compress(sources, keep)), \
+                list(itertools.compress(targets, keep)), \
+                list(itertools.compress(records[2::3], keep))
+
+    def iter_vertices(self):
+        """
+        Iterate over the remaining vertices.
+
+        :return: An iterator of (id, label) tuples.
+        """
+        return itertools.compress(zip(self.ids, self.labels), self.alive)
+
+    def iter_edges(self):
+        """
+        Stream the remaining edges. Without filtered vertices the edges of
+        the input file are returned as they are.
+
+        :return: An iterator of (source_id, target_id, label) tuples.
+        """
+        if not self.filtered:
+            for edges in self._iter_text_edges():
+                yield from edges
+            return
+        ids = self.ids
+        edge_labels = self.edge_labels
+        for sources, targets, labels in self._iter_alive_edges():
+            if numpy is not None:
+                sources = sources.tolist()
+                targets = targets.tolist()
+                labels = labels.tolist()
+            yield from zip(map(ids.__getitem__, sources),
+                           map(ids.__getitem__, targets),
+                           map(edge_labels.__getitem__, labels))
+
+    def close(self):
+        """
+        Remove the temporary edge file.
+
+        :return: Nothing.
+        """
+        if self._edge_file is not None:
+            self._edge_file.close()
+            self._edge_file = None
+
+    def _remove(self, positions):
+        """
+        Remove vertices and (in the output) their edges.
+
+        :param positions: The positions of the vertices.
+        :return: Nothing.
+        """
+        for i in positions:
+            self.alive[i] = 0
+        self.filtered = True
+        self._edge_count = None
+
+    def _get_label_number(self, label: str):
+        """
+        Get the number of an edge label in the temporary edge file.
+
+        :param label: The label.
+        :return: The number or -1 if no edge has this label.
+        """
+        self._get_edge_file()
+        if label in self.edge_labels:
+            return self.edge_labels.index(label)
+        return -1
+
+    def _remove_h(self):
+        """
+        Run REMOVE_H, see Graph.preprocess.
+
+        :return: Nothing.
+        """
+        size = len(self.alive)
+        single = self._get_label_number("1")
+        if numpy is not None:
+            has_multibond = numpy.zeros(size, dtype=bool)
+            for sources, targets, labels in self._iter_alive_edges():
+                multibond = labels != single
+                has_multibond[sources[multibond]] = True
+                has_multibond[targets[multibond]] = True
+            neighbor_multibond = numpy.zeros(size, dtype=bool)
+            for sources, targets, _ in self._iter_alive_edges():
+                neighbor_multibond[sources[has_multibond[targets]]] = True
+                neighbor_multibond[targets[has_multibond[sources]]] = True
+            neighbor_multibond = neighbor_multibond.tolist()
+        else:
+            has_multibond = bytearray(size)
+            for sources, targets, labels in self._iter_alive_edges():
+                for s, t, label in zip(sources, targets, labels):
+                    if label != single:
+                        has_multibond[s] = has_multibond[t] = 1
+            neighbor_multibond = bytearray(size)
+            for sources, targets, _ in self._iter_alive_edges():
+                for s, t in zip(sources, targets):
+                    if has_multibond[t]:
+                        neighbor_multibond[s] = 1
+                    if has_multibond[s]:
+                        neighbor_multibond[t] = 1
+        self._remove([i for i, label in enumerate(self.labels)
+                      if self.alive[i] and label == "1"
+                      and not neighbor_multibond[i]])
+
+    def _compress_ch3(self):
+        """
+        Run COMPRESS_CH3, see Graph.preprocess.
+
+        :return: Nothing.
+        """
+        size = len(self.alive)
+        labels = self.labels
+        if numpy is not None:
+            is_h = numpy.array([label == "1" for label in labels],
+                               dtype=bool)
+            h_count = numpy.zeros(size)
+            for sources, targets, _ in self._iter_alive_edges():
+                not_loop = sources != targets
+                h_count += numpy.bincount(sources, weights=is_h[targets],
+                                          minlength=size)
+                h_count += numpy.bincount(targets[not_loop],
+                                          weights=is_h[sources[not_loop]],
+                                          minlength=size)
+            compressed = numpy.array([label == "6" for label in labels],
+                                     dtype=bool) & (h_count == 3)
+            del h_count
+            removed = numpy.zeros(size, dtype=bool)
+            for sources, targets, _ in self._iter_alive_edges():
+                removed[targets[compressed[sources]]] = True
+                removed[sources[compressed[targets]]] = True
+            compressed = numpy.flatnonzero(compressed).tolist()
+            to_remove = numpy.flatnonzero(removed & is_h).tolist()
+        else:
+            h_count = [0] * size
+            for sources, targets, _ in self._iter_alive_edges():
+                for s, t in zip(sources, targets):
+                    if labels[t] == "1":
+                        h_count[s] += 1
+                    if labels[s] == "1" and s != t:
+                        h_count[t] += 1
+            compressed = bytearray(size)
+            for i, label in enumerate(labels):
+                if label == "6" and h_count[i] == 3:
+                    compressed[i] = 1
+            del h_count
+            to_remove = set()
+            for sources, targets, _ in self._iter_alive_edges():
+                for s, t in zip(sources, targets):
+                    if compressed[s] and labels[t] == "1":
+                        to_remove.add(t)
+                    if compressed[t] and labels[s] == "1":
+                        to_remove.add(s)
+            compressed = itertools.compress(range(size), compressed)
+        for i in compressed:
+            labels[i] = "CH3"
+        self._remove(to_remove)
+
+    def preprocess(self, step: Preprocessing):
+        """
+        Run a preprocessing step, see Graph.preprocess.
+
+        :param step: The step.
+        :return: This graph.
+        """
+        alive = self.alive
+        labels = self.labels
+        if step == Preprocessing.REMOVE_H_ALL:
+            self._remove([i for i, label in enumerate(labels)
+                          if alive[i] and label == "1"])
+        elif step == Preprocessing.GET_CONSENSUS:
+            # The labels are interned, compute each consensus only once.
+            consensus = dict()
+            for i, label in enumerate(labels):
+                if alive[i]:
+                    if label not in consensus:
+                        consensus[label] = Graph.consensus_label(label)
+                    labels[i] = consensus[label]
+        elif step == Preprocessing.REMOVE_H:
+            self._remove_h()
+        elif step == Preprocessing.COMPRESS_CH3:
+            self._compress_ch3()
+        else:
+            raise Exception("Unknown step: " + str(step))
+        return self
+
+    def preprocessing(self, step_names: list, profiler=None):
+        """
+        Run preprocessing steps, see Graph.preprocessing.
+
+        :param step_names: The steps (by name)
+        :param profiler: A Profiler recording every step (optional).
+        :return: This graph.
+        """
+        for step in step_names or []:
+            if profiler is None:
+                self.preprocess(Preprocessing.get(step))
+                continue
+            with profiler.stage("preprocess." + step, self) as record:
+                self.preprocess(Preprocessing.get(step))
+                Profiler.set_counts(record, "after", self)
+        return self
+
+    def write(self, outpath, author=None, out_format="graph"):
+        """
+        Writes the graph in the custom .graph format, see Graph.write. The
+        edges are streamed from the input file.
+
+        :param outpath: The path of the output .graph file.
+        :param author: The value of the author field in the output file
+        (optional).
+        :param out_format: The output format (only graph).
+        """
+        if out_format != "graph":
+            raise Exception("Out-of-core processing only writes the graph "
+                            "format")
+        write_graph_text(outpath, self.iter_vertices(), self.iter_edges(),
+                         self.vertex_count, self.edge_count, author)
+
+
+VECTORIZED_STEPS = (Preprocessing.REMOVE_H, Preprocessing.REMOVE_H_ALL,
+                    Preprocessing.COMPRESS_CH3)
+
+
+def remove_h_kernel(size: int, sources, targets, multibond):
+    """
+    Find the vertices that have a neighbor with a multibond. REMOVE_H keeps
+    hydrogen atoms with this property.
+
+    :param size: The number of vertices.
+    :param sources: The source vertex indices of the edges.
+    :param targets: The target vertex indices of the edges.
+    :param multibond: A boolean array marking edges with a label other
+    than "1".
+    :return: A boolean array marking vertices with a neighbor that has a
+    multibond.
+    """
+    has_multibond = numpy.zeros(size, dtype=bool)
+    has_multibond[sources[multibond]] = True
+    has_multibond[targets[multibond]] = True
+    # Propagate to the neighbors, this handles distance two.
+    neighbor_multibond = numpy.zeros(size, dtype=bool)
+    neighbor_multibond[sources[has_multibond[targets]]] = True
+    neighbor_multibond[targets[has_multibond[sources]]] = True
+    return neighbor_multibond
+
+
+def compress_ch3_kernel(is_h, is_c, sources, targets):
+    """
+    Find CH_3 subgraphs, i.e. carbon atoms with exactly three hydrogen
+    neighbors (counting parallel edges).
+
+    :param is_h: A boolean array marking hydrogen atoms.
+    :param is_c: A boolean array marking carbon atoms.
+    :param sources: The source vertex indices of the edges.
+    :param targets: The target vertex indices of the edges.
+    :return: A tuple of boolean arrays marking the compressed carbon atoms
+    and the hydrogen atoms to remove.
+    """
+    size = len(is_h)
+    not_loop = sources != targets
+    h_count = numpy.bincount(sources, weights=is_h[targets], minlength=size)
+    h_count += numpy.bincount(targets[not_loop],
+                              weights=is_h[sources[not_loop]],
+                              minlength=size)
+    compressed = is_c & (h_count == 3)
+    removed = numpy.zeros(size, dtype=bool)
+    removed[targets[compressed[sources]]] = True
+    removed[sources[compressed[targets]]] = True
+    return compressed, removed & is_h
+
+
+class ConsensusEngine:
+    """
+    Computes the consensus labels of aligned graphs in bulk. The single labels
+    are interned to integers (the table is kept between calls) and counted
+    in a matrix of vertices x labels, instead of a dict per vertex. The result
+    is the same as the result of Graph.consensus_label. Without NumPy, the
+    labels are computed one at a time.
+    """
+
+    # The number of aligned vertices counted at once.
+    CHUNK_SIZE = 4096
+
+    def __init__(self):
+        self.labels = []
+        self._label_index = dict()
+
+    def consensus_labels(self, aligned_labels: list):
+        """
+        Get the consensus labels of many aligned vertex labels.
+
+        :param aligned_labels: The space-separated labels of aligned vertices.
+        :return: A list of the consensus labels ("0" if there is none).
+        """
+        if numpy is None:
+            return [Graph.consensus_label(label) for label in aligned_labels]
+        result = []
+        for first in range(0, len(aligned_labels),
+                           ConsensusEngine.CHUNK_SIZE):
+            result += self._count_chunk(
+                aligned_labels[first:first + ConsensusEngine.CHUNK_SIZE])
+        return result
+
+    def _count_chunk(self, aligned_labels: list):
+        """
+        Get the consensus labels of a chunk of aligned vertex labels.
+
+        :param aligned_labels: The space-separated labels of aligned vertices.
+        :return: A list of the consensus labels.
+        """
+        index = self._label_index
+        labels = self.labels
+        tokens = " ".join(aligned_labels).split(" ")
+        for label in set(tokens).difference(index):
+            index[label] = len(labels)
+            labels += [label]
+        ids = numpy.fromiter(map(index.__getitem__, tokens),
+                             dtype=numpy.int64, count=len(tokens))
+        del tokens
+        lengths = [label.count(" ") + 1 for label in aligned_labels]
+        rows = numpy.repeat(numpy.arange(len(aligned_labels)), lengths)
+        counts = numpy.bincount(rows * len(labels) + ids,
+                                minlength=len(aligned_labels) * len(labels))\
+            .reshape(len(aligned_labels), len(labels))
+        result = [labels[i] or "0" for i in counts.argmax(axis=1).tolist()]
+        # Ties are broken by the first occurrence (dict order). They are rare,
+        # so these vertices are computed one at a time.
+        ties = (counts == counts.max(axis=1)[:, None]).sum(axis=1) > 1
+        for row in numpy.flatnonzero(ties).tolist():
+            result[row] = Graph.consensus_label(aligned_labels[row])
+        return result
+
+    def get_consensus(self, graphs: list):
+        """
+        Get the consensus graphs of many aligned graphs in one batch.
+
+        :param graphs: The aligned graphs.
+        :return: A list of the consensus graphs.
+        """
+        aligned_labels = [v[1] for graph in graphs for v in graph.vertices]
+        consensus = iter(self.consensus_labels(aligned_labels))
+        return [Graph([(v[0], next(consensus)) for v in graph.vertices],
+                      graph.edges) for graph in graphs]
+
+
+class CompactGraph:
+    """
+    A memory efficient graph storing vertices and edges in typed arrays.
+    All vertex ids and labels are interned in a single label table, vertices
+    are identified by contiguous integer indices. Edge endpoints that are not
+    in the vertex list are stored as additional ids without a label.
+    """
+
+    def __init__(self):
+        """
+        Create a new empty compact graph.
+        """
+        self.labels = []
+        self._label_index = dict()
+        self.vertex_ids = array("i")
+        self.vertex_labels = array("i")
+        self._vertex_index = dict()
+        self.edge_sources = array("i")
+        self.edge_targets = array("i")
+        self.edge_labels = array("i")
+        self.author = None
+        self._csr = None
+        self._mmap = None
+
+    @property
+    def vertex_count(self):
+        """
+        The number of vertices (without ids only used by dangling edges).
+        """
+        return len(self.vertex_labels)
+
+    @property
+    def edge_count(self):
+        """
+        The number of edges.
+        """
+        return len(self.edge_labels)
+
+    def intern(self, label: str):
+        """
+        Get the index of a label in the label table, adding it if necessary.
+
+        :param label: The label.
+        :return: The index of the label.
+        """
+        index = self._label_index.get(label)
+        if index is None:
+            index = len(self.labels)
+            self.labels.append(label)
+            self._label_index[label] = index
+        return index
+
+    def _get_index(self, vid: str):
+        """
+        Get the vertex index of a vertex id, adding an unlabeled id if
+        necessary.
+
+        :param vid: The vertex id.
+        :return: The vertex index.
+        """
+        index = self._vertex_index.get(vid)
+        if index is None:
+            index = len(self.vertex_ids)
+            self.vertex_ids.append(self.intern(vid))
+            self._vertex_index[vid] = index
+        return index
+
+    def add_vertex(self, vid: str, label: str):
+        """
+        Add a vertex.
+
+        :param vid: The vertex id.
+        :param label: The vertex label.
+        :return: The index of the new vertex.
+        """
+        if len(self.vertex_ids) != len(self.vertex_labels):
+            raise Exception("Vertices must be added before edges.")
+        index = len(self.vertex_ids)
+        self.vertex_ids.append(self.intern(vid))
+        self.vertex_labels.append(self.intern(label))
+        self._vertex_index.setdefault(vid, index)
+        return index
+
+    def add_edge(self, source: str, target: str, label: str):
+        """
+        Add an edge.
+
+        :param source: The source vertex id.
+        :param target: The target vertex id.
+        :param label: The edge label.
+        :return: The index of the new edge.
+        """
+        self.edge_sources.append(self._get_index(source))
+        self.edge_targets.append(self._get_index(target))
+        self.edge_labels.append(self.intern(label))
+        self._csr = None
+        return len(self.edge_labels) - 1
+
+    def get_csr(self):
+        """
+        Get the adjacency of this graph in compressed sparse row format.
+        The neighbors of the vertex with index i are neighbors[offsets[i]:
+        offsets[i + 1]], connected by the edges with the indices stored at
+        the same positions in edge_indices (in the order of the edge list).
+
+        :return: A tuple of (offsets, neighbors, edge_indices).
+        """
+        if self._csr is None:
+            counts = [0] * (len(self.vertex_ids) + 1)
+            for source, target in zip(self.edge_sources, self.edge_targets):
+                counts[source + 1] += 1
+                if source != target:
+                    counts[target + 1] += 1
+            offsets = array("i", itertools.accumulate(counts))
+            neighbors = array("i", [0]) * offsets[-1]
+            edge_indices = array("i", [0]) * offsets[-1]
+            position = offsets[:-1]
+            for edge, (source, target) in enumerate(
+                    zip(self.edge_sources, self.edge_targets)):
+                neighbors[position[source]] = target
+                edge_indices[position[source]] = edge
+                position[source] += 1
+                if source != target:
+                    neighbors[position[target]] = source
+                    edge_indices[position[target]] = edge
+                    position[target] += 1
+            self._csr = (offsets, neighbors, edge_indices)
+        return self._csr
+
+    def get_neighbors_of(self, index: int):
+        """
+        Get the neighbors of a vertex in the form of
+        (neighbor_index, edge_label_index).
+
+        :param index: The index of the vertex.
+        :return: The neighbors of the vertex and the corresponding edge label.
+        """
+        offsets, neighbors, edge_indices = self.get_csr()
+        return [(neighbors[i], self.edge_labels[edge_indices[i]])
+                for i in range(offsets[index], offsets[index + 1])]
+
+    def iter_vertices(self):
+        """
+        Iterate the vertices as tuples of (id, label).
+
+        :return: A generator of vertex tuples.
+        """
+        labels = self.labels
+        for vid, label in zip(self.vertex_ids, self.vertex_labels):
+            yield labels[vid], labels[label]
+
+    def iter_edges(self):
+        """
+        Iterate the edges as tuples of (source_id, target_id, label).
+
+        :return: A generator of edge tuples.
+        """
+        labels = self.labels
+        ids = self.vertex_ids
+        for source, target, label in zip(self.edge_sources, self.edge_targets,
+                                         self.edge_labels):
+            yield labels[ids[source]], labels[ids[target]], labels[label]
+
+    @classmethod
+    def from_graph(cls, graph: Graph):
+        """
+        Create a compact graph from a graph.
+
+        :param graph: The graph.
+        :return: The compact graph.
+        """
+        result = CompactGraph()
+        for vertex in graph.vertices:
+            result.add_vertex(vertex[0], vertex[1])
+        for edge in graph.edges:
+            result.add_edge(edge[0], edge[1], edge[2])
+        return result
+
+    def to_graph(self):
+        """
+        Convert this compact graph to a graph storing lists of tuples.
+
+        :return: The graph.
+        """
+        return Graph(list(self.iter_vertices()), list(self.iter_edges()))
+
+    def write(self, outpath, author=None, out_format="graph"):
+        """
+        Writes the graph in the custom .graph format, see Graph.write.
+
+        :param outpath: The path of the output .graph file.
+        :param author: The value of the author field in the output file
+        (optional).
+        :param out_format: The output format (graph or binary).
+        """
+        if out_format == "binary":
+            self.write_binary(outpath, author)
+            return
+        write_graph_text(outpath, self.iter_vertices(), self.iter_edges(),
+                         self.vertex_count, self.edge_count, author)
+
+    def write_binary(self, outpath, author=None):
+        """
+        Writes the graph in the binary graph format (see BINARY_HEADER).
+
+        :param outpath: The path of the output file.
+        :param author: The value of the author field in the output file
+        (optional).
+        """
+        print("Writing ", outpath, " with ", self.vertex_count,
+              " vertices and ", self.edge_count, " edges.")
+        labels = self.labels
+        author_index = -1
+        if author:
+            author_index = len(labels)
+            labels = labels + [author]
+        data = [label.encode() for label in labels]
+        offsets = array("q", itertools.accumulate(
+            itertools.chain([0], map(len, data))))
+        data = b"".join(data)
+        columns = [self.vertex_ids, self.vertex_labels, self.edge_sources,
+                   self.edge_targets, self.edge_labels]
+        with open_file(outpath, "wb") as outfile:
+            outfile.write(BINARY_HEADER.pack(
+                BINARY_MAGIC, self.vertex_count, len(self.vertex_ids),
+                self.edge_count, len(labels), len(data), author_index))
+            _write_little_endian(outfile, offsets)
+            outfile.write(data)
+            # Align the columns to 4 bytes.
+            outfile.write(b"\0" * (-len(data) % 4))
+            for column in columns:
+                _write_little_endian(outfile, array("i", column))
+
+    @classmethod
+    def read_binary(cls, in_path):
+        """
+        Read a compact graph from a file in the binary graph format. The file
+        is memory-mapped and the columns are used without copying them, so the
+        graph is read-only. Only the label table is decoded.
+
+        :param in_path: The input path.
+        :return: The compact graph.
+        """
+        with open_file(in_path, "rb") as infile:
+            if isinstance(infile, io.BufferedReader):
+                mapped = mmap.mmap(infile.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            else:
+                # Compressed files cannot be mapped, they are decompressed
+                # to memory.
+                mapped = infile.read()
+        return CompactGraph.from_buffer(mapped, in_path)
+
+    @classmethod
+    def from_buffer(cls, buffer, in_path: str):
+        """
+        Create a compact graph from the content of a file in the binary graph
+        format. The columns are used without copying them, so the graph is
+        read-only.
+
+        :param buffer: The content (bytes or a memory map).
+        :param in_path: The input path (for error messages).
+        :return: The compact graph.
+        """
+        if buffer[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+            raise Exception("Not a binary graph: " + in_path)
+        _, vertex_count, id_count, edge_count, label_count, data_size, \
+            author_index = BINARY_HEADER.unpack_from(buffer)
+        view = memoryview(buffer)
+        position = BINARY_HEADER.size
+
+        def column(typecode, count):
+            nonlocal position
+            size = array(typecode).itemsize * count
+            data = view[position:position + size]
+            position += size
+            if sys.byteorder == "little":
+                return data.cast(typecode)
+            result = array(typecode, data.tobytes())
+            result.byteswap()
+            return result
+
+        offsets = column("q", label_count + 1)
+        data = view[position:position + data_size]
+        position += data_size + (-data_size % 4)
+        labels = [str(data[offsets[i]:offsets[i + 1]], "utf-8")
+                  for i in range(label_count)]
+        result = CompactGraph()
+        if author_index >= 0:
+            result.author = labels.pop(author_index)
+        result.labels = labels
+        result._label_index = {label: i for i, label in enumerate(labels)}
+        result.vertex_ids = column("i", id_count)
+        result.vertex_labels = column("i", vertex_count)
+        result.edge_sources = column("i", edge_count)
+        result.edge_targets = column("i", edge_count)
+        result.edge_labels = column("i", edge_count)
+        result._mmap = buffer
+        return result
+
+
+class GraphBatch:
+    """
+    Many graphs packed into shared typed arrays. Like in a CompactGraph, the
+    vertex ids and labels of all members are interned in a single label
+    table. The vertices and edges of the members are concatenated and
+    delimited by offset arrays, edges refer to vertices by their index in the
+    whole batch. The batch is the disjoint union of its members, so every
+    preprocessing step runs on all members at once.
+    """
+
+    def __init__(self):
+        """
+        Create a new empty batch.
+        """
+        self.labels = []
+        self._label_index = dict()
+        self.vertex_ids = array("i")
+        self.vertex_labels = array("i")
+        self.edge_sources = array("i")
+        self.edge_targets = array("i")
+        self.edge_labels = array("i")
+        self.vertex_offsets = array("q", [0])
+        self.edge_offsets = array("q", [0])
+
+    def __len__(self):
+        return len(self.vertex_offsets) - 1
+
+    def intern(self, label: str):
+        """
+        Get the index of a label in the label table, adding it if necessary.
+
+        :param label: The label.
+        :return: The index of the label.
+        """
+        index = self._label_index.get(label)
+        if index is None:
+            index = len(self.labels)
+            self.labels.append(label)
+            self._label_index[label] = index
+        return index
+
+    def add(self, graph: Graph):
+        """
+        Add a graph as new member. Graphs with duplicate vertex ids or with
+        edges to unknown vertices cannot be packed.
+
+        :param graph: The graph.
+        :return: The index of the new member, or None if the graph cannot be
+        packed.
+        """
+        first = len(self.vertex_labels)
+        index = {v[0]: first + i for i, v in enumerate(graph.vertices)}
+        if len(index) != len(graph.vertices):
+            return None
+        try:
+            sources = [index[e[0]] for e in graph.edges]
+            targets = [index[e[1]] for e in graph.edges]
+        except KeyError:
+            return None
+        intern = self.intern
+        self.vertex_ids.extend([intern(v[0]) for v in graph.vertices])
+        self.vertex_labels.extend([intern(v[1]) for v in graph.vertices])
+        self.edge_sources.extend(sources)
+        self.edge_targets.extend(targets)
+        self.edge_labels.extend([intern(e[2]) for e in graph.edges])
+        self.vertex_offsets.append(len(self.vertex_labels))
+        self.edge_offsets.append(len(self.edge_labels))
+        return len(self) - 1
+
+    def get_member(self, member: int):
+        """
+        Get a member of the batch.
+
+        :param member: The index of the member.
+        :return: The member as Graph.
+        """
+        labels = self.labels
+        get = labels.__getitem__
+        first = self.vertex_offsets[member]
+        last = self.vertex_offsets[member + 1]
+        ids = list(map(get, self.vertex_ids[first:last]))
+        vertices = list(zip(ids, map(get, self.vertex_labels[first:last])))
+        edge_first = self.edge_offsets[member]
+        edge_last = self.edge_offsets[member + 1]
+        edges = list(zip(
+            [ids[i - first] for i in self.edge_sources[edge_first:edge_last]],
+            [ids[i - first] for i in self.edge_targets[edge_first:edge_last]],
+            map(get, self.edge_labels[edge_first:edge_last])))
+        return Graph(vertices, edges)
+
+    def preprocessing(self, step_names: list):
+        """
+        Run preprocessing steps on all members. The result is the same as
+        running Graph.preprocessing on every member. Without NumPy, the
+        members are preprocessed one at a time.
+
+        :param step_names: The steps (by name)
+        :return: The batch after preprocessing.
+        """
+        if not step_names:
+            return self
+        if numpy is None:
+            result = GraphBatch()
+            for member in range(len(self)):
+                result.add(self.get_member(member).preprocessing(step_names))
+            return result
+        vertex_labels = numpy.asarray(self.vertex_labels, dtype=numpy.intp)
+        vertex_ids = numpy.asarray(self.vertex_ids, dtype=numpy.intp)
+        sources = numpy.asarray(self.edge_sources, dtype=numpy.intp)
+        targets = numpy.asarray(self.edge_targets, dtype=numpy.intp)
+        edge_labels = numpy.asarray(self.edge_labels, dtype=numpy.intp)
+        vertex_offsets = numpy.asarray(self.vertex_offsets, dtype=numpy.intp)
+        edge_offsets = numpy.asarray(self.edge_offsets, dtype=numpy.intp)
+        for step in map(Preprocessing.get, step_names):
+            # GET_CONSENSUS can intern "1", look it up for every step.
+            h = self._label_index.get("1", -1)
+            is_h = vertex_labels == h
+            if step == Preprocessing.REMOVE_H:
+                neighbor_multibond = remove_h_kernel(
+                    len(vertex_labels), sources, targets, edge_labels != h)
+                keep = ~is_h | neighbor_multibond
+            elif step == Preprocessing.REMOVE_H_ALL:
+                keep = ~is_h
+            elif step == Preprocessing.COMPRESS_CH3:
+                compressed, removed = compress_ch3_kernel(
+                    is_h, vertex_labels == self._label_index.get("6", -1),
+                    sources, targets)
+                vertex_labels = numpy.where(compressed, self.intern("CH3"),
+                                            vertex_labels)
+                keep = ~removed
+            elif step == Preprocessing.GET_CONSENSUS:
+                # The consensus only has to be computed once per label.
+                used = numpy.unique(vertex_labels).tolist()
+                table = numpy.arange(len(self.labels))
+                table[used] = [self.intern(Graph.consensus_label(
+                    self.labels[i])) for i in used]
+                vertex_labels = table[vertex_labels]
+                continue
+            else:
+                raise Exception("Unknown step: " + str(step))
+            if keep.all():
+                continue
+            keep_edges = keep[sources] & keep[targets]
+            # The number of kept vertices (edges) in front of each vertex
+            # (edge), this is also the new index.
+            kept = numpy.concatenate(([0], numpy.cumsum(keep)))
+            kept_edges = numpy.concatenate(([0], numpy.cumsum(keep_edges)))
+            sources = kept[sources[keep_edges]]
+            targets = kept[targets[keep_edges]]
+            edge_labels = edge_labels[keep_edges]
+            vertex_offsets = kept[vertex_offsets]
+            edge_offsets = kept_edges[edge_offsets]
+            vertex_ids = vertex_ids[keep]
+            vertex_labels = vertex_labels[keep]
+
+        def to_array(typecode, values):
+            return array(typecode, values.astype(
+                numpy.intc if typecode == "i" else numpy.int64).tobytes())
+
+        self.vertex_ids = to_array("i", vertex_ids)
+        self.vertex_labels = to_array("i", vertex_labels)
+        self.edge_sources = to_array("i", sources)
+        self.edge_targets = to_array("i", targets)
+        self.edge_labels = to_array("i", edge_labels)
+        self.vertex_offsets = to_array("q", vertex_offsets)
+        self.edge_offsets = to_array("q", edge_offsets)
+        return self
+
+
+def get_output_suffix(out_format: str, compression=None):
+    """
+    Get the file name suffix of an output format.
+
+    :param out_format: The output format.
+    :param compression: The compression format (optional, see
+    COMPRESSION_FORMATS).
+    :return: The suffix.
+    """
+    suffix = OUT_FORMAT_SUFFIXES[out_format]
+    if compression:
+        suffix += "." + compression
+    return suffix
+
+
+def strip_compression_suffix(path: str):
+    """
+    Remove the suffix of a compression format from a path.
+
+    :param path: The path.
+    :return: The path without the compression suffix.
+    """
+    base, suffix = os.path.splitext(path)
+    return base if suffix in COMPRESSION_SUFFIXES else path
+
+
+def open_file(path: str, mode="r"):
+    """
+    Open a file, compressed files are (de)compressed while streaming through.
+    When reading, gzip, bz2 and xz files are detected by their magic bytes.
+    When writing, the compression is chosen by the suffix (.gz, .bz2, .xz or
+    .lzma).
+
+    :param path: The path.
+    :param mode: The mode ("r", "rb", "w" or "wb").
+    :return: The file object.
+    """
+    if "r" in mode:
+        infile = open(path, "rb")
+        magic = infile.peek(6)[:6]
+        for prefix, module in COMPRESSION_MAGIC:
+            if magic.startswith(prefix):
+                infile.close()
+                return module.open(path, "rb" if "b" in mode else "rt")
+        return infile if "b" in mode else io.TextIOWrapper(infile)
+    module = COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1])
+    if module is None:
+        return open(path, mode)
+    if module is gzip:
+        # The default level 9 is much slower and hardly smaller.
+        return gzip.open(path, "wb" if "b" in mode else "wt",
+                         compresslevel=6)
+    return module.open(path, "wb" if "b" in mode else "wt")
+
+
+def decompress(data: bytes):
+    """
+    Decompress the content of a file if it is compressed (see open_file).
+
+    :param data: The content.
+    :return: The decompressed content.
+    """
+    for prefix, module in COMPRESSION_MAGIC:
+        if data.startswith(prefix):
+            return module.decompress(data)
+    return data
+
+
+def _write_little_endian(outfile, values: array):
+    """
+    Write an array in little-endian byte order.
+
+    :param outfile: The (binary mode) output file.
+    :param values: The array.
+    """
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    values.tofile(outfile)
+
+
+def write_graph_text(outpath, vertices, edges, vertex_count: int,
+                     edge_count: int, author=None):
+    """
+    Write vertices and edges in the custom .graph format used by the other
+    tools in the Praktikum.
+
+    :param outpath: The path of the output .graph file.
+    :param vertices: An iterable of vertex tuples.
+    :param edges: An iterable of edge tuples.
+    :param vertex_count: The number of vertices.
+    :param edge_count: The number of edges.
+    :param author: The value of the author field in the output file
+    (optional).
+    """
+    vertex_count = str(vertex_count)
+    edges_count = str(edge_count)
+    print("Writing ", outpath, " with ", vertex_count, " vertices and ",
+          edges_count, " edges.")
+    outfile = open_file(outpath, "w")
+    if author:
+        outfile.write("AUTHOR: " + author + "\n")
+    outfile.write("#nodes;" + vertex_count + "\n")
+    outfile.write("#edges;" + edges_count + "\n")
+    outfile.write("Nodes labelled;True\n")
+    outfile.write("Edges labelled;True\n")
+    outfile.write("Directed graph;False\n")
+    outfile.write("\n")
+    for vertex in vertices:
+        outfile.write(";".join(vertex) + "\n")
+    outfile.write("\n")
+    for edge in edges:
+        outfile.write(";".join(edge) + "\n")
+    outfile.close()
+
+
+def iter_json_array(file, key: str, chunk_size=1 << 20):
+    """
+    Incrementally parse the elements of the first array stored under a key
+    in a JSON document. The file is read in chunks and every element is
+    decoded as soon as it is complete. Memory use is bounded by the size of
+    the largest element plus the chunk size.
+
+    :param file: The (text mode) file to read from.
+    :param key: The key of the array.
+    :param chunk_size: The number of characters read at once.
+    :return: A generator of the parsed elements.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    eof = False
+
+    def read_more():
+        nonlocal buffer, eof
+        chunk = file.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer += chunk
+
+    # Find the start of the array.
+    marker = '"' + key + '"'
+    while True:
+        start = buffer.find(marker)
+        if start >= 0:
+            bracket = buffer.find("[", start + len(marker))
+            if bracket >= 0:
+                if buffer[start + len(marker):bracket].strip() != ":":
+                    raise Exception("Expected an array for key " + key)
+                buffer = buffer[bracket + 1:]
+                break
+        elif eof:
+            raise Exception("Key not found: " + key)
+        else:
+            # Keep a possible partial match of the marker.
+            buffer = buffer[-len(marker):]
+        if eof:
+            raise Exception("Expected an array for key " + key)
+        read_more()
+    position = 0
+    expect_element = True
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n":
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise Exception("Unexpected end of file in " + key)
+            buffer = ""
+            position = 0
+            read_more()
+            continue
+        if buffer[position] == "]":
+            return
+        if not expect_element:
+            if buffer[position] != ",":
+                raise Exception("Expected ',' in " + key)
+            position += 1
+            expect_element = True
+            continue
+        try:
+            element, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # The element is incomplete, drop parsed data and read more.
+            buffer = buffer[position:]
+            position = 0
+            read_more()
+            continue
+        yield element
+        expect_element = False
+        buffer = buffer[end:]
+        position = 0
+
+
+class ConversionCache:
+    """
+    An on-disk cache of converted graph files. Entries are keyed by a hash of
+    the input file contents, the input format, the preprocessing steps, the
+    author and the output format. The least recently used entries are removed
+    when the cache grows larger than its size limit. Every process keeps its
+    own view of the cache, so the size limit is only approximate when multiple
+    processes share one cache directory.
+    """
+
+    _instances = dict()
+
+    def __init__(self, path: str, max_size=1 << 30, link=False):
+        """
+        Open a cache directory, creating it if necessary.
+
+        :param path: The cache directory.
+        :param max_size: The maximum size of the cache in bytes.
+        :param link: Hardlink cached files instead of copying them. Output
+        files must not be modified in place in this case.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        os.makedirs(path, exist_ok=True)
+        found = []
+        for directory in os.scandir(path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                # Skip files of unfinished stores.
+                if not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    found += [(stat.st_mtime, entry.name, stat.st_size)]
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._size += size
+
+    @classmethod
+    def get_instance(cls, path: str, max_size=1 << 30, link=False):
+        """
+        Get the cache instance of this process for a cache directory. This is
+        used by worker processes to avoid scanning the cache for every file.
+
+        :param path: The cache directory.
+        :param max_size: The maximum size of the cache in bytes.
+        :param link: Hardlink cached files instead of copying them.
+        :return: The cache.
+        """
+        if path not in cls._instances:
+            cls._instances[path] = ConversionCache(path, max_size, link)
+        return cls._instances[path]
+
+    @staticmethod
+    def get_key(inpath: str, informat: str, author=None, preprocess=None,
+                out_format="graph", compression=None):
+        """
+        Calculate the cache key of a conversion.
+
+        :param inpath: The input path.
+        :param informat: The input format.
+        :param author: The author (optional).
+        :param preprocess: The preprocessing steps (optional).
+        :param out_format: The output format.
+        :param compression: The compression suffix of the output (optional).
+        :return: The cache key. It ends with the file name suffix of the
+        output, the cache entries are named after their keys.
+        """
+        digest = hashlib.sha256()
+        with open(inpath, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        settings = [Graph.detect_format(inpath, informat), preprocess or [],
+                    author, out_format]
+        if compression:
+            settings += [compression]
+        digest.update(json.dumps(settings).encode())
+        return digest.hexdigest() + OUT_FORMAT_SUFFIXES[out_format] + \
+            (compression or "")
+
+    def _get_path(self, key: str):
+        """
+        Get the path of a cache entry.
+
+        :param key: The cache key.
+        :return: The path.
+        """
+        return os.path.join(self.path, key[:2], key)
+
+    def fetch(self, key: str, outpath: str):
+        """
+        Copy a cached file to an output path.
+
+        :param key: The cache key.
+        :param outpath: The output path.
+        :return: True on a hit, False on a miss.
+        """
+        cached = self._get_path(key)
+        try:
+            # The modification time is used to restore the LRU order.
+            os.utime(cached)
+        except FileNotFoundError:
+            self._size -= self._entries.pop(key, 0)
+            self.misses += 1
+            return False
+        if os.path.lexists(outpath):
+            os.remove(outpath)
+        if self.link:
+            try:
+                os.link(cached, outpath)
+            except OSError:
+                shutil.copyfile(cached, outpath)
+        else:
+            shutil.copyfile(cached, outpath)
+        if key not in self._entries:
+            # Stored by another process.
+            self._entries[key] = os.path.getsize(cached)
+            self._size += self._entries[key]
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True
+
+    def store(self, key: str, outpath: str):
+        """
+        Add a converted file to the cache and evict old entries if the cache
+        is too large.
+
+        :param key: The cache key.
+        :param outpath: The path of the converted file.
+        """
+        cached = self._get_path(key)
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        temp = cached + "." + str(os.getpid()) + ".tmp"
+        shutil.copyfile(outpath, temp)
+        os.replace(temp, cached)
+        size = os.path.getsize(cached)
+        self._size += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        while self._size > self.max_size and len(self._entries) > 1:
+            old_key, old_size = self._entries.popitem(last=False)
+            self._size -= old_size
+            try:
+                os.remove(self._get_path(old_key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """
+        Get the statistics of this cache.
+
+        :return: A dict of hits, misses, entries and size in bytes.
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self._entries), "size": self._size}
+
+
+def get_output_path(outpath: str, name: str, shard=False):
+    """
+    Get the path of an output file. Sharded outputs are spread over 256
+    subdirectories named after the first byte of the SHA-1 of the file name,
+    so no directory gets too large.
+
+    :param outpath: The output directory.
+    :param name: The file name.
+    :param shard: Use a hashed subdirectory.
+    :return: The output path.
+    """
+    if not shard:
+        return os.path.join(outpath, name)
+    return os.path.join(outpath, hashlib.sha1(name.encode("utf-8"))
+                        .hexdigest()[:2], name)
+
+
+def create_shards(outpath: str):
+    """
+    Create the subdirectories of a sharded output directory.
+
+    :param outpath: The output directory.
+    """
+    for shard in range(256):
+        os.makedirs(os.path.join(outpath, "%02x" % shard), exist_ok=True)
+
+
+class Journal:
+    """
+    An append-only log of the completed conversions of an output directory.
+    A line is appended after each input is converted completely, so an
+    interrupted run can be resumed by skipping the logged inputs, without
+    checking for existing output files.
+    """
+
+    FILE_NAME = "journal.log"
+
+    def __init__(self, outpath: str):
+        """
+        Open (or create) the journal of an output directory.
+
+        :param outpath: The output directory.
+        """
+        self.path = os.path.join(outpath, Journal.FILE_NAME)
+        self.completed = set()
+        if os.path.exists(self.path):
+            with open(self.path, "rb+") as infile:
+                size = 0
+                for line in infile:
+                    if not line.endswith(b"\n"):
+                        break
+                    self.completed.add(json.loads(line.decode("utf-8")))
+                    size += len(line)
+                # The last line is incomplete if the run was killed while
+                # writing it.
+                infile.truncate(size)
+        self.file = open(self.path, "a")
+
+    @staticmethod
+    def get_key(inpath: str):
+        """
+        Get the key of an input in the journal.
+
+        :param inpath: The input path.
+        :return: The key.
+        """
+        return os.path.abspath(inpath)
+
+    def __contains__(self, inpath: str):
+        return Journal.get_key(inpath) in self.completed
+
+    def add(self, inpath: str):
+        """
+        Log a completed input.
+
+        :param inpath: The input path.
+        """
+        key = Journal.get_key(inpath)
+        self.completed.add(key)
+        self.file.write(json.dumps(key) + "\n")
+        self.file.flush()
+
+    def close(self):
+        """
+        Close the journal.
+        """
+        self.file.close()
+
+
+class Deduplicator:
+    """
+    Finds graphs that are structurally identical to an earlier graph. Graphs
+    are grouped by their canonical hash, graphs with the same hash are
+    compared exactly. The unique graphs are kept in memory for this.
+    """
+
+    def __init__(self):
+        self._graphs = dict()
+        self.duplicates = dict()
+
+    def check(self, graph: Graph, source: str):
+        """
+        Check whether a graph is a duplicate of an earlier graph. Otherwise,
+        the graph is remembered.
+
+        :param graph: The graph.
+        :param source: The name of the input of the graph.
+        :return: The name of the input of the earlier graph, or None if the
+        graph is new.
+        """
+        candidates = self._graphs.setdefault(graph.canonical_hash(), [])
+        for other, other_source in candidates:
+            if graph.is_isomorphic(other):
+                self.duplicates[source] = other_source
+                return other_source
+        candidates += [(graph, source)]
+        return None
+
+    def write(self, outpath: str):
+        """
+        Write the mapping of duplicates to the inputs they duplicate.
+
+        :param outpath: The path of the JSON file.
+        """
+        with open(outpath, "w") as outfile:
+            json.dump(self.duplicates, outfile, indent=1, sort_keys=True)
+
+
+class Manifest:
+    """
+    An index of the converted graphs in an output path, stored in SQLite. For
+    every output file, it records the source, the vertex and edge counts, the
+    label histogram, the preprocessing steps and the byte size, so subsets
+    can be selected without parsing any graphs. Without a path, the entries
+    are only collected in a list (used by the worker processes).
+    """
+
+    FILE_NAME = "manifest.sqlite"
+
+    def __init__(self, path=None):
+        """
+        Open (or create) a manifest.
+
+        :param path: The directory of the manifest (optional).
+        """
+        self.entries = []
+        self.path = path
+        self.connection = None
+        if path is not None:
+            self.connection = sqlite3.connect(
+                os.path.join(path, Manifest.FILE_NAME))
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS graphs (output TEXT PRIMARY KEY, "
+                "source TEXT, vertices INTEGER, edges INTEGER, labels TEXT, "
+                "steps TEXT, size INTEGER)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS labels (output TEXT, label TEXT, "
+                "count INTEGER, PRIMARY KEY (output, label))")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS labels_by_label ON labels "
+                "(label, count)")
+            self.connection.commit()
+
+    @staticmethod
+    def get_entry(outpath: str, source: str, graph, preprocess=None):
+        """
+        Describe a written graph.
+
+        :param outpath: The output path.
+        :param source: The input the graph was read from.
+        :param graph: The graph (a Graph, CompactGraph, GraphView or
+        OutOfCoreGraph).
+        :param preprocess: The preprocessing steps (optional).
+        :return: The entry as dict.
+        """
+        if isinstance(graph, CompactGraph):
+            labels = [graph.labels[i] for i in graph.vertex_labels]
+            vertex_count = graph.vertex_count
+            edge_count = graph.edge_count
+        elif isinstance(graph, (GraphView, OutOfCoreGraph)):
+            labels = [v[1] for v in graph.iter_vertices()]
+            vertex_count = graph.vertex_count
+            edge_count = graph.edge_count
+        else:
+            labels = [v[1] for v in graph.vertices]
+            vertex_count = len(graph.vertices)
+            edge_count = len(graph.edges)
+        histogram = dict()
+        for label in labels:
+            histogram[label] = histogram.get(label, 0) + 1
+        return {"output": os.path.abspath(outpath), "source": source,
+                "vertices": vertex_count, "edges": edge_count,
+                "labels": histogram, "steps": list(preprocess or []),
+                "size": os.path.getsize(outpath)}
+
+    def add(self, entry: dict):
+        """
+        Add (or replace) an entry.
+
+        :param entry: The entry, see get_entry.
+        """
+        if self.connection is None:
+            self.entries += [entry]
+            return
+        output = os.path.relpath(entry["output"], self.path)
+        with self.connection:
+            self.connection.execute("DELETE FROM labels WHERE output = ?",
+                                    (output,))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO graphs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (output, entry["source"], entry["vertices"], entry["edges"],
+                 json.dumps(entry["labels"], sort_keys=True),
+                 ",".join(entry["steps"]), entry["size"]))
+            self.connection.executemany(
+                "INSERT INTO labels VALUES (?, ?, ?)",
+                [(output, label, count)
+                 for label, count in entry["labels"].items()])
+
+    def query(self, min_vertices=None, max_vertices=None, min_edges=None,
+              max_edges=None, labels=None, steps=None, source=None):
+        """
+        Select entries. All given conditions have to hold.
+
+        :param min_vertices: The minimum number of vertices.
+        :param max_vertices: The maximum number of vertices.
+        :param min_edges: The minimum number of edges.
+        :param max_edges: The maximum number of edges.
+        :param labels: A dict of vertex labels to their minimum count. A count
+        of 0 selects graphs without the label.
+        :param steps: The list of preprocessing steps.
+        :param source: A glob pattern of the source.
+        :return: A list of entries with output paths in the manifest
+        directory, sorted by output.
+        """
+        conditions = []
+        parameters = []
+        for column, op, value in [("vertices", ">=", min_vertices),
+                                  ("vertices", "<=", max_vertices),
+                                  ("edges", ">=", min_edges),
+                                  ("edges", "<=", max_edges),
+                                  ("source", "GLOB", source)]:
+            if value is not None:
+                conditions += [column + " " + op + " ?"]
+                parameters += [value]
+        if steps is not None:
+            conditions += ["steps = ?"]
+            parameters += [",".join(steps)]
+        for label, count in (labels or dict()).items():
+            if count > 0:
+                conditions += ["EXISTS (SELECT 1 FROM labels WHERE labels."
+                               "output = graphs.output AND label = ? AND "
+                               "count >= ?)"]
+                parameters += [label, count]
+            else:
+                conditions += ["NOT EXISTS (SELECT 1 FROM labels WHERE "
+                               "labels.output = graphs.output AND "
+                               "label = ?)"]
+                parameters += [label]
+        sql = "SELECT * FROM graphs"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        result = []
+        for row in self.connection.execute(sql + " ORDER BY output",
+                                           parameters):
+            result += [{"output": os.path.join(self.path, row[0]),
+                        "source": row[1], "vertices": row[2],
+                        "edges": row[3], "labels": json.loads(row[4]),
+                        "steps": row[5].split(",") if row[5] else [],
+                        "size": row[6]}]
+        return result
+
+    def close(self):
+        """
+        Close the manifest.
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class Profiler:
+    """
+    Records wall time, peak memory and vertex and edge counts of the stages
+    of conversions. Memory is measured with tracemalloc, which is started by
+    the profiler.
+    """
+
+    def __init__(self, report=None):
+        """
+        Create a new profiler.
+
+        :param report: A text file to write the records to as JSON lines
+        (optional).
+        """
+        self.records = []
+        self.report = report
+        self.current_file = None
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @staticmethod
+    def set_counts(record: dict, when: str, graph):
+        """
+        Set the vertex and edge counts of a record.
+
+        :param record: The record.
+        :param when: "before" or "after".
+        :param graph: The graph (or None).
+        """
+        if graph is None:
+            record["vertices_" + when] = None
+            record["edges_" + when] = None
+        elif isinstance(graph, (CompactGraph, GraphView, OutOfCoreGraph)):
+            record["vertices_" + when] = graph.vertex_count
+            record["edges_" + when] = graph.edge_count
+        else:
+            record["vertices_" + when] = len(graph.vertices)
+            record["edges_" + when] = len(graph.edges)
+
+    @staticmethod
+    def get_stage(profiler):
+        """
+        Get the stage method of a profiler or, without a profiler, a function
+        yielding records that are not kept.
+
+        :param profiler: The profiler (or None).
+        :return: A function like stage.
+        """
+        if profiler is not None:
+            return profiler.stage
+        return lambda name, graph=None: contextlib.nullcontext(dict())
+
+    @contextlib.contextmanager
+    def stage(self, name: str, graph=None):
+        """
+        Profile a stage of the current file. The record is yielded, the
+        counts after the stage are set with set_counts.
+
+        :param name: The name of the stage.
+        :param graph: The graph before the stage (optional).
+        :return: A context manager yielding the record.
+        """
+        record = {"file": self.current_file, "stage": name}
+        Profiler.set_counts(record, "before", graph)
+        Profiler.set_counts(record, "after", None)
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.clear_traces()
+        base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            record["peak_memory"] = tracemalloc.get_traced_memory()[1] - base
+            self.add(record)
+
+    def add(self, record: dict):
+        """
+        Add a record, writing it to the report.
+
+        :param record: The record.
+        """
+        self.records += [record]
+        if self.report is not None:
+            self.report.write(json.dumps(record) + "\n")
+            self.report.flush()
+
+    def summary(self, count=5):
+        """
+        Summarize the slowest files and stages.
+
+        :param count: The number of files and stages to list.
+        :return: The summary as text.
+        """
+        files = dict()
+        stages = dict()
+        for record in self.records:
+            files[record["file"]] = files.get(record["file"], 0) \
+                + record["seconds"]
+            stages[record["stage"]] = stages.get(record["stage"], 0) \
+                + record["seconds"]
+        lines = ["Slowest files:"]
+        for name, seconds in sorted(files.items(), key=lambda x: -x[1]
+                                    )[:count]:
+            lines += ["  %10.6f s  %s" % (seconds, name)]
+        lines += ["Slowest stages (total):"]
+        for name, seconds in sorted(stages.items(), key=lambda x: -x[1]
+                                    )[:count]:
+            lines += ["  %10.6f s  %s" % (seconds, name)]
+        return "\n".join(lines) + "\n"
+
+
+def json2graph(inpath: str, outpath: str, informat: str, author=None,
+               preprocess = None, cache=None, out_format="graph",
+               profiler=None, dedupe=None, manifest=None, lazy=False,
+               graph_cache=None, out_of_core=False):
+    if profiler is not None:
+        profiler.current_file = inpath
+    stage = Profiler.get_stage(profiler)
+    key = None
+    if cache is not None:
+        with stage("cache"):
+            compression = os.path.splitext(outpath)[1]
+            key = ConversionCache.get_key(
+                inpath, informat, author, preprocess, out_format,
+                compression if compression in COMPRESSION_SUFFIXES else None)
+            hit = cache.fetch(key, outpath)
+        if hit:
+            print("Using cached conversion of ", inpath, "for", outpath)
+            if manifest is None and dedupe is None:
+                return
+            graph = Graph.read_graph(outpath)
+            if dedupe is not None:
+                original = dedupe.check(graph, inpath)
+                if original is not None:
+                    print("Skipping ", inpath, "(duplicate of", original + ")")
+                    os.remove(outpath)
+                    return
+            if manifest is not None:
+                manifest.add(Manifest.get_entry(outpath, inpath, graph,
+                                                preprocess))
+            return
+        if os.path.lexists(outpath):
+            # Do not write through a hardlink to a cache entry.
+            os.remove(outpath)
+    print("Converting ", inpath, "to", outpath)
+    with stage("read") as record:
+        if out_of_core:
+            if Graph.detect_format(inpath, informat) != "graph":
+                raise Exception("Out-of-core processing requires a .graph "
+                                "input: " + inpath)
+            graph = OutOfCoreGraph(inpath)
+        elif graph_cache is not None:
+            graph = graph_cache.read_graph(inpath, informat)
+        else:
+            graph = Graph.read_graph(inpath, informat)
+        Profiler.set_counts(record, "after", graph)
+    if lazy:
+        graph = graph.view()
+    graph = graph.preprocessing(preprocess, profiler)
+    if dedupe is not None:
+        if lazy:
+            graph = graph.materialize()
+        original = dedupe.check(graph, inpath)
+        if original is not None:
+            print("Skipping ", inpath, "(duplicate of", original + ")")
+            return
+    with stage("write", graph) as record:
+        graph.write(outpath, author, out_format)
+        Profiler.set_counts(record, "after", graph)
+    if manifest is not None:
+        manifest.add(Manifest.get_entry(outpath, inpath, graph, preprocess))
+    if out_of_core:
+        graph.close()
+    if cache is not None:
+        cache.store(key, outpath)
+
+
+def json2graph_multi(inpath: str, outpath: str, author=None,
+                     preprocess=None, force=False, out_format="graph",
+                     dedupe=None, manifest=None, shard=False,
+                     compression=None, batch_size=None, profiler=None):
+    """
+    Convert every compound of a JSON file to its own .graph file. The output
+    files are named after the input file and the compound id.
+
+    :param inpath: The JSON input path.
+    :param outpath: The output directory.
+    :param author: The author (optional).
+    :param preprocess: The preprocessing steps (optional).
+    :param force: Overwrite existing files.
+    :param out_format: The output format.
+    :param dedupe: A Deduplicator (optional), duplicates are not written.
+    They are named by the input path and compound id, separated by "#".
+    :param manifest: A Manifest (optional), the written files are added.
+    :param shard: Write to hashed subdirectories (see get_output_path).
+    :param compression: The compression of the output files (optional).
+    :param batch_size: Preprocess this many compounds at once (optional,
+    see convert_batched).
+    :param profiler: A Profiler (optional, not with batch_size). Every
+    compound is recorded as file "inpath#compound_id". Reading the rest of
+    the input after the last compound is recorded for inpath.
+    :return: The number of written files.
+    """
+    print("Converting compounds of ", inpath, "to", outpath)
+    stage = Profiler.get_stage(profiler)
+
+    def compounds():
+        parsed = Graph.read_graphs_json(inpath)
+        while True:
+            if profiler is not None:
+                profiler.current_file = inpath
+            with stage("read") as record:
+                compound_id, graph = next(parsed, (None, None))
+                if graph is not None:
+                    record["file"] = inpath + "#" + compound_id
+                    Profiler.set_counts(record, "after", graph)
+            if graph is None:
+                return
+            next_outfile = get_output_path(
+                outpath, strip_compression_suffix(os.path.basename(inpath))
+                + "." + compound_id
+                + get_output_suffix(out_format, compression), shard)
+            if os.path.exists(next_outfile) and not force:
+                sys.stderr.write("Error: File already exists: "
+                                 + next_outfile + "\n")
+                continue
+            yield inpath + "#" + compound_id, graph, next_outfile
+
+    return convert_batched(compounds(), author, preprocess, out_format,
+                           batch_size, dedupe, manifest, profiler=profiler)
+
+
+def json2graph_variants(inpath: str, outpaths: dict, informat: str,
+                        pipelines: dict, author=None, out_format="graph",
+                        manifest=None, profiler=None):
+    """
+    Convert a file to several variants with different preprocessing steps.
+    The file is read once, see Graph.preprocessing_variants.
+
+    :param inpath: The input path.
+    :param outpaths: A dict of variant names to output paths.
+    :param informat: The input format.
+    :param pipelines: A dict of variant names to lists of steps (by name).
+    :param author: The author (optional).
+    :param out_format: The output format.
+    :param manifest: A Manifest (optional), the written files are added.
+    :param profiler: A Profiler (optional). The output of every variant is
+    recorded as stage "write.NAME".
+    """
+    if profiler is not None:
+        profiler.current_file = inpath
+    stage = Profiler.get_stage(profiler)
+    print("Converting ", inpath, "to", ", ".join(outpaths.values()))
+    with stage("read") as record:
+        graph = Graph.read_graph(inpath, informat)
+        Profiler.set_counts(record, "after", graph)
+    for name, result in graph.preprocessing_variants(pipelines,
+                                                     profiler).items():
+        with stage("write." + name, result) as record:
+            result.write(outpaths[name], author, out_format)
+            Profiler.set_counts(record, "after", result)
+        if manifest is not None:
+            manifest.add(Manifest.get_entry(outpaths[name], inpath, result,
+                                            pipelines[name]))
+
+
+def convert_batched(items, author=None, preprocess=None, out_format="graph",
+                    batch_size=1024, dedupe=None, manifest=None,
+                    journal=None, profiler=None):
+    """
+    Preprocess and write graphs in batches (see GraphBatch), which avoids the
+    overhead of preprocessing many small graphs one at a time. Graphs that
+    cannot be packed are preprocessed on their own. The graphs are finished
+    (checked for duplicates and written) in the order of the items.
+
+    :param items: An iterable of (source, graph, outpath) tuples.
+    :param author: The author (optional).
+    :param preprocess: The preprocessing steps (optional).
+    :param out_format: The output format.
+    :param batch_size: The number of graphs per batch (None: preprocess every
+    graph on its own).
+    :param dedupe: A Deduplicator (optional), duplicates are not written.
+    :param manifest: A Manifest (optional), the written files are added.
+    :param journal: A Journal (optional), the sources are logged when their
+    graph is written.
+    :param profiler: A Profiler (optional) recording the preprocessing and
+    output of every graph (by its source). Batches cannot be profiled, so
+    it requires batch_size None.
+    :return: The number of written files.
+    """
+    if profiler is not None and batch_size is not None:
+        raise Exception("Batched conversions cannot be profiled")
+    stage = Profiler.get_stage(profiler)
+    written = 0
+    batch = GraphBatch()
+    members = []
+
+    def finish(source, graph, outpath):
+        nonlocal written
+        if dedupe is not None:
+            original = dedupe.check(graph, source)
+            if original is not None:
+                print("Skipping ", source, "(duplicate of", original + ")")
+                if journal is not None:
+                    journal.add(source)
+                return
+        with stage("write", graph) as record:
+            graph.write(outpath, author, out_format)
+            Profiler.set_counts(record, "after", graph)
+        if manifest is not None:
+            manifest.add(Manifest.get_entry(outpath, source, graph,
+                                            preprocess))
+        if journal is not None:
+            journal.add(source)
+        written += 1
+
+    def flush():
+        nonlocal batch, members
+        batch = batch.preprocessing(preprocess)
+        for member, (source, outpath) in enumerate(members):
+            finish(source, batch.get_member(member), outpath)
+        batch = GraphBatch()
+        members = []
+
+    for source, graph, outpath in items:
+        if batch_size is None or batch.add(graph) is None:
+            if members:
+                # Finish the earlier graphs first.
+                flush()
+            if profiler is not None:
+                profiler.current_file = source
+            finish(source, graph.preprocessing(preprocess, profiler),
+                   outpath)
+            continue
+        members += [(source, outpath)]
+        if len(members) >= batch_size:
+            flush()
+    flush()
+    return written
+
+
+def _json2graph_task(task):
+    """
+    Run json2graph for a single (inpath, outpath, informat, author,
+    preprocess, cache, out_format, profile, manifest) tuple, catching errors.
+    The cache is given as a tuple of (path, max_size, link) or None. Used by
+    the worker processes of batch_json2graph.
+
+    :param task: The arguments of json2graph.
+    :return: A tuple of the error message (None on success), whether the
+    cache was hit, the profile records and the manifest entries.
+    """
+    cache = None
+    if task[5] is not None:
+        cache = ConversionCache.get_instance(*task[5])
+    hits = cache.hits if cache is not None else 0
+    profiler = Profiler() if task[7] else None
+    records = profiler.records if profiler is not None else []
+    manifest = Manifest() if task[8] else None
+    entries = manifest.entries if manifest is not None else []
+    try:
+        json2graph(*task[:5], cache, task[6], profiler, manifest=manifest)
+    except Exception as e:
+        return type(e).__name__ + ": " + str(e), False, records, entries
+    return None, cache is not None and cache.hits > hits, records, entries
+
+
+def batch_json2graph(files: list, informat: str, author=None,
+                     preprocess=None, jobs=None, cache=None,
+                     out_format="graph", profiler=None, manifest=None,
+                     journal=None):
+    """
+    Convert multiple files using a pool of worker processes.
+    Failed conversions will not stop the other conversions.
+
+    :param files: A list of (inpath, outpath) tuples.
+    :param informat: The input format.
+    :param author: The author (optional).
+    :param preprocess: The preprocessing steps (optional).
+    :param jobs: The number of worker processes (default: number of CPUs).
+    :param cache: A ConversionCache (optional). Its statistics are updated
+    with the results of the workers.
+    :param out_format: The output format.
+    :param profiler: A Profiler (optional), the records of the workers are
+    added to it.
+    :param manifest: A Manifest (optional), the entries of the workers are
+    added to it.
+    :param journal: A Journal (optional), completed inputs are logged.
+    :return: A list of (inpath, error message) tuples of failed conversions.
+    """
+    cache_spec = None
+    if cache is not None:
+        cache_spec = (cache.path, cache.max_size, cache.link)
+    tasks = [(inpath, outpath, informat, author, preprocess, cache_spec,
+              out_format, profiler is not None, manifest is not None)
+             for inpath, outpath in files]
+    if not tasks:
+        return []
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    chunksize = max(1, min(64, len(tasks) // (jobs * 4)))
+    failures = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(_json2graph_task, tasks, chunksize=chunksize)
+        for task, (error, hit, records, entries) in zip(tasks, results):
+            if profiler is not None:
+                for record in records:
+                    profiler.add(record)
+            if manifest is not None:
+                for entry in entries:
+                    manifest.add(entry)
+            if error is not None:
+                failures += [(task[0], error)]
+                continue
+            if journal is not None:
+                journal.add(task[0])
+            if cache is not None:
+                if hit:
+                    cache.hits += 1
+                else:
+                    cache.misses += 1
+    return failures
+
+
+def _read_bytes(inpath: str):
+    """
+    Read a whole file.
+
+    :param inpath: The input path.
+    :return: The content.
+    """
+    with open(inpath, "rb") as infile:
+        return infile.read()
+
+
+def async_json2graph(files: list, informat: str, author=None,
+                     preprocess=None, io_threads=4, queue_size=8,
+                     out_format="graph", dedupe=None, manifest=None,
+                     journal=None):
+    """
+    Convert multiple files in a pipeline that overlaps reading, converting
+    and writing. Files are read and written by a pool of threads, while the
+    graphs are parsed and preprocessed one at a time. The bounded queues
+    between the stages limit the number of files held in memory.
+    Failed conversions will not stop the other conversions.
+
+    :param files: A list of (inpath, outpath) tuples.
+    :param informat: The input format.
+    :param author: The author (optional).
+    :param preprocess: The preprocessing steps (optional).
+    :param io_threads: The number of concurrent reads and of concurrent
+    writes.
+    :param queue_size: The maximum number of files waiting in front of the
+    conversion and of the write stage.
+    :param out_format: The output format.
+    :param dedupe: A Deduplicator (optional), duplicates are not written.
+    :param manifest: A Manifest (optional), the written files are added.
+    :param journal: A Journal (optional), completed inputs are logged.
+    :return: A list of (inpath, error message) tuples of failed conversions.
+    """
+    return asyncio.run(_async_pipeline(files, informat, author, preprocess,
+                                       io_threads, queue_size, out_format,
+                                       dedupe, manifest, journal))
+
+
+async def _async_pipeline(files: list, informat: str, author, preprocess,
+                          io_threads: int, queue_size: int, out_format: str,
+                          dedupe, manifest, journal):
+    """
+    The pipeline of async_json2graph.
+
+    :return: A list of (inpath, error message) tuples of failed conversions.
+    """
+    loop = asyncio.get_event_loop()
+    pending = asyncio.Queue()
+    for index, (inpath, outpath) in enumerate(files):
+        pending.put_nowait((index, inpath, outpath))
+    read_queue = asyncio.Queue(queue_size)
+    write_queue = asyncio.Queue(queue_size)
+    failures = []
+
+    def fail(index, inpath, e):
+        failures.append((index, inpath, type(e).__name__ + ": " + str(e)))
+
+    async def read(executor):
+        while not pending.empty():
+            index, inpath, outpath = pending.get_nowait()
+            try:
+                data = await loop.run_in_executor(executor, _read_bytes,
+                                                  inpath)
+            except Exception as e:
+                fail(index, inpath, e)
+                continue
+            await read_queue.put((index, inpath, outpath, data))
+
+    async def convert():
+        while True:
+            item = await read_queue.get()
+            if item is None:
+                break
+            index, inpath, outpath, data = item
+            print("Converting ", inpath, "to", outpath)
+            try:
+                graph = Graph.parse_graph(data, inpath, informat)
+                graph = graph.preprocessing(preprocess)
+            except Exception as e:
+                fail(index, inpath, e)
+                continue
+            finally:
+                del data, item
+            if dedupe is not None:
+                original = dedupe.check(graph, inpath)
+                if original is not None:
+                    print("Skipping ", inpath, "(duplicate of",
+                          original + ")")
+                    if journal is not None:
+                        journal.add(inpath)
+                    continue
+            await write_queue.put((index, inpath, outpath, graph))
+            # Let the loop hand finished reads and writes to the other stages.
+            await asyncio.sleep(0)
+
+    async def write(executor):
+        while True:
+            item = await write_queue.get()
+            if item is None:
+                break
+            index, inpath, outpath, graph = item
+            try:
+                await loop.run_in_executor(executor, graph.write, outpath,
+                                           author, out_format)
+                if manifest is not None:
+                    manifest.add(Manifest.get_entry(outpath, inpath, graph,
+                                                    preprocess))
+                if journal is not None:
+                    journal.add(inpath)
+            except Exception as e:
+                fail(index, inpath, e)
+
+    with ThreadPoolExecutor(max_workers=io_threads) as read_executor, \
+            ThreadPoolExecutor(max_workers=io_threads) as write_executor:
+        readers = [loop.create_task(read(read_executor))
+                   for _ in range(io_threads)]
+        converter = loop.create_task(convert())
+        writers = [loop.create_task(write(write_executor))
+                   for _ in range(io_threads)]
+        await asyncio.gather(*readers)
+        await read_queue.put(None)
+        await converter
+        for _ in writers:
+            await write_queue.put(None)
+        await asyncio.gather(*writers)
+    return [(inpath, error) for _, inpath, error in sorted(failures)]
+
+
+class DirectoryWatcher:
+    """
+    Waits for changes of the files in a directory. On Linux inotify is used
+    (through ctypes), other systems fall back to polling.
+    """
+
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO
+    INOTIFY_MASK = 0x2 | 0x8 | 0x80
+    INOTIFY_OVERFLOW = 0x4000
+    INOTIFY_EVENT = struct.Struct("iIII")
+
+    def __init__(self, path: str, poll_interval=2.0):
+        """
+        Start watching a directory.
+
+        :param path: The directory.
+        :param poll_interval: The interval between two scans when polling.
+        """
+        self.path = path
+        self.poll_interval = poll_interval
+        self._fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                if libc.inotify_add_watch(fd, os.fsencode(path),
+                                          DirectoryWatcher.INOTIFY_MASK) < 0:
+                    os.close(fd)
+                else:
+                    self._fd = fd
+        except (OSError, AttributeError, TypeError):
+            pass
+
+    @property
+    def uses_inotify(self):
+        """
+        Whether inotify is used.
+        """
+        return self._fd is not None
+
+    def wait(self, timeout=None):
+        """
+        Wait for changes.
+
+        :param timeout: The maximum time to wait in seconds (None: wait for the
+        next change or poll interval).
+        :return: A set of changed file names, or None if the whole directory
+        has to be scanned.
+        """
+        if self._fd is None:
+            time.sleep(self.poll_interval if timeout is None
+                       else min(timeout, self.poll_interval))
+            return None
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        names = set()
+        while readable:
+            try:
+                data = os.read(self._fd, 1 << 16)
+            except BlockingIOError:
+                break
+            position = 0
+            while position < len(data):
+                _, mask, _, length = DirectoryWatcher.INOTIFY_EVENT\
+                    .unpack_from(data, position)
+                position += DirectoryWatcher.INOTIFY_EVENT.size
+                if mask & DirectoryWatcher.INOTIFY_OVERFLOW:
+                    return None
+                name = data[position:position + length].rstrip(b"\0")
+                position += length
+                if name:
+                    names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def watch_directory(inpath: str, outpath: str, informat: str, author=None,
+                    preprocess=None, force=False, state_path=None,
+                    debounce=1.0, poll_interval=2.0, cache=None,
+                    out_format="graph", iterations=None, manifest=None,
+                    compression=None):
+    """
+    Watch a directory and convert new or modified input files to the output
+    path, like the -O mode. A file is converted once it did not change for
+    the debounce time. Converted files are recorded in a state file, so
+    a restart will only convert files that changed in the meantime.
+
+    :param inpath: The input directory.
+    :param outpath: The output directory.
+    :param informat: The input format.
+    :param author: The author (optional).
+    :param preprocess: The preprocessing steps (optional).
+    :param force: Overwrite existing output files of unknown inputs.
+    :param state_path: The state file (default: in the output directory).
+    :param debounce: The time in seconds a file has to be unchanged.
+    :param poll_interval: The interval between scans without inotify.
+    :param cache: A ConversionCache (optional).
+    :param out_format: The output format.
+    :param iterations: Stop after this many rounds (default: run forever).
+    :param manifest: A Manifest (optional), the written files are added.
+    :param compression: The compression of the output files (optional).
+    """
+    if state_path is None:
+        state_path = os.path.join(outpath, ".json2graph-watch-state.json")
+    settings = [informat, author, preprocess or [], out_format]
+    if compression:
+        settings += [compression]
+    converted = dict()
+    if os.path.exists(state_path):
+        with open(state_path, "r") as state_file:
+            state = json.load(state_file)
+        if state.get("settings") == settings:
+            converted = state["files"]
+        else:
+            sys.stderr.write("Warning: Settings changed, converting all "
+                             "files again\n")
+
+    def save_state():
+        temp = state_path + ".tmp"
+        with open(temp, "w") as state_file:
+            json.dump({"settings": settings, "files": converted}, state_file)
+        os.replace(temp, state_path)
+
+    def signature(name):
+        try:
+            stat = os.stat(os.path.join(inpath, name))
+        except FileNotFoundError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def is_input(name):
+        try:
+            Graph.detect_format(name, informat)
+        except Exception:
+            return False
+        return not name.startswith(".")
+
+    pending = dict()
+    watcher = DirectoryWatcher(inpath, poll_interval)
+    print("Watching", inpath, "using",
+          "inotify" if watcher.uses_inotify else "polling")
+    names = None
+    iteration = 0
+    try:
+        while iterations is None or iteration < iterations:
+            iteration += 1
+            if names is None:
+                names = [entry.name for entry in os.scandir(inpath)
+                         if entry.is_file()]
+            now = time.monotonic()
+            for name in names:
+                if not is_input(name):
+                    continue
+                current = signature(name)
+                if current is None or converted.get(name) == current:
+                    pending.pop(name, None)
+                elif name not in pending or pending[name][0] != current:
+                    pending[name] = (current, now)
+            for name, (current, changed) in list(pending.items()):
+                if now - changed < debounce:
+                    continue
+                del pending[name]
+                if signature(name) != current:
+                    # Changed again, handled in the next round.
+                    continue
+                next_outfile = os.path.join(
+                    outpath, strip_compression_suffix(name)
+                    + get_output_suffix(out_format, compression))
+                if name not in converted and \
+                        os.path.exists(next_outfile) and not force:
+                    sys.stderr.write("Error: File already exists: "
+                                     + next_outfile + "\n")
+                else:
+                    try:
+                        json2graph(os.path.join(inpath, name), next_outfile,
+                                   informat, author, preprocess, cache,
+                                   out_format, manifest=manifest)
+                    except Exception as e:
+                        sys.stderr.write("Error: Failed to convert " + name
+                                         + ": " + str(e) + "\n")
+                # Failed files are only retried after they are modified.
+                converted[name] = current
+                save_state()
+            if iterations is not None and iteration >= iterations:
+                break
+            timeout = None
+            if pending:
+                timeout = max(0.0, min(changed for _, changed in
+                                       pending.values())
+                              + debounce - time.monotonic())
+            changes = watcher.wait(timeout)
+            names = None if changes is None else \
+                list(changes.union(pending))
+    finally:
+        watcher.close()
+
+
+class GraphCache:
+    """
+    Keeps parsed input graphs in memory, for the server mode. The graphs are
+    keyed by path, modification time, size and input format, so a changed
+    file is parsed again. The least recently used graphs are dropped when the
+    estimated size of all graphs exceeds the limit. Callers get shallow
+    copies, so preprocessing does not change the cached graphs.
+    """
+
+    def __init__(self, max_size=1 << 28):
+        """
+        Create a new empty cache.
+
+        :param max_size: The maximum estimated size of all graphs in bytes.
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self._keys = dict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_size(graph: Graph):
+        """
+        Estimate the memory used by a graph (lists, tuples and strings).
+        Strings shared between tuples are counted every time.
+
+        :param graph: The graph.
+        :return: The size in bytes.
+        """
+        size = sys.getsizeof(graph.vertices) + sys.getsizeof(graph.edges)
+        for elements in graph.vertices, graph.edges:
+            size += sum(map(sys.getsizeof, elements))
+            size += sum(map(sys.getsizeof,
+                            itertools.chain.from_iterable(elements)))
+        return size
+
+    def read_graph(self, in_path: str, in_format="auto"):
+        """
+        Read a graph, see Graph.read_graph, using the cache.
+
+        :param in_path: The path of the input file.
+        :param in_format: The input format.
+        :return: A shallow copy of the graph.
+        """
+        stat = os.stat(in_path)
+        path = os.path.abspath(in_path)
+        key = (path, stat.st_mtime_ns, stat.st_size, in_format)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0].shallow_copy()
+        self.misses += 1
+        graph = Graph.read_graph(in_path, in_format)
+        old_key = self._keys.pop(path, None)
+        if old_key is not None:
+            self.size -= self.entries.pop(old_key)[1]
+        size = GraphCache.get_size(graph)
+        if size <= self.max_size:
+            self.entries[key] = (graph, size)
+            self._keys[path] = key
+            self.size += size
+            while self.size > self.max_size:
+                old_key, (_, old_size) = self.entries.popitem(last=False)
+                del self._keys[old_key[0]]
+                self.size -= old_size
+        return graph.shallow_copy()
+
+
+def get_default_socket():
+    """
+    Get the default socket path of the server mode, $JSON2GRAPH_SOCKET or a
+    socket of the current user in the temporary directory.
+
+    :return: The path.
+    """
+    return os.environ.get("JSON2GRAPH_SOCKET") or os.path.join(
+        tempfile.gettempdir(), "json2graph-" + str(os.getuid()) + ".sock")
+
+
+class ConversionServer:
+    """
+    A server running json2graph for clients (see json2graph-client.py), so
+    the interpreter, the modules and the parsed input graphs stay in memory.
+    It listens on a Unix socket and handles one request at a time. A request
+    is a JSON line {"argv": [...], "cwd": "..."} with the command line
+    arguments of json2graph and the working directory of the client, the
+    reply is a JSON line {"exit_code": ..., "stdout": "...", "stderr": "..."}.
+    A line that is not a JSON object is answered with an error reply. The
+    request {"stop": true} stops the server.
+    """
+
+    def __init__(self, path: str, graph_cache=None):
+        """
+        Create a new server listening on a Unix socket. A stale socket file
+        is replaced.
+
+        :param path: The path of the socket.
+        :param graph_cache: The GraphCache (optional, default: 256 MB).
+        """
+        self.path = path
+        self.graph_cache = graph_cache if graph_cache is not None \
+            else GraphCache()
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.remove(path)
+            else:
+                raise Exception("Server already running: " + path)
+            finally:
+                probe.close()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        os.chmod(path, 0o600)
+        self.socket.listen(8)
+
+    def handle(self, request: dict):
+        """
+        Run json2graph for a request.
+
+        :param request: The request.
+        :return: The reply.
+        """
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        cwd = os.getcwd()
+        try:
+            with contextlib.redirect_stdout(stdout), \
+                    contextlib.redirect_stderr(stderr):
+                try:
+                    os.chdir(request.get("cwd", cwd))
+                    exit_code = main(request["argv"], self.graph_cache)
+                except SystemExit as e:
+                    exit_code = e.code if isinstance(e.code, int) \
+                        else int(e.code is not None)
+                    if isinstance(e.code, str):
+                        stderr.write(e.code + "\n")
+                except Exception as e:
+                    stderr.write("Error: " + type(e).__name__ + ": "
+                                 + str(e) + "\n")
+                    exit_code = 1
+        finally:
+            os.chdir(cwd)
+        return {"exit_code": exit_code, "stdout": stdout.getvalue(),
+                "stderr": stderr.getvalue()}
+
+    def serve(self):
+        """
+        Handle requests until a stop request is received.
+
+        :return: Nothing.
+        """
+        while True:
+            connection, _ = self.socket.accept()
+            with connection, connection.makefile("rwb") as stream:
+                try:
+                    request = json.loads(stream.readline().decode("utf-8"))
+                except ValueError:
+                    request = None
+                if not isinstance(request, dict):
+                    reply = {"exit_code": 1, "stdout": "",
+                             "stderr": "Error: Malformed request\n"}
+                elif request.get("stop"):
+                    stream.write(b'{"exit_code": 0}\n')
+                    return
+                else:
+                    reply = self.handle(request)
+                try:
+                    stream.write(json.dumps(reply).encode("utf-8") + b"\n")
+                    stream.flush()
+                except OSError:
+                    # The client is gone.
+                    pass
+
+    def close(self):
+        """
+        Stop listening and remove the socket.
+
+        :return: Nothing.
+        """
+        self.socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def print_banner():
+    """
+    Print the json2graph banner.
+
+    :return: Nothing.
+    """
+    if "TERM" in os.environ and "color" in os.environ["TERM"]:
+        print(r"""[38;5;93m    [38;5;99m   _[38;5;63m     [38;5;69m    [38;5;33m    [38;5;39m    _[38;5;38m__  [38;5;44m    [38;5;43m     [38;5;49m    [38;5;48m    [38;5;84m     [38;5;83m  __[38;5;119m
+[38;5;93m   [38;5;99m   (_[38;5;63m)___[38;5;69m____[38;5;33m_  __[38;5;39m__ |[38;5;38m__ \[38;5;44m ____[38;5;43m ___[38;5;49m_____[38;5;48m__ _[38;5;84m____[38;5;83m  / /[38;5;119m
+[38;5;93m   [38;5;99m  / [38;5;63m/ ___[38;5;69m/ __[38;5;33m \/ [38;5;39m__ \_[38;5;38m_/ /[38;5;44m/ __[38;5;43m `/ _[38;5;49m__/ [38;5;48m__ `[38;5;84m/ __ [38;5;83m\/ _[38;5;119m_ \
+[38;5;93m   [38;5;99m / ([38;5;63m__  [38;5;69m) /_/[38;5;33m / /[38;5;39m / /[38;5;38m __//[38;5;44m /_/[38;5;43m / /[38;5;49m  / /[38;5;48m_/ /[38;5;84m /_/[38;5;83m / / [38;5;119m/ /
+[38;5;93m _[38;5;99m_/ /[38;5;63m____/[38;5;69m\___[38;5;33m_/_/[38;5;39m /_/_[38;5;38m___/[38;5;44m\__, [38;5;43m/_/ [38;5;49m  \_[38;5;48m_,_/ [38;5;84m.___[38;5;83m/_/ [38;5;119m/_/
+[38;5;93m/_[38;5;99m__/ [38;5;63m    [38;5;69m     [38;5;33m    [38;5;39m    [38;5;38m    /[38;5;44m____[38;5;43m/   [38;5;49m     [38;5;48m  /_[38;5;84m/   [38;5;83m     [38;5;119m
+
+[0m""")
+    else:
+        print(r"""       _                 ___                          __
+      (_)________  ____ |__ \ ____ __________ _____  / /_
+     / / ___/ __ \/ __ \__/ // __ `/ ___/ __ `/ __ \/ __ \
+    / (__  ) /_/ / / / / __// /_/ / /  / /_/ / /_/ / / / /
+ __/ /____/\____/_/ /_/____/\__, /_/   \__,_/ .___/_/ /_/
+/___/                      /____/          /_/""")
+
+
+def main(argv=None, graph_cache=None):
+    """
+    Run json2graph with command line arguments.
+
+    :param argv: The arguments (default: sys.argv[1:]).
+    :param graph_cache: A GraphCache for the input graphs (optional, used by
+    the server mode).
+    :return: The exit code. Invalid arguments raise SystemExit.
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-f", "--force", help="Overwrite existing files.",
+                    action="store_true")
+    ap_out_selection = ap.add_mutually_exclusive_group(required=True)
+    ap_out_selection.add_argument("-o", "--output", help="Output file")
+    ap_out_selection.add_argument("-O", "--outpath", help="Output path")
+    ap_out_selection.add_argument(
+        "--serve", metavar="SOCKET", nargs="?", const=get_default_socket(),
+        help="Run as server for json2graph-client.py on the Unix socket "
+             "SOCKET (default: $JSON2GRAPH_SOCKET or " + get_default_socket()
+             + "), keeping parsed input files in memory.")
+    ap.add_argument("--graph-cache-size", type=int, metavar="MB", default=256,
+                    help="Maximum size of the input graphs kept in memory by "
+                         "--serve in MB (default: 256).")
+    ap.add_argument("-l", "--format", help="Input format (json, graph, "
+                                           "binary, auto)",
+                    default="auto")
+    ap.add_argument("--out-format", help="Output format (graph, binary)",
+                    choices=list(OUT_FORMAT_SUFFIXES), default="graph")
+    ap.add_argument("-z", "--compress", choices=COMPRESSION_FORMATS,
+                    help="Compress the output files of -O (the suffix is "
+                         "appended). Compressed inputs are detected "
+                         "automatically.")
+    ap.add_argument("-a", "--author", help="Author", default="Egal.",
+                    required=False)
+    ap.add_argument("-A", "--no-author", help="Do not write the author.",
+                    action="store_true")
+    ap.add_argument("-P", "--preprocess", nargs="+", metavar="STEP",
+                    help="Run a preprocessing step ("
+                         + Preprocessing.names() + ")")
+    ap.add_argument("-V", "--variant", action="append", metavar="NAME=STEPS",
+                    help="Write a variant with the comma-separated "
+                         "preprocessing steps to the subdirectory NAME of "
+                         "the output path (can be given multiple times, "
+                         "requires -O). Every input is read once.")
+    ap.add_argument("--lazy", action="store_true",
+                    help="Run the preprocessing steps on a lazy view of the "
+                         "input graph instead of building a new graph for "
+                         "every step (lower peak memory).")
+    ap.add_argument("--out-of-core", action="store_true",
+                    help="Keep only the vertices of .graph inputs in memory "
+                         "and stream the edges from disk (for graphs larger "
+                         "than the memory).")
+    ap.add_argument("-M", "--multi", help="Write every compound of a JSON "
+                                          "input to its own file (requires "
+                                          "-O).", action="store_true")
+    ap.add_argument("-j", "--jobs", type=int, metavar="N",
+                    help="Convert multiple files using N worker processes.")
+    ap.add_argument("-B", "--batch", dest="batch_size", type=int, metavar="N",
+                    help="Preprocess N graphs at once in a packed batch "
+                         "(with -O).")
+    ap.add_argument("--async", dest="async_io", type=int, metavar="N",
+                    help="Convert multiple files in a pipeline with N "
+                         "threads each for reading and writing, overlapping "
+                         "I/O with the conversion.")
+    ap.add_argument("--dedupe", action="store_true",
+                    help="Do not write graphs that are isomorphic to an "
+                         "earlier graph (after preprocessing). The skipped "
+                         "inputs are listed in duplicates.json in the "
+                         "output path.")
+    ap.add_argument("--shard", action="store_true",
+                    help="Write the output files to 256 hashed "
+                         "subdirectories of the output path.")
+    ap.add_argument("--resume", action="store_true",
+                    help="Log completed inputs in " + Journal.FILE_NAME
+                         + " in the output path and skip them when run "
+                           "again. Existing output files of other inputs "
+                           "are overwritten.")
+    ap.add_argument("--manifest", action="store_true",
+                    help="Record the converted graphs in the index "
+                         + Manifest.FILE_NAME + " in the output path "
+                         "(requires -O).")
+    ap.add_argument("--cache", metavar="DIR",
+                    help="Cache converted files in DIR.")
+    ap.add_argument("--cache-size", type=int, metavar="MB", default=1024,
+                    help="Maximum size of the cache in MB (default: 1024).")
+    ap.add_argument("--cache-link", action="store_true",
+                    help="Hardlink cached files instead of copying them.")
+    ap.add_argument("--profile", metavar="REPORT",
+                    help="Write time, memory and size of every stage to "
+                         "REPORT (JSON lines).")
+    ap.add_argument("-W", "--watch", metavar="DIR",
+                    help="Watch DIR and convert new or modified files "
+                         "(requires -O).")
+    ap.add_argument("--state", metavar="FILE",
+                    help="State file of the watch mode (default: in the "
+                         "output path).")
+    ap.add_argument("--debounce", type=float, default=1.0, metavar="SEC",
+                    help="Convert files in watch mode after they did not "
+                         "change for SEC seconds (default: 1).")
+    ap.add_argument("input", metavar="INFILE", nargs="*", help="Input file(s)")
+    args = ap.parse_args(argv)
+    if args.serve:
+        if graph_cache is not None:
+            sys.stderr.write("--serve cannot be used by a client\n")
+            return 1
+        server = ConversionServer(args.serve,
+                                  GraphCache(args.graph_cache_size << 20))
+        sys.stderr.write("Listening on " + args.serve + "\n")
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+        return 0
+    if args.watch and graph_cache is not None:
+        sys.stderr.write("--watch is not supported by the server\n")
+        return 1
+    new_author = args.author
+    if args.no_author:
+        new_author = None
+    infiles = args.input
+    exit_code = 0
+    cache = None
+    if args.cache:
+        cache = ConversionCache(args.cache, args.cache_size << 20,
+                                args.cache_link)
+    if args.async_io and (args.jobs or cache is not None or args.profile):
+        sys.stderr.write("--async cannot be combined with -j, --cache or "
+                         "--profile\n")
+        return 1
+    pipelines = None
+    if args.variant:
+        pipelines = OrderedDict()
+        for variant in args.variant:
+            name, _, steps = variant.partition("=")
+            pipelines[name] = [step for step in steps.split(",") if step]
+            for step in pipelines[name]:
+                Preprocessing.get(step)
+        if args.preprocess or not args.outpath or args.multi or args.jobs \
+                or args.async_io or args.batch_size or cache is not None \
+                or args.dedupe or args.watch:
+            sys.stderr.write("--variant requires -O and cannot be combined "
+                             "with -P, -M, -j, --async, --batch, --cache, "
+                             "--dedupe or --watch\n")
+            return 1
+    if args.lazy and (args.jobs or args.async_io or args.batch_size
+                      or args.multi or args.variant or args.watch):
+        sys.stderr.write("--lazy cannot be combined with -j, --async, "
+                         "--batch, -M, --variant or --watch\n")
+        return 1
+    if args.out_of_core and (args.jobs or args.async_io or args.batch_size
+                             or args.multi or args.variant or args.watch
+                             or args.lazy or args.dedupe
+                             or args.out_format != "graph"):
+        sys.stderr.write("--out-of-core cannot be combined with -j, --async, "
+                         "--batch, -M, --variant, --watch, --lazy, --dedupe "
+                         "or --out-format binary\n")
+        return 1
+    if args.batch_size and (args.jobs or args.async_io or cache is not None
+                            or args.profile or args.watch):
+        sys.stderr.write("--batch cannot be combined with -j, --async, "
+                         "--cache, --profile or --watch\n")
+        return 1
+    dedupe = None
+    if args.dedupe:
+        if args.jobs or args.watch or not args.outpath:
+            sys.stderr.write("--dedupe requires -O and cannot be combined "
+                             "with -j or --watch\n")
+            return 1
+        dedupe = Deduplicator()
+    if args.manifest and not args.outpath:
+        sys.stderr.write("--manifest requires -O\n")
+        return 1
+    manifest = None
+    profiler = None
+    if args.profile:
+        profiler = Profiler(open(args.profile, "w"))
+    if args.watch:
+        if not args.outpath:
+            sys.stderr.write("Please use -O with --watch\n")
+            return 1
+        if not os.path.exists(args.outpath):
+            os.mkdir(args.outpath)
+        if args.manifest:
+            manifest = Manifest(args.outpath)
+        try:
+            watch_directory(args.watch, args.outpath, args.format, new_author,
+                            args.preprocess, args.force, args.state,
+                            args.debounce, cache=cache,
+                            out_format=args.out_format, manifest=manifest,
+                            compression=args.compress)
+        except KeyboardInterrupt:
+            pass
+    elif len(infiles) > 1 or (args.outpath and infiles):
+        if args.output:
+            sys.stderr.write("Please use -O when converting multiple input "
+                             "files\n")
+            return 1
+        assert args.outpath, "Output path not set. [-O]"
+        outpath = args.outpath
+        if not os.path.exists(outpath):
+            sys.stderr.write("Warning: Output path does not exist\n")
+            os.mkdir(outpath)
+        if args.manifest:
+            manifest = Manifest(outpath)
+        if args.shard:
+            create_shards(outpath)
+        for name in pipelines or []:
+            os.makedirs(os.path.join(outpath, name), exist_ok=True)
+            if args.shard:
+                create_shards(os.path.join(outpath, name))
+        journal = Journal(outpath) if args.resume else None
+        batch = []
+        for infile in infiles:
+            if journal is not None and infile in journal:
+                continue
+            if pipelines is not None:
+                outfiles = OrderedDict(
+                    (name, get_output_path(
+                        os.path.join(outpath, name),
+                        strip_compression_suffix(os.path.basename(infile))
+                        + get_output_suffix(args.out_format, args.compress),
+                        args.shard)) for name in pipelines)
+                existing = [outfile for outfile in outfiles.values()
+                            if os.path.exists(outfile)]
+                if journal is None and existing and not args.force:
+                    sys.stderr.write("Error: File already exists: "
+                                     + existing[0] + "\n")
+                    continue
+                json2graph_variants(infile, outfiles, args.format, pipelines,
+                                    new_author, args.out_format, manifest,
+                                    profiler)
+                if journal is not None:
+                    journal.add(infile)
+                continue
+            if args.multi:
+                json2graph_multi(infile, outpath, new_author, args.preprocess,
+                                 args.force or journal is not None,
+                                 args.out_format, dedupe, manifest,
+                                 args.shard, args.compress, args.batch_size,
+                                 profiler)
+                if journal is not None:
+                    journal.add(infile)
+                continue
+            next_outfile = get_output_path(
+                outpath, strip_compression_suffix(os.path.basename(infile))
+                + get_output_suffix(args.out_format, args.compress),
+                args.shard)
+            if journal is None and os.path.exists(next_outfile) \
+                    and not args.force:
+                sys.stderr.write("Error: File already exists: " + next_outfile
+                                 + "\n")
+                continue
+            if args.jobs or args.async_io or args.batch_size:
+                batch += [(infile, next_outfile)]
+            else:
+                json2graph(infile, next_outfile, args.format,
+                           new_author, args.preprocess, cache,
+                           args.out_format, profiler, dedupe, manifest,
+                           args.lazy, graph_cache, args.out_of_core)
+                if journal is not None:
+                    journal.add(infile)
+        if args.batch_size:
+            def read_batch():
+                for infile, next_outfile in batch:
+                    print("Converting ", infile, "to", next_outfile)
+                    yield infile, Graph.read_graph(infile, args.format), \
+                        next_outfile
+
+            convert_batched(read_batch(), new_author, args.preprocess,
+                            args.out_format, args.batch_size, dedupe,
+                            manifest, journal)
+        elif args.jobs or args.async_io:
+            if args.async_io:
+                failed = async_json2graph(batch, args.format, new_author,
+                                          args.preprocess, args.async_io,
+                                          out_format=args.out_format,
+                                          dedupe=dedupe, manifest=manifest,
+                                          journal=journal)
+            else:
+                failed = batch_json2graph(batch, args.format, new_author,
+                                          args.preprocess, args.jobs, cache,
+                                          args.out_format, profiler, manifest,
+                                          journal)
+            for failed_file, error in failed:
+                sys.stderr.write("Error: Failed to convert " + failed_file
+                                 + ": " + error + "\n")
+            if failed:
+                sys.stderr.write(str(len(failed)) + " of " + str(len(batch))
+                                 + " files failed.\n")
+                exit_code = 1
+        if journal is not None:
+            journal.close()
+        if dedupe is not None:
+            dedupe.write(os.path.join(outpath, "duplicates.json"))
+            sys.stderr.write(str(len(dedupe.duplicates))
+                             + " duplicates skipped.\n")
+    elif len(infiles) == 0:
+        sys.stderr.write("Error: No input files.\n")
+        exit_code = 1
+    elif len(infiles) == 1:
+        if args.multi:
+            sys.stderr.write("Please use -O when converting multiple "
+                             "compounds\n")
+            return 1
+        assert args.output, "No output file given. [-o]"
+        json2graph(infiles[0], args.output, args.format, new_author,
+                   args.preprocess, cache, args.out_format, profiler,
+                   lazy=args.lazy, graph_cache=graph_cache,
+                   out_of_core=args.out_of_core)
+    if manifest is not None:
+        manifest.close()
+    if profiler is not None:
+        profiler.report.close()
+        sys.stderr.write(profiler.summary())
+    if cache is not None:
+        sys.stderr.write("Cache: " + str(cache.hits) + " hits, "
+                         + str(cache.misses) + " misses\n")
+    return exit_code
+
+
+if __name__ == '__main__':
+    print_banner()
+    exit(main())
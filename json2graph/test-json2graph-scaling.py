@@ -0,0 +1,282 @@
+import contextlib
+import gc
+import importlib.util
+import io
+import math
+import os
+import tempfile
+import time
+import unittest
+import json2graph as j2g
+
+# The generators of the benchmark script (not importable by name).
+_spec = importlib.util.spec_from_file_location(
+    "bench_json2graph",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 "bench-json2graph.py"))
+bench = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(bench)
+
+# The numbers of atoms of the generated inputs.
+SIZES = [2500, 5000, 10000, 20000, 40000]
+# Runs per size, the best run is used.
+REPEAT = 3
+# The growth exponent may exceed the one of n log n by this much. Caches
+# and timer noise make linear operations look like n^1.1 to n^1.4.
+MARGIN = 0.5
+
+
+def fit_exponent(sizes: list, seconds: list):
+    """
+    Fit the exponent k of t = c * n^k by least squares on log-log scale.
+
+    :param sizes: The input sizes n.
+    :param seconds: The measured times t.
+    :return: The exponent.
+    """
+    xs = [math.log(n) for n in sizes]
+    ys = [math.log(max(t, 1e-9)) for t in seconds]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    return sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) \
+        / sum((x - x_mean) ** 2 for x in xs)
+
+
+def get_limit(sizes: list):
+    """
+    Get the largest accepted exponent, the exponent of n log n over the
+    sizes plus the margin.
+
+    :param sizes: The input sizes.
+    :return: The exponent.
+    """
+    return fit_exponent(sizes, [n * math.log(n) for n in sizes]) + MARGIN
+
+
+def measure(setup, operation):
+    """
+    Measure the best time of an operation.
+
+    :param setup: A function preparing the argument of the operation (not
+    measured).
+    :param operation: The operation, called with the result of setup.
+    :return: The best time in seconds.
+    """
+    best = None
+    for _ in range(REPEAT):
+        argument = setup()
+        gc.collect()
+        start = time.perf_counter()
+        operation(argument)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+_molecules = dict()
+_aligned = dict()
+
+
+def get_molecule(atoms: int):
+    """
+    Get a generated molecule as graph (cached, copy before changing it).
+
+    :param atoms: The number of atoms.
+    :return: The graph.
+    """
+    if atoms not in _molecules:
+        elements, bonds = bench.generate_molecule(atoms)
+        _molecules[atoms] = j2g.Graph(
+            [(str(aid), str(e)) for aid, e in enumerate(elements, 1)],
+            [(str(b[0]), str(b[1]), str(b[2])) for b in bonds])
+    return _molecules[atoms]
+
+
+def get_aligned(atoms: int):
+    """
+    Get a generated aligned graph (cached, copy before changing it).
+
+    :param atoms: The number of vertices.
+    :return: The graph.
+    """
+    if atoms not in _aligned:
+        _aligned[atoms] = bench.generate_aligned_graph(atoms)
+    return _aligned[atoms]
+
+
+class ScalingTestCase(unittest.TestCase):
+    def assertScaling(self, name: str, setup, operation):
+        """
+        Assert that an operation grows at most like n log n.
+
+        :param name: The name of the operation.
+        :param setup: A function of the size preparing the argument of the
+        operation.
+        :param operation: The operation.
+        :return: Nothing.
+        """
+        seconds = [measure(lambda: setup(n), operation) for n in SIZES]
+        exponent = fit_exponent(SIZES, seconds)
+        self.assertLessEqual(
+            exponent, get_limit(SIZES),
+            "%s grows like n^%.2f: %s" % (
+                name, exponent, ", ".join("%d: %.4f s" % (n, t) for n, t
+                                          in zip(SIZES, seconds))))
+
+    def test_fit_exponent(self):
+        """
+        Test that the fit finds the exponent of exact power laws and that
+        n log n is accepted and n^2 is not.
+
+        :return: Nothing.
+        """
+        self.assertAlmostEqual(
+            2.0, fit_exponent(SIZES, [3 * n ** 2 for n in SIZES]))
+        self.assertAlmostEqual(
+            1.0, fit_exponent(SIZES, [n / 7 for n in SIZES]))
+        self.assertLessEqual(
+            fit_exponent(SIZES, [n * math.log(n) for n in SIZES]),
+            get_limit(SIZES))
+        self.assertGreater(fit_exponent(SIZES, [n ** 2 for n in SIZES]),
+                           get_limit(SIZES))
+
+    def test_indices(self):
+        """
+        Test building the adjacency and vertex indices.
+
+        :return: Nothing.
+        """
+        self.assertScaling("get_adjacency",
+                           lambda n: get_molecule(n).copy(),
+                           lambda g: g.get_adjacency())
+        self.assertScaling("get_vertex_index",
+                           lambda n: get_molecule(n).copy(),
+                           lambda g: g.get_vertex_index())
+
+    def test_neighbors(self):
+        """
+        Test get_neighbors_of, degree and have_neighbors_multibonds for all
+        vertices.
+
+        :return: Nothing.
+        """
+        self.assertScaling("get_neighbors_of",
+                           lambda n: get_molecule(n).copy(),
+                           lambda g: [g.get_neighbors_of(v)
+                                      for v in g.vertices])
+        self.assertScaling("degree",
+                           lambda n: get_molecule(n).copy(),
+                           lambda g: [g.degree(v) for v in g.vertices])
+        self.assertScaling("have_neighbors_multibonds",
+                           lambda n: get_molecule(n).copy(),
+                           lambda g: [g.have_neighbors_multibonds(v)
+                                      for v in g.vertices])
+
+    def test_subgraphs(self):
+        """
+        Test filter_vertices, induced_subgraph, compress_ch3 and copy.
+
+        :return: Nothing.
+        """
+        self.assertScaling("filter_vertices",
+                           lambda n: get_molecule(n).copy(),
+                           lambda g: g.filter_vertices(lambda v: v[1] != "1"))
+
+        def without_hydrogen(n):
+            g = get_molecule(n).copy()
+            g.get_adjacency()
+            g.vertices = [v for v in g.vertices if v[1] != "1"]
+            return g
+
+        self.assertScaling("induced_subgraph", without_hydrogen,
+                           lambda g: g.induced_subgraph())
+        self.assertScaling("compress_ch3",
+                           lambda n: get_molecule(n).copy(),
+                           lambda g: g.compress_ch3())
+        self.assertScaling("copy", get_molecule, lambda g: g.copy())
+
+    def test_consensus(self):
+        """
+        Test get_consesus on aligned graphs.
+
+        :return: Nothing.
+        """
+        self.assertScaling("get_consesus",
+                           lambda n: get_aligned(n).copy(),
+                           lambda g: g.get_consesus())
+
+    def test_hashing(self):
+        """
+        Test the Weisfeiler-Lehman colors, the canonical hash and the
+        isomorphism test.
+
+        :return: Nothing.
+        """
+        self.assertScaling("get_wl_colors",
+                           lambda n: get_molecule(n).copy(),
+                           lambda g: g.get_wl_colors())
+        self.assertScaling("canonical_hash",
+                           lambda n: get_molecule(n).copy(),
+                           lambda g: g.canonical_hash())
+        self.assertScaling("is_isomorphic",
+                           lambda n: (get_molecule(n).copy(),
+                                      get_molecule(n).copy()),
+                           lambda graphs: graphs[0].is_isomorphic(graphs[1]))
+
+    def test_preprocessing(self):
+        """
+        Test every preprocessing step, with and without NumPy.
+
+        :return: Nothing.
+        """
+        numpy = j2g.numpy
+        try:
+            for use_numpy in sorted({False, numpy is not None}):
+                j2g.numpy = numpy if use_numpy else None
+                for step in j2g.Preprocessing:
+                    source = get_aligned \
+                        if step == j2g.Preprocessing.GET_CONSENSUS \
+                        else get_molecule
+                    with self.subTest(step=step.value, numpy=use_numpy):
+                        self.assertScaling(
+                            "preprocessing " + step.value,
+                            lambda n: source(n).copy(),
+                            lambda g: g.preprocessing([step.value]))
+        finally:
+            j2g.numpy = numpy
+
+    def test_read_write(self):
+        """
+        Test writing and reading .graph and JSON files.
+
+        :return: Nothing.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            def path(n, suffix):
+                return os.path.join(tmp, str(n) + suffix)
+
+            def write(n):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    get_molecule(n).write(path(n, ".graph"))
+                bench.write_pubchem_json(path(n, ".json"),
+                                         *bench.generate_molecule(n))
+                return n
+
+            for n in SIZES:
+                write(n)
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertScaling("write",
+                                   lambda n: (get_molecule(n),
+                                              path(n, ".out")),
+                                   lambda args: args[0].write(args[1]))
+            self.assertScaling("read_graph_graph",
+                               lambda n: path(n, ".graph"),
+                               j2g.Graph.read_graph_graph)
+            self.assertScaling("read_graph_json",
+                               lambda n: path(n, ".json"),
+                               j2g.Graph.read_graph_json)
+
+
+if __name__ == '__main__':
+    unittest.main()
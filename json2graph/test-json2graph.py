@@ -1,7 +1,30 @@
+import json
+import os
+import socket
+import tempfile
+import threading
 import unittest
 import json2graph as j2g
 
 
+def write_compound_json(path, elements, bonds):
+    """
+    Write a minimal PubChem JSON file.
+
+    :param path: The output path.
+    :param elements: The element numbers of the atoms.
+    :param bonds: The bonds as tuples of (aid1, aid2, order).
+    :return: Nothing.
+    """
+    with open(path, "w") as file:
+        json.dump({"PC_Compounds": [{
+            "atoms": {"aid": list(range(1, len(elements) + 1)),
+                      "element": elements},
+            "bonds": {"aid1": [b[0] for b in bonds],
+                      "aid2": [b[1] for b in bonds],
+                      "order": [b[2] for b in bonds]}}]}, file)
+
+
 class MyTestCase(unittest.TestCase):
     def test_get_neighbors_of(self):
         """
@@ -140,6 +163,30 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(graph.degree(deg_three), 3)
         self.assertEqual(graph.degree(cycle), 1)
 
+    def test_adjacency_after_filter(self):
+        """
+        Test that the adjacency index is kept up to date by filter_vertices
+        and that degree counts parallel and reversed edges like the edge list.
+
+        :return: Nothing.
+        """
+        vertices = [("a", "6"), ("b", "1"), ("c", "8")]
+        edges = [("a", "b", "1"), ("a", "c", "2")]
+        graph = j2g.Graph(vertices, edges)
+        self.assertEqual(graph.degree(("a", "6")), 2)
+        graph.filter_vertices(lambda x: x[1] != "1")
+        self.assertEqual(graph.degree(("a", "6")), 1)
+        self.assertListEqual(graph.get_neighbors_of(("a", "6")),
+                             [(("c", "8"), "2")])
+        self.assertDictEqual(graph.get_adjacency(),
+                             {"a": [("c", "2")], "c": [("a", "2")]})
+        graph = j2g.Graph(vertices, [("a", "b", "1"), ("b", "a", "1"),
+                                     ("a", "b", "1"), ("a", "b", "2"),
+                                     ("c", "c", "1"), ("c", "c", "1")])
+        self.assertEqual(graph.degree(("a", "6")), 3)
+        self.assertEqual(graph.degree(("b", "1")), 3)
+        self.assertEqual(graph.degree(("c", "8")), 1)
+
     def test_get_consensus(self):
         vertices = [
             ("1", "C C O"),
@@ -158,6 +205,755 @@ class MyTestCase(unittest.TestCase):
         graph = j2g.Graph(vertices, edges)
         self.assertListEqual(graph.get_consesus().vertices, expected_vertices)
 
+    def test_consensus_engine(self):
+        """
+        Test that the consensus engine keeps the tie-breaking of
+        consensus_label for a batch of graphs.
+
+        :return: Nothing.
+        """
+        first = j2g.Graph([("1", "C C O"), ("2", "O N N O"), ("3", "")], [])
+        second = j2g.Graph([("1", " 6 6"), ("2", "N  O  1")],
+                           [("1", "2", "1")])
+        engine = j2g.ConsensusEngine()
+        first, second = engine.get_consensus([first, second])
+        self.assertListEqual([("1", "C"), ("2", "O"), ("3", "0")],
+                             first.vertices)
+        self.assertListEqual([("1", "6"), ("2", "0")], second.vertices)
+        self.assertListEqual([("1", "2", "1")], second.edges)
+
+    def test_canonical_hash(self):
+        """
+        Test that isomorphic graphs have the same hash, that hash collisions
+        are resolved by the isomorphism check and that cached conversions are
+        deduplicated.
+
+        :return: Nothing.
+        """
+        graph = j2g.Graph([("1", "6"), ("2", "8"), ("3", "1")],
+                          [("1", "2", "2"), ("1", "3", "1")])
+        permuted = j2g.Graph([("c", "1"), ("a", "6"), ("b", "8")],
+                             [("c", "a", "1"), ("b", "a", "2")])
+        changed = j2g.Graph(graph.vertices, [("1", "2", "1"),
+                                             ("1", "3", "2")])
+        self.assertEqual(graph.canonical_hash(), permuted.canonical_hash())
+        self.assertTrue(graph.is_isomorphic(permuted))
+        self.assertNotEqual(graph.canonical_hash(), changed.canonical_hash())
+        self.assertFalse(graph.is_isomorphic(changed))
+        # A hexagon and two triangles cannot be distinguished by their hash.
+        vertices = [(str(i), "6") for i in range(6)]
+        hexagon = j2g.Graph(vertices, [(str(i), str((i + 1) % 6), "1")
+                                       for i in range(6)])
+        triangles = j2g.Graph(vertices, [
+            (str(i), str((i + 1) % 3 + i // 3 * 3), "1") for i in range(6)])
+        self.assertEqual(hexagon.canonical_hash(), triangles.canonical_hash())
+        dedupe = j2g.Deduplicator()
+        self.assertIsNone(dedupe.check(hexagon, "hexagon"))
+        self.assertIsNone(dedupe.check(triangles, "triangles"))
+        self.assertEqual("hexagon", dedupe.check(hexagon.copy(), "copy"))
+        self.assertDictEqual({"copy": "hexagon"}, dedupe.duplicates)
+        # Cached conversions are checked as well.
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = j2g.ConversionCache(os.path.join(tmp, "cache"))
+            for name, elements in ("a", [6, 8]), ("b", [6, 8]), ("c", [7, 8]):
+                write_compound_json(os.path.join(tmp, name + ".json"),
+                                    elements, [(1, 2, 2)])
+            for _ in range(2):
+                dedupe = j2g.Deduplicator()
+                for name in "abc":
+                    j2g.json2graph(os.path.join(tmp, name + ".json"),
+                                   os.path.join(tmp, name + ".graph"), "auto",
+                                   None, None, cache, dedupe=dedupe)
+                self.assertDictEqual({os.path.join(tmp, "b.json"):
+                                      os.path.join(tmp, "a.json")},
+                                     dedupe.duplicates)
+                self.assertListEqual([True, False, True], [
+                    os.path.exists(os.path.join(tmp, name + ".graph"))
+                    for name in "abc"])
+            self.assertEqual(4, cache.stats()["hits"])
+
+    def test_batch_json2graph(self):
+        """
+        Test that the parallel batch conversion matches the serial conversion
+        and reports failed files.
+
+        :return: Nothing.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            good = os.path.join(tmp, "good.json")
+            bad = os.path.join(tmp, "bad.json")
+            write_compound_json(good, [6, 1, 1, 1, 8],
+                                [(1, 2, 1), (1, 3, 1), (1, 4, 1), (1, 5, 2)])
+            with open(bad, "w") as file:
+                file.write("{")
+            serial = os.path.join(tmp, "serial.graph")
+            parallel = os.path.join(tmp, "parallel.graph")
+            j2g.json2graph(good, serial, "auto", "a", ["COMPRESS_CH3"])
+            failed = j2g.batch_json2graph(
+                [(good, parallel), (bad, os.path.join(tmp, "bad.graph"))],
+                "auto", "a", ["COMPRESS_CH3"], 2)
+            self.assertListEqual([bad], [f[0] for f in failed])
+            with open(serial) as expected, open(parallel) as actual:
+                self.assertEqual(expected.read(), actual.read())
+
+    def test_async_json2graph(self):
+        """
+        Test that the async pipeline writes the same files as the serial
+        conversion for all input formats and reports failed files.
+
+        :return: Nothing.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            good = os.path.join(tmp, "good.json")
+            bad = os.path.join(tmp, "bad.json")
+            write_compound_json(good, [6, 1, 1, 1, 8],
+                                [(1, 2, 1), (1, 3, 1), (1, 4, 1), (1, 5, 2)])
+            with open(bad, "w") as file:
+                file.write("{")
+            text = os.path.join(tmp, "good.graph")
+            binary = os.path.join(tmp, "good.bgraph")
+            j2g.json2graph(good, text, "auto", "a")
+            j2g.json2graph(good, binary, "auto", "a", out_format="binary")
+            for inpath in [good, text, binary]:
+                j2g.json2graph(inpath, inpath + ".serial", "auto", "a",
+                               ["COMPRESS_CH3"])
+            files = [(inpath, inpath + ".async")
+                     for inpath in [good, bad, text, binary]]
+            failed = j2g.async_json2graph(files, "auto", "a",
+                                          ["COMPRESS_CH3"], 2, 1)
+            self.assertListEqual([bad], [f[0] for f in failed])
+            for inpath in [good, text, binary]:
+                with open(inpath + ".serial") as expected, \
+                        open(inpath + ".async") as actual:
+                    self.assertEqual(expected.read(), actual.read())
+
+    def test_manifest(self):
+        """
+        Test that converted graphs are recorded in the manifest and can be
+        selected by counts, labels and steps.
+
+        :return: Nothing.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            methane = os.path.join(tmp, "methane.json")
+            water = os.path.join(tmp, "water.json")
+            write_compound_json(methane, [6, 1, 1, 1, 1],
+                                [(1, 2, 1), (1, 3, 1), (1, 4, 1), (1, 5, 1)])
+            write_compound_json(water, [8, 1, 1], [(1, 2, 1), (1, 3, 1)])
+            manifest = j2g.Manifest(tmp)
+            for inpath in [methane, water]:
+                j2g.json2graph(inpath, inpath + ".graph", "auto",
+                               manifest=manifest)
+            j2g.json2graph(water, water + ".graph", "auto", None,
+                           ["REMOVE_H_ALL"], manifest=manifest)
+            manifest.close()
+            manifest = j2g.Manifest(tmp)
+            self.assertEqual(2, len(manifest.query()))
+            entry = manifest.query(labels={"1": 4})[0]
+            self.assertEqual(methane, entry["source"])
+            self.assertEqual(methane + ".graph", entry["output"])
+            self.assertDictEqual({"6": 1, "1": 4}, entry["labels"])
+            self.assertEqual(os.path.getsize(methane + ".graph"),
+                             entry["size"])
+            self.assertListEqual([water], [e["source"] for e in manifest.query(
+                max_vertices=1, labels={"1": 0}, steps=["REMOVE_H_ALL"])])
+            self.assertListEqual([], manifest.query(min_edges=5))
+            manifest.close()
+
+    def test_journal(self):
+        """
+        Test that the journal survives an incomplete last line and that
+        sharded output paths are stable.
+
+        :return: Nothing.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = j2g.Journal(tmp)
+            journal.add("a.json")
+            journal.add(os.path.join(tmp, "b.json"))
+            journal.file.write('"c.js')
+            journal.close()
+            journal = j2g.Journal(tmp)
+            self.assertIn("a.json", journal)
+            self.assertIn(os.path.join(tmp, "b.json"), journal)
+            self.assertNotIn("c.json", journal)
+            journal.add("c.json")
+            journal.close()
+            journal = j2g.Journal(tmp)
+            self.assertIn("c.json", journal)
+            journal.close()
+            j2g.create_shards(tmp)
+            outpath = j2g.get_output_path(tmp, "a.json.graph", True)
+            self.assertEqual(outpath, j2g.get_output_path(tmp, "a.json.graph",
+                                                          True))
+            self.assertTrue(os.path.isdir(os.path.dirname(outpath)))
+            self.assertEqual(os.path.join(tmp, "a.json.graph"),
+                             j2g.get_output_path(tmp, "a.json.graph"))
+
+    def test_compressed_files(self):
+        """
+        Test that compressed inputs and outputs are handled transparently.
+
+        :return: Nothing.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            plain = os.path.join(tmp, "plain.json")
+            write_compound_json(plain, [6, 8, 1], [(1, 2, 2), (1, 3, 1)])
+            compressed = os.path.join(tmp, "compressed.json.gz")
+            with open(plain, "rb") as infile, \
+                    j2g.open_file(compressed, "wb") as outfile:
+                outfile.write(infile.read())
+            expected = j2g.Graph.read_graph(plain)
+            graph = j2g.Graph.read_graph(compressed)
+            self.assertListEqual(expected.vertices, graph.vertices)
+            self.assertListEqual(expected.edges, graph.edges)
+            self.assertEqual(1, len(list(
+                j2g.Graph.read_graphs_json(compressed))))
+            with open(compressed, "rb") as infile:
+                parsed = j2g.Graph.parse_graph(infile.read(), compressed)
+            self.assertListEqual(expected.vertices, parsed.vertices)
+            for suffix, out_format in [(".graph.xz", "graph"),
+                                       (".bgraph.bz2", "binary")]:
+                outpath = os.path.join(tmp, "out" + suffix)
+                graph.write(outpath, "a", out_format)
+                with open(outpath, "rb") as infile:
+                    self.assertNotIn(b"#nodes", infile.read())
+                written = j2g.Graph.read_graph(outpath)
+                self.assertListEqual(expected.edges, written.edges)
+                self.assertEqual("a", j2g.Graph.read_graph_header(
+                    outpath)["author"])
+
+    def test_read_graphs_json(self):
+        """
+        Test that the streaming reader returns every compound, even with a
+        chunk size smaller than a single compound.
+
+        :return: Nothing.
+        """
+        compounds = [{"id": {"id": {"cid": cid}},
+                      "atoms": {"aid": [1, 2], "element": [6, cid]},
+                      "bonds": {"aid1": [1], "aid2": [2], "order": [1]}}
+                     for cid in range(1, 5)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bulk.json")
+            with open(path, "w") as file:
+                json.dump({"PC_Compounds": compounds}, file, indent=1)
+            graphs = list(j2g.Graph.read_graphs_json(path, 7))
+        self.assertListEqual(["1", "2", "3", "4"], [g[0] for g in graphs])
+        self.assertListEqual([("1", "6"), ("2", "4")], graphs[3][1].vertices)
+        self.assertListEqual([("1", "2", "1")], graphs[3][1].edges)
+
+    def test_compact_graph(self):
+        """
+        Test the conversion to and from the compact graph representation,
+        including an edge to a vertex id that is not in the vertex list.
+
+        :return: Nothing.
+        """
+        vertices = [("1", "6"), ("2", "8"), ("3", "6")]
+        edges = [("1", "2", "2"), ("3", "1", "1"), ("3", "4", "1")]
+        compact = j2g.CompactGraph.from_graph(j2g.Graph(vertices, edges))
+        self.assertEqual(3, compact.vertex_count)
+        self.assertEqual(3, compact.edge_count)
+        self.assertListEqual(["1", "6", "2", "8", "3", "4"], compact.labels)
+        self.assertListEqual([(1, 2), (2, 0)], compact.get_neighbors_of(0))
+        graph = compact.to_graph()
+        self.assertListEqual(vertices, graph.vertices)
+        self.assertListEqual(edges, graph.edges)
+
+    @unittest.skipIf(j2g.numpy is None, "NumPy is not installed")
+    def test_preprocess_vectorized(self):
+        """
+        Test that the NumPy kernels give the same result as the default
+        preprocessing steps, also when the arrays are passed on from one step
+        to the next, and that REMOVE_H_ALL uses them when they are built.
+
+        :return: Nothing.
+        """
+        vertices = [("c1", "6"), ("h1", "1"), ("h2", "1"), ("h3", "1"),
+                    ("c2", "6"), ("h4", "1"), ("o", "8"), ("h5", "1"),
+                    ("n", "7"), ("h6", "1")]
+        edges = [("c1", "h1", "1"), ("h2", "c1", "1"), ("c1", "h3", "1"),
+                 ("c1", "c2", "1"), ("c2", "h4", "1"), ("c2", "o", "2"),
+                 ("o", "h5", "1"), ("n", "h6", "1"), ("n", "x", "1")]
+        for step in j2g.VECTORIZED_STEPS:
+            expected = j2g.Graph(vertices, edges).preprocess(step)
+            actual = j2g.Graph(vertices, edges).preprocess_vectorized(step)
+            self.assertListEqual(expected.vertices, actual.vertices)
+            self.assertListEqual(expected.edges, actual.edges)
+        graph = j2g.Graph(vertices, edges)
+        for step in [j2g.Preprocessing.COMPRESS_CH3,
+                     j2g.Preprocessing.REMOVE_H,
+                     j2g.Preprocessing.REMOVE_H_ALL]:
+            graph = graph.preprocess_vectorized(step)
+            arrays = graph.get_arrays()
+            expected = j2g.Graph(graph.vertices, graph.edges).get_arrays()
+            for key in expected:
+                self.assertEqual(j2g.numpy.asarray(expected[key]).tolist(),
+                                 j2g.numpy.asarray(arrays[key]).tolist())
+        # REMOVE_H_ALL only uses its kernel if the arrays are built already.
+        graph = j2g.Graph([(str(i), "1" if i % 2 else "6")
+                           for i in range(j2g.VECTORIZE_MIN_VERTICES)],
+                          [("0", "1", "1"), ("0", "2", "1")])
+        step = j2g.Preprocessing.REMOVE_H_ALL
+        self.assertIsNone(graph.shallow_copy().preprocess(step)._arrays)
+        graph.get_arrays()
+        result = graph.shallow_copy().preprocess(step)
+        self.assertIsNotNone(result._arrays)
+        self.assertListEqual([("0", "2", "1")], result.edges)
+
+    def test_graph_batch(self):
+        """
+        Test that preprocessing a batch gives the same members as
+        preprocessing every graph on its own, and that batched conversion
+        writes the same files and keeps the input order for duplicates.
+
+        :return: Nothing.
+        """
+        graphs = [
+            j2g.Graph([("1", "6"), ("2", "1"), ("3", "1"), ("4", "1"),
+                       ("5", "8"), ("6", "1")],
+                      [("1", "2", "1"), ("1", "3", "1"), ("1", "4", "1"),
+                       ("1", "5", "1"), ("5", "6", "1")]),
+            j2g.Graph(),
+            j2g.Graph([("a", "1 1 6"), ("b", "8 8 1")], [("a", "b", "2")]),
+            j2g.Graph([("1", "6"), ("2", "1")], [("1", "3", "1")])
+        ]
+        steps = ["REMOVE_H", "COMPRESS_CH3", "GET_CONSENSUS"]
+        batch = j2g.GraphBatch()
+        self.assertListEqual([0, 1, 2, None],
+                             [batch.add(graph) for graph in graphs])
+        batch = batch.preprocessing(steps)
+        for member in range(3):
+            expected = graphs[member].copy().preprocessing(steps)
+            self.assertListEqual(expected.vertices,
+                                 batch.get_member(member).vertices)
+            self.assertListEqual(expected.edges,
+                                 batch.get_member(member).edges)
+        # The consensus label "1" is only interned by GET_CONSENSUS.
+        batch = j2g.GraphBatch()
+        batch.add(j2g.Graph([("a", "1 8"), ("b", "6")], [("a", "b", "2")]))
+        batch = batch.preprocessing(["GET_CONSENSUS", "REMOVE_H_ALL"])
+        self.assertListEqual([("b", "6")], batch.get_member(0).vertices)
+        self.assertListEqual([], batch.get_member(0).edges)
+        with tempfile.TemporaryDirectory() as tmp:
+            items = [(str(i), graph.copy(),
+                      os.path.join(tmp, str(i) + ".graph"))
+                     for i, graph in enumerate(graphs)]
+            self.assertEqual(4, j2g.convert_batched(items, "a", steps,
+                                                    batch_size=2))
+            for i, graph in enumerate(graphs):
+                graph.copy().preprocessing(steps).write(
+                    os.path.join(tmp, "expected.graph"), "a")
+                with open(os.path.join(tmp, "expected.graph")) as expected, \
+                        open(os.path.join(tmp, str(i) + ".graph")) as actual:
+                    self.assertEqual(expected.read(), actual.read())
+            # The third graph cannot be packed (an edge to an unknown vertex)
+            # and equals the first two after preprocessing.
+            graphs = [j2g.Graph([("1", "6"), ("2", "8")], [("1", "2", "2")]),
+                      j2g.Graph([("a", "6"), ("b", "8")], [("b", "a", "2")]),
+                      j2g.Graph([("1", "6"), ("2", "8")],
+                                [("1", "2", "2"), ("2", "3", "1")])]
+            for order, original in ((1, "0"), (-1, "2")):
+                items = [(str(i), graph.copy(),
+                          os.path.join(tmp, "d%d.graph" % i))
+                         for i, graph in enumerate(graphs)][::order]
+                dedupe = j2g.Deduplicator()
+                self.assertEqual(1, j2g.convert_batched(
+                    items, "a", ["REMOVE_H_ALL"], batch_size=8,
+                    dedupe=dedupe))
+                self.assertSetEqual({original},
+                                    set(dedupe.duplicates.values()))
+
+    def test_preprocessing_variants(self):
+        """
+        Test that every variant equals an independent run of its pipeline
+        and that the original graph is not changed.
+
+        :return: Nothing.
+        """
+        vertices = [("1", "6"), ("2", "1"), ("3", "1"), ("4", "1"),
+                    ("5", "8"), ("6", "1"), ("7", "6"), ("8", "1")]
+        edges = [("1", "2", "1"), ("1", "3", "1"), ("1", "4", "1"),
+                 ("1", "5", "1"), ("5", "6", "1"), ("5", "7", "1"),
+                 ("7", "8", "1")]
+        graph = j2g.Graph(list(vertices), list(edges))
+        pipelines = {"raw": [],
+                     "noh": ["REMOVE_H"],
+                     "ch3": ["REMOVE_H", "COMPRESS_CH3"],
+                     "all": ["REMOVE_H_ALL"],
+                     "ch3_all": ["COMPRESS_CH3", "REMOVE_H_ALL"]}
+        variants = graph.preprocessing_variants(pipelines)
+        self.assertSetEqual(set(pipelines), set(variants))
+        for name, steps in pipelines.items():
+            expected = j2g.Graph(list(vertices), list(edges))
+            expected = expected.preprocessing(steps)
+            self.assertListEqual(expected.vertices, variants[name].vertices)
+            self.assertListEqual(expected.edges, variants[name].edges)
+        self.assertListEqual(vertices, graph.vertices)
+        self.assertListEqual(edges, graph.edges)
+
+    def test_graph_view(self):
+        """
+        Test that preprocessing a view gives the same graph as preprocessing
+        the graph, without changing the base graph.
+
+        :return: Nothing.
+        """
+        vertices = [("1", "6"), ("2", "1"), ("3", "1"), ("4", "1"),
+                    ("5", "8"), ("6", "1"), ("7", "6 6 1"), ("8", "1 1 8")]
+        edges = [("1", "2", "1"), ("1", "3", "1"), ("1", "4", "1"),
+                 ("1", "5", "1"), ("5", "6", "1"), ("5", "7", "2"),
+                 ("7", "8", "1"), ("8", "9", "1")]
+        graph = j2g.Graph(list(vertices), list(edges))
+        for steps in [[], ["REMOVE_H"], ["REMOVE_H_ALL"],
+                      ["GET_CONSENSUS", "COMPRESS_CH3", "REMOVE_H"],
+                      ["COMPRESS_CH3", "GET_CONSENSUS", "REMOVE_H_ALL"]]:
+            view = graph.view().preprocessing(steps)
+            expected = j2g.Graph(list(vertices), list(edges))
+            expected = expected.preprocessing(steps)
+            actual = view.materialize()
+            self.assertListEqual(expected.vertices, actual.vertices)
+            self.assertListEqual(expected.edges, actual.edges)
+            self.assertEqual(len(expected.vertices), view.vertex_count)
+            self.assertEqual(len(expected.edges), view.edge_count)
+        self.assertListEqual(vertices, graph.vertices)
+        self.assertListEqual(edges, graph.edges)
+        view = graph.view().remove_vertices([0])
+        self.assertEqual(7, view.vertex_count)
+        self.assertEqual(3, view.edge_count)
+        with tempfile.TemporaryDirectory() as tmp:
+            view.write(os.path.join(tmp, "view.graph"), "a")
+            view.materialize().write(os.path.join(tmp, "graph.graph"), "a")
+            with open(os.path.join(tmp, "view.graph")) as actual, \
+                    open(os.path.join(tmp, "graph.graph")) as expected:
+                self.assertEqual(expected.read(), actual.read())
+
+    def test_out_of_core_graph(self):
+        """
+        Test that out-of-core processing writes the same files as
+        processing the parsed graph, also with tiny blocks.
+
+        :return: Nothing.
+        """
+        vertices = [("1", "6"), ("2", "1"), ("3", "1"), ("4", "1"),
+                    ("5", "8"), ("6", "1"), ("7", "6 6 1"), ("8", "1 1 8")]
+        edges = [("1", "2", "1"), ("1", "3", "1"), ("1", "4", "1"),
+                 ("1", "5", "1"), ("5", "6", "1"), ("5", "7", "2"),
+                 ("7", "8", "1"), ("8", "9", "1")]
+        with tempfile.TemporaryDirectory() as tmp:
+            inpath = os.path.join(tmp, "in.graph")
+            j2g.Graph(vertices, edges).write(inpath, "a")
+            for steps in [[], ["GET_CONSENSUS"], ["REMOVE_H_ALL"],
+                          ["REMOVE_H", "COMPRESS_CH3"],
+                          ["GET_CONSENSUS", "COMPRESS_CH3", "REMOVE_H"]]:
+                j2g.Graph.read_graph(inpath).preprocessing(steps)\
+                    .write(os.path.join(tmp, "expected.graph"), "b")
+                graph = j2g.OutOfCoreGraph(inpath, block_size=5)
+                graph.preprocessing(steps)
+                graph.write(os.path.join(tmp, "actual.graph"), "b")
+                graph.close()
+                with open(os.path.join(tmp, "expected.graph")) as expected, \
+                        open(os.path.join(tmp, "actual.graph")) as actual:
+                    self.assertEqual(expected.read(), actual.read())
+
+    def test_preprocessing_plan(self):
+        """
+        Test that local steps are merged and that the plan gives the same
+        result as running the steps one after another, also on the arrays of
+        a larger graph, without changing the graph.
+
+        :return: Nothing.
+        """
+        steps = ["GET_CONSENSUS", "REMOVE_H_ALL", "COMPRESS_CH3", "REMOVE_H"]
+        plan = j2g.PreprocessingPlan(steps)
+        self.assertListEqual([[j2g.Preprocessing.GET_CONSENSUS,
+                               j2g.Preprocessing.REMOVE_H_ALL],
+                              [j2g.Preprocessing.COMPRESS_CH3],
+                              [j2g.Preprocessing.REMOVE_H]], plan.passes)
+        self.assertTrue(plan.uses_neighbors)
+        self.assertFalse(j2g.PreprocessingPlan(steps[:2]).uses_neighbors)
+        vertices = [("1", "6 6 1"), ("2", "1 1 6"), ("3", "6"), ("4", "1"),
+                    ("5", "1"), ("6", "1 8 8"), ("7", "1")]
+        edges = [("1", "2", "1"), ("1", "3", "1"), ("3", "4", "1"),
+                 ("3", "5", "1"), ("3", "6", "2"), ("6", "7", "1"),
+                 ("7", "8", "1")]
+        for i in range(len(steps)):
+            expected = j2g.Graph(vertices, edges)
+            for step in steps[i:]:
+                expected = expected.preprocess(j2g.Preprocessing.get(step))
+            actual = j2g.PreprocessingPlan(steps[i:])\
+                .run(j2g.Graph(vertices, edges))
+            self.assertListEqual(expected.vertices, actual.vertices)
+            self.assertListEqual(expected.edges, actual.edges)
+        # Enough copies for the kernels (with NumPy), with edges between the
+        # copies.
+        copies = j2g.VECTORIZE_MIN_VERTICES // len(vertices) + 1
+        vertices = [(str(c) + "." + v, label) for c in range(copies)
+                    for v, label in vertices]
+        edges = [(str(c) + "." + s, str(c) + "." + t, label)
+                 for c in range(copies) for s, t, label in edges] + \
+            [(str(c) + ".6", str(c + 1) + ".7", "2")
+             for c in range(copies - 1)]
+        for i in range(len(steps)):
+            expected = j2g.Graph(vertices, edges)
+            for step in steps[i:]:
+                expected = expected.preprocess(j2g.Preprocessing.get(step))
+            graph = j2g.Graph(vertices, edges)
+            actual = j2g.PreprocessingPlan(steps[i:]).run(graph)
+            self.assertListEqual(expected.vertices, actual.vertices)
+            self.assertListEqual(expected.edges, actual.edges)
+            self.assertListEqual(vertices, graph.vertices)
+
+    def test_conversion_cache(self):
+        """
+        Test cache hits, misses and LRU eviction of the conversion cache and
+        that the entries are named like the outputs.
+
+        :return: Nothing.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            first = os.path.join(tmp, "first.json")
+            second = os.path.join(tmp, "second.json")
+            write_compound_json(first, [6, 1], [(1, 2, 1)])
+            write_compound_json(second, [8, 1], [(1, 2, 1)])
+            out = os.path.join(tmp, "out.graph")
+            cache = j2g.ConversionCache(os.path.join(tmp, "cache"), 100)
+            j2g.json2graph(first, out, "auto", "a", None, cache)
+            with open(out) as file:
+                expected = file.read()
+            j2g.json2graph(first, out, "auto", "a", None, cache)
+            with open(out) as file:
+                self.assertEqual(expected, file.read())
+            j2g.json2graph(first, out, "auto", "b", None, cache)
+            self.assertDictEqual({"hits": 1, "misses": 2, "entries": 1,
+                                  "size": len(expected)},
+                                 cache.stats())
+            j2g.json2graph(second, out, "auto", "a", None, cache)
+            reopened = j2g.ConversionCache(os.path.join(tmp, "cache"), 100)
+            self.assertEqual(1, reopened.stats()["entries"])
+            binary = os.path.join(tmp, "out.bgraph")
+            cache = j2g.ConversionCache(os.path.join(tmp, "cache"), 1 << 20)
+            for _ in range(2):
+                j2g.json2graph(first, binary, "auto", "a", None, cache,
+                               "binary")
+            self.assertEqual(1, cache.stats()["hits"])
+            key = j2g.ConversionCache.get_key(first, "auto", "a", None,
+                                              "binary")
+            self.assertTrue(key.endswith(".bgraph"))
+            self.assertTrue(os.path.exists(cache._get_path(key)))
+            self.assertListEqual([("1", "6"), ("2", "1")],
+                                 j2g.Graph.read_graph(binary).vertices)
+
+    def test_binary_format(self):
+        """
+        Test that the binary graph format round-trips losslessly with the
+        .graph format.
+
+        :return: Nothing.
+        """
+        vertices = [("1", "6"), ("2", "8"), ("3", "CH3")]
+        edges = [("1", "2", "2"), ("3", "1", "1"), ("3", "4", "")]
+        with tempfile.TemporaryDirectory() as tmp:
+            binary = os.path.join(tmp, "test.bgraph")
+            text = os.path.join(tmp, "test.graph")
+            j2g.Graph(vertices, edges).write(binary, "me", "binary")
+            compact = j2g.Graph.read_graph(binary, compact=True)
+            self.assertEqual("me", compact.author)
+            self.assertIsInstance(compact.edge_sources, memoryview)
+            graph = j2g.Graph.read_graph(binary)
+            self.assertListEqual(vertices, graph.vertices)
+            self.assertListEqual(edges, graph.edges)
+            compact.write(text, compact.author)
+            graph = j2g.Graph.read_graph(text, compact=True)
+            self.assertEqual("me", graph.author)
+            self.assertListEqual(edges, list(graph.iter_edges()))
+            compressed = os.path.join(tmp, "test.bgraph.gz")
+            j2g.Graph(vertices, edges).write(compressed, "me", "binary")
+            for path in binary, compressed:
+                self.assertDictEqual({"author": "me", "vertex_count": 3,
+                                      "edge_count": 3},
+                                     j2g.Graph.read_graph_header(path))
+
+    def test_read_graph_graph(self):
+        """
+        Test the block-wise .graph parser with wrong header counts, a block
+        size smaller than a line and the header-only mode.
+
+        :return: Nothing.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "test.graph")
+            with open(path, "w") as file:
+                file.write("// comment\nAUTHOR: me\n#nodes;2\n#edges;5\n"
+                           "Nodes labelled;True\nEdges labelled;False\n"
+                           "Directed graph;False\n\n"
+                           "1;6\n2;8\n3;1 \n\n1;2\n3;1")
+            for block_size in (1, 5, 1 << 22):
+                graph = j2g.Graph.read_graph_graph(path, False, block_size)
+                self.assertListEqual([("1", "6"), ("2", "8"), ("3", "1")],
+                                     graph.vertices)
+                self.assertListEqual([("1", "2", ""), ("3", "1", "")],
+                                     graph.edges)
+                compact = j2g.Graph.read_graph_graph(path, True, block_size)
+                self.assertEqual("me", compact.author)
+                self.assertListEqual(graph.vertices,
+                                     list(compact.iter_vertices()))
+                self.assertListEqual(graph.edges, list(compact.iter_edges()))
+            # Huge header counts only preallocate PREALLOCATE_MAX entries.
+            huge = os.path.join(tmp, "huge.graph")
+            with open(huge, "w") as file:
+                file.write("#nodes;2000000000\n#edges;2000000000\n"
+                           "Edges labelled;True\n\n"
+                           "1;6\n\n1;1;2")
+            self.assertListEqual([("1", "1", "2")],
+                                 j2g.Graph.read_graph_graph(huge).edges)
+            self.assertDictEqual({"author": "me", "vertex_count": 2,
+                                  "edge_count": 5},
+                                 j2g.Graph.read_graph_header(path))
+
+    def test_profiler(self):
+        """
+        Test that the profiler records every stage of a conversion, every step
+        of a preprocessing plan, and every stage of -V and -M.
+
+        :return: Nothing.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            inpath = os.path.join(tmp, "in.json")
+            write_compound_json(inpath, [6, 1, 1, 1, 8],
+                                [(1, 2, 1), (1, 3, 1), (1, 4, 1), (1, 5, 1)])
+            profiler = j2g.Profiler()
+            j2g.json2graph(inpath, os.path.join(tmp, "out.graph"), "auto",
+                           None, ["REMOVE_H_ALL", "COMPRESS_CH3"],
+                           profiler=profiler)
+            j2g.json2graph(inpath, os.path.join(tmp, "out.graph"), "auto",
+                           None, ["REMOVE_H_ALL"], profiler=profiler)
+            report = os.path.join(tmp, "report.jsonl")
+            self.assertEqual(0, j2g.main(
+                ["-O", os.path.join(tmp, "variants"), "--profile", report,
+                 "-V", "a=REMOVE_H_ALL", "-V", "b=REMOVE_H_ALL,COMPRESS_CH3",
+                 inpath]))
+            with open(report) as file:
+                variant_records = [json.loads(line) for line in file]
+            self.assertEqual(0, j2g.main(
+                ["-O", os.path.join(tmp, "multi"), "-M", "--profile", report,
+                 inpath, "-P", "REMOVE_H_ALL"]))
+            with open(report) as file:
+                multi_records = [json.loads(line) for line in file]
+        self.assertListEqual(["read", "preprocess.REMOVE_H_ALL",
+                              "preprocess.COMPRESS_CH3", "write", "read",
+                              "preprocess.REMOVE_H_ALL", "write"],
+                             [r["stage"] for r in profiler.records])
+        self.assertEqual((5, 4), (profiler.records[1]["vertices_before"],
+                                  profiler.records[1]["edges_before"]))
+        self.assertEqual((2, 1), (profiler.records[1]["vertices_after"],
+                                  profiler.records[1]["edges_after"]))
+        self.assertEqual(2, profiler.records[2]["vertices_before"])
+        self.assertEqual(1, profiler.records[3]["edges_after"])
+        self.assertIn("Slowest files", profiler.summary())
+        self.assertListEqual(["read", "preprocess.REMOVE_H_ALL",
+                              "preprocess.COMPRESS_CH3", "write.a",
+                              "write.b"],
+                             [r["stage"] for r in variant_records])
+        self.assertListEqual([("read", inpath + "#0"),
+                              ("preprocess.REMOVE_H_ALL", inpath + "#0"),
+                              ("write", inpath + "#0"), ("read", inpath)],
+                             [(r["stage"], r["file"]) for r in multi_records])
+
+    def test_watch_directory(self):
+        """
+        Test that the watch mode converts new and modified files only once,
+        also across restarts.
+
+        :return: Nothing.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            indir = os.path.join(tmp, "in")
+            outdir = os.path.join(tmp, "out")
+            os.mkdir(indir)
+            os.mkdir(outdir)
+            first = os.path.join(indir, "first.json")
+            write_compound_json(first, [6, 8], [(1, 2, 2)])
+            with open(os.path.join(indir, "notes.txt"), "w") as file:
+                file.write("no graph")
+            j2g.watch_directory(indir, outdir, "auto", "a", debounce=0,
+                                iterations=1)
+            outfile = os.path.join(outdir, "first.json.graph")
+            self.assertEqual(2, len(os.listdir(outdir)))
+            os.remove(outfile)
+            j2g.watch_directory(indir, outdir, "auto", "a", debounce=0,
+                                iterations=1)
+            self.assertFalse(os.path.exists(outfile))
+            write_compound_json(first, [6, 8, 8], [(1, 2, 2), (1, 3, 2)])
+            os.utime(first, ns=(0, 1))
+            j2g.watch_directory(indir, outdir, "auto", "a", debounce=0,
+                                iterations=1)
+            self.assertEqual(3, len(j2g.Graph.read_graph(outfile).vertices))
+
+    def test_conversion_server(self):
+        """
+        Test that the server converts like the command line, reuses parsed
+        graphs until the input changes, keeps the cache within its limit and
+        answers malformed requests with an error.
+
+        :return: Nothing.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            infile = os.path.join(tmp, "in.json")
+            write_compound_json(infile, [6, 1, 1, 1, 8],
+                                [(1, 2, 1), (1, 3, 1), (1, 4, 1), (1, 5, 2)])
+            cache = j2g.GraphCache()
+            server = j2g.ConversionServer(os.path.join(tmp, "s.sock"), cache)
+            thread = threading.Thread(target=server.serve)
+            thread.start()
+
+            def send(request):
+                with socket.socket(socket.AF_UNIX) as connection:
+                    connection.connect(server.path)
+                    with connection.makefile("rwb") as stream:
+                        stream.write(json.dumps(request).encode() + b"\n")
+                        stream.flush()
+                        return json.loads(stream.readline().decode())
+
+            try:
+                argv = ["-f", "-P", "COMPRESS_CH3", "-o", "out.graph",
+                        "in.json"]
+                for _ in range(2):
+                    reply = send({"argv": argv, "cwd": tmp})
+                    self.assertEqual(0, reply["exit_code"])
+                self.assertEqual((1, 1), (cache.hits, cache.misses))
+                graph = j2g.Graph.read_graph(os.path.join(tmp, "out.graph"))
+                self.assertListEqual([("1", "CH3"), ("5", "8")],
+                                     graph.vertices)
+                self.assertEqual(5, len(cache.read_graph(infile).vertices))
+                os.utime(infile, ns=(0, 1))
+                cache.read_graph(infile)
+                self.assertEqual((2, 2), (cache.hits, cache.misses))
+                self.assertEqual(1, len(cache.entries))
+                reply = send({"argv": ["-P", "FOO", "-o", "x", "in.json"],
+                              "cwd": tmp})
+                self.assertEqual(1, reply["exit_code"])
+                self.assertIn("FOO", reply["stderr"])
+                for request in ([1, 2], "stop", None, 3):
+                    reply = send(request)
+                    self.assertEqual(1, reply["exit_code"])
+                    self.assertIn("Malformed", reply["stderr"])
+                with socket.socket(socket.AF_UNIX) as connection:
+                    connection.connect(server.path)
+                    with connection.makefile("rwb") as stream:
+                        stream.write(b"{not json\n")
+                        stream.flush()
+                        reply = json.loads(stream.readline().decode())
+                self.assertEqual(1, reply["exit_code"])
+            finally:
+                send({"stop": True})
+                thread.join()
+                server.close()
+            cache = j2g.GraphCache(max_size=1)
+            cache.read_graph(infile)
+            self.assertEqual(0, cache.size)
+
 
 if __name__ == '__main__':
     unittest.main()